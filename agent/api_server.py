@@ -1,9 +1,44 @@
-from fastapi import FastAPI, Depends, HTTPException
+import os
+import time
+
+# Set STARTUP_PROFILE=1 to log startup timings (run startup_profile.py for per-import times)
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "") not in ("", "0", "false")
+_import_started = time.perf_counter()
+
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, Header, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any, Union
-import uvicorn
-from pharma_agent import PharmacistAgent
+from typing import List, Optional, Dict, Any, Literal, Union
+import asyncio
+import contextvars
+import heapq
+import json
+import secrets
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pharma_agent import (
+    TRANSITION_TEMPLATES, PharmacistAgent, RequestCancelled, conversation_transition, repair_raw_diagnosis
+)
+from greeting_cache import GreetingCache
+from speculative_diagnosis import SpeculativeDiagnosisStore
+from session_snapshot import open_snapshot, write_snapshot
+from fallback_diagnosis import FallbackDiagnosisEngine
+from compact_session import CompactSession, messages_from_snapshot
+from usage_tracker import UsageTracker, TokenBudgetExceeded
+from token_caps import AdaptiveTokenCaps
+from medical_context import MedicalContextStore
+from db_pool import LazyConnectionPool
+from write_behind import WriteBehindWriter
+from session_export import iter_ndjson, iter_parquet, iter_records
+from profiling import ProfileStore, RequestProfiler, collapsed_text, profiled, sample_stacks
+from diagnosis_stream import IncrementalDiagnosisParser, sse_event
+from idempotency import IdempotencyConflict, ReplayCache
+from diagnosis_jobs import FINISHED, DiagnosisJobQueue, InMemoryJobStore, QueueFull
+from symptom_record import SymptomRecord
+from memory_report import InflightCounter, InflightRequests, TracemallocDiff, deep_sizeof, process_memory
+from tracing import Tracer, TraceRequests, current_traceparent, load_exporter, span
 
 app = FastAPI(title="PharmaAI API")
 
@@ -21,20 +56,40 @@ class SymptomRequest(BaseModel):
     user_id: str
     on_demand: Optional[bool] = False
     conversation: Optional[List[Dict[str, str]]] = None
+    # Alternative to the Idempotency-Key header for clients that can't set headers
+    client_message_id: Optional[str] = None
 
 class ChatMessage(BaseModel):
-    role: str  # 'user' or 'assistant'
+    role: Literal["system", "user", "assistant"]
     content: str
 
+class IndexedMessage(ChatMessage):
+    index: int  # position in the session, stable while the session isn't cleared
+
+class ConversationPage(BaseModel):
+    user_id: str
+    session_version: int
+    total: int
+    # Oldest first within the page; pass next_cursor as ?before= for the page of older messages
+    messages: List[IndexedMessage]
+    next_cursor: Optional[str] = None
+
 class ConversationRequest(BaseModel):
     user_id: str
-    conversation: List[ChatMessage]
+    # Full conversation. Sent with session_version (a resync after a version mismatch) it replaces
+    # the stored turns; without it (legacy clients) it is diagnosed as-is, leaving the session alone.
+    conversation: Optional[List[ChatMessage]] = None
     on_demand: Optional[bool] = False
+    # Delta sync: the session version the client last saw plus any messages added since.
+    # Sending neither field nor a conversation diagnoses the stored session as-is.
+    session_version: Optional[int] = None
+    new_messages: Optional[List[ChatMessage]] = None
 
 class ChatResponse(BaseModel):
     response: str
     conversation_id: str
     readyForDiagnosis: Optional[bool] = False
+    session_version: Optional[int] = None
 
 class PrescriptionItem(BaseModel):
     drug_name: str
@@ -47,81 +102,668 @@ class DiagnosisData(BaseModel):
     diagnosis: str
     prescriptions: List[PrescriptionItem]
     follow_up_recommendations: str = "None"
+    preliminary: bool = False
 
 class DiagnosisResponse(BaseModel):
     response: str
     diagnosis: Optional[DiagnosisData] = None
     checkout_ready: Optional[bool] = False
     error: Optional[str] = None
+    session_version: Optional[int] = None
+
+class DiagnosisJob(BaseModel):
+    job_id: str
+    status: str  # 'queued', 'running', 'done' or 'failed'
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[DiagnosisResponse] = None
+    error: Optional[str] = None
 
 # Dictionary to store user-specific conversation histories
-user_conversations: Dict[str, List[Dict[str, str]]] = {}
+# (CompactSession behaves like a list of message dicts but stores them compactly)
+user_conversations: Dict[str, CompactSession] = {}
+# Latest diagnosis per user (with a diagnosed_at timestamp), kept for the analytics export
+user_diagnoses: Dict[str, Dict[str, Any]] = {}
 
 # Create a shared PharmacistAgent instance for generating responses
-# (No longer storing conversation history in this instance)
-shared_agent = PharmacistAgent()
+# (No longer storing conversation history in this instance).
+# Construction is cheap: the API key check runs in the background at startup
+# and its result is reported by /api/ready.
+shared_agent = PharmacistAgent(validate=False)
+upstream_status: Dict[str, Any] = {"ok": False, "detail": "Upstream check not run yet", "checked_at": None}
+
+# Token and latency accounting per call type and user, with optional per-user budgets
+# (USER_TOKEN_BUDGET tokens per USER_TOKEN_BUDGET_WINDOW seconds; 0 disables budgets)
+usage_tracker = UsageTracker(
+    max_users=int(os.getenv("USAGE_MAX_USERS", "10000")),
+    sink_path=os.getenv("USAGE_LOG_PATH", "") or None,
+    user_token_budget=int(os.getenv("USER_TOKEN_BUDGET", "0")),
+    budget_window=float(os.getenv("USER_TOKEN_BUDGET_WINDOW", "3600")),
+)
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "60"))
+
+# max_tokens caps learned per call type from observed output lengths
+# (the agent's defaults of 2000 for chat and 4000 for diagnosis stay the upper bound)
+token_caps: Optional[AdaptiveTokenCaps] = None
+if os.getenv("ADAPTIVE_MAX_TOKENS", "true").lower() == "true":
+    token_caps = AdaptiveTokenCaps(
+        percentile=float(os.getenv("ADAPTIVE_MAX_TOKENS_PERCENTILE", "0.99")),
+        margin=float(os.getenv("ADAPTIVE_MAX_TOKENS_MARGIN", "0.25")),
+        floor=int(os.getenv("ADAPTIVE_MAX_TOKENS_FLOOR", "256")),
+    )
+DEFAULT_MAX_TOKENS = {"greeting": 2000, "follow_up": 2000, "completion": 2000, "on_demand": 2000, "diagnosis": 4000}
+
+# Patient records (allergies, medications, active prescriptions) from the app's database,
+# added to prompts so the assistant doesn't ask for them again. Enabled when DATABASE_URL is set.
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+database_pool: Optional[LazyConnectionPool] = None
+if DATABASE_URL:
+    database_pool = LazyConnectionPool(
+        DATABASE_URL,
+        max_connections=int(os.getenv("DB_POOL_MAX_CONNECTIONS", "4")),
+        acquire_timeout=float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "5")),
+    )
+medical_contexts: Optional[MedicalContextStore] = None
+if database_pool is not None and os.getenv("MEDICAL_CONTEXT_ENABLED", "true").lower() == "true":
+    medical_contexts = MedicalContextStore(
+        database_pool,
+        ttl=float(os.getenv("MEDICAL_CONTEXT_TTL", "300")),
+        token_budget=int(os.getenv("MEDICAL_CONTEXT_TOKEN_BUDGET", "150")),
+    )
+
+async def medical_context_for(user_id: str) -> Optional[str]:
+    """Return the user's cached patient record block, if any."""
+    if medical_contexts is None:
+        return None
+    return await medical_contexts.get(user_id) or None
+
+async def known_allergies(user_id: str) -> List[str]:
+    """Return the allergies on the user's patient record, for the fallback engine."""
+    if medical_contexts is None:
+        return []
+    return await medical_contexts.get_allergies(user_id)
+
+def invalidate_medical_contexts(user_ids):
+    if medical_contexts is not None:
+        for user_id in user_ids:
+            medical_contexts.invalidate(user_id)
+
+# Audit trail: chat turns and diagnoses are queued and written to the Conversation table in
+# batches off the request path (enable with PERSIST_CONVERSATIONS=true). PERSIST_PRESCRIPTIONS
+# also writes diagnosed prescriptions; leave it off when the app saves them at checkout.
+conversation_writer: Optional[WriteBehindWriter] = None
+if database_pool is not None and os.getenv("PERSIST_CONVERSATIONS", "false").lower() == "true":
+    conversation_writer = WriteBehindWriter(
+        database_pool,
+        batch_size=int(os.getenv("PERSIST_BATCH_SIZE", "200")),
+        flush_interval=float(os.getenv("PERSIST_FLUSH_INTERVAL", "2")),
+        max_pending=int(os.getenv("PERSIST_MAX_PENDING", "5000")),
+        persist_prescriptions=os.getenv("PERSIST_PRESCRIPTIONS", "false").lower() == "true",
+        on_prescriptions_written=invalidate_medical_contexts,
+    )
+
+def new_agent(user_id: Optional[str] = None, medical_context: Optional[str] = None, **kwargs) -> PharmacistAgent:
+    """Create a per-request agent that reuses the shared agent's HTTP client."""
+    agent = PharmacistAgent(validate=False, **kwargs)
+    agent.client = shared_agent.client
+    agent.usage_tracker = usage_tracker
+    agent.user_id = user_id
+    agent.token_caps = token_caps
+    agent.medical_context = medical_context
+    return agent
+
+def budget_exceeded_response(e: TokenBudgetExceeded) -> JSONResponse:
+    print(f"Rejecting request: {str(e)}")
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Token budget exceeded, please try again later", "retry_after": round(e.retry_after)},
+        headers={"Retry-After": str(int(e.retry_after) + 1)}
+    )
+
+# Admin endpoints require the X-Admin-Token header to match ADMIN_API_TOKEN (disabled when unset)
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "")
+
+def is_admin_token(token: Optional[str]) -> bool:
+    return bool(ADMIN_API_TOKEN and token and secrets.compare_digest(token, ADMIN_API_TOKEN))
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+# Per-request cProfile: /api/chat and /api/diagnose calls sent with X-Profile and the admin
+# token return an X-Profile-Id whose stats are at /api/admin/profiles/{id} (and, with
+# PROFILE_DIR, in {id}.prof). The middleware is only installed when admin endpoints are enabled.
+profile_store = ProfileStore(keep=int(os.getenv("PROFILE_KEEP", "20")), dump_dir=os.getenv("PROFILE_DIR", "") or None)
+if ADMIN_API_TOKEN:
+    app.add_middleware(
+        RequestProfiler,
+        paths=["/api/chat", "/api/diagnose"],
+        authorize=lambda headers: is_admin_token(headers.get("x-admin-token")),
+        store=profile_store,
+    )
+
+# Request tracing (enable with TRACE_EXPORTER=stdout, file or module:factory): sampled chat and
+# diagnose requests get a span per phase, continuing the caller's traceparent header. Requests
+# the caller hasn't already sampled are traced with probability TRACE_SAMPLE_RATE.
+tracer = Tracer(
+    load_exporter(os.getenv("TRACE_EXPORTER", ""), os.getenv("TRACE_FILE", "") or None),
+    sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0.01")),
+)
+if tracer.exporter is not None:
+    app.add_middleware(TraceRequests, tracer=tracer, paths=["/api/chat", "/api/diagnose"])
+
+# Requests in progress, reported by /api/admin/memory
+inflight_requests = InflightCounter()
+app.add_middleware(InflightRequests, counter=inflight_requests)
+
+# Optional cache for first-turn greetings (enable with GREETING_CACHE_ENABLED=true)
+greeting_cache: Optional[GreetingCache] = None
+if os.getenv("GREETING_CACHE_ENABLED", "false").lower() == "true":
+    greeting_cache = GreetingCache(
+        max_entries=int(os.getenv("GREETING_CACHE_MAX_ENTRIES", "256")),
+        variants_per_entry=int(os.getenv("GREETING_CACHE_VARIANTS", "3")),
+        similarity_threshold=float(os.getenv("GREETING_CACHE_SIMILARITY", "0.75")),
+    )
+
+# "No more"/"that's all" and "diagnose me" turns are answered from templates instead of a
+# completion (TEMPLATE_TRANSITIONS=false keeps the LLM's phrasing). TRANSITION_TEMPLATES_PATH
+# may point to a JSON file like {"completion": [...], "on_demand": [...]} replacing the defaults.
+def load_transition_templates(path: str) -> Dict[str, List[str]]:
+    templates = {transition: list(replies) for transition, replies in TRANSITION_TEMPLATES.items()}
+    if path:
+        with open(path) as f:
+            configured = json.load(f)
+        for transition, replies in configured.items():
+            if transition not in templates:
+                raise ValueError(f"Unknown transition {transition!r} in {path}")
+            if not replies or not all(isinstance(reply, str) and reply for reply in replies):
+                raise ValueError(f"{path}: {transition!r} needs a non-empty list of replies")
+            templates[transition] = list(replies)
+    return templates
+
+transition_templates: Optional[Dict[str, List[str]]] = None
+if os.getenv("TEMPLATE_TRANSITIONS", "true").lower() == "true":
+    transition_templates = load_transition_templates(os.getenv("TRANSITION_TEMPLATES_PATH", ""))
+template_replies: Dict[str, int] = {"completion": 0, "on_demand": 0}
+
+# Diagnoses started in the background as soon as a chat reaches the diagnosis trigger
+speculative_diagnoses = SpeculativeDiagnosisStore()
+
+# Chat retries carrying the same Idempotency-Key (or client_message_id) get the original
+# response instead of appending the message again and making another completion
+chat_replays = ReplayCache(
+    ttl=float(os.getenv("IDEMPOTENCY_TTL", "600")),
+    max_entries=int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000")),
+)
+
+# Degraded mode: when the upstream misses its deadline, errors, or too many diagnoses
+# are already in flight, answer from the local rule-based engine instead
+FALLBACK_DIAGNOSIS_ENABLED = os.getenv("FALLBACK_DIAGNOSIS_ENABLED", "true").lower() == "true"
+DIAGNOSIS_DEADLINE_SECONDS = float(os.getenv("DIAGNOSIS_DEADLINE_SECONDS", "25"))
+DIAGNOSIS_MAX_CONCURRENCY = int(os.getenv("DIAGNOSIS_MAX_CONCURRENCY", "8"))
+fallback_engine = FallbackDiagnosisEngine()
+diagnosis_slots = asyncio.Semaphore(DIAGNOSIS_MAX_CONCURRENCY)
+# One thread per slot, so diagnoses never queue behind chat turns in the default executor
+diagnosis_executor = ThreadPoolExecutor(max_workers=DIAGNOSIS_MAX_CONCURRENCY, thread_name_prefix="diagnosis")
+fallback_counts: Dict[str, int] = {"deadline": 0, "overloaded": 0, "upstream_error": 0, "parse_error": 0}
+
+async def start_in_diagnosis_slot(func, *args) -> "asyncio.Future":
+    """Take a diagnosis slot and run ``func(*args)`` on a diagnosis thread.
+
+    The slot is released when the thread returns (or when the call is cancelled before it
+    starts), not when the caller stops waiting, so a diagnosis abandoned at its deadline, on a
+    disconnect or for a newer message still counts against the limit while its thread runs.
+    """
+    await diagnosis_slots.acquire()
+    loop = asyncio.get_running_loop()
+
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(diagnosis_slots.release)
+        except RuntimeError:
+            pass  # the loop has already closed on shutdown
+
+    future = diagnosis_executor.submit(contextvars.copy_context().run, func, *args)
+    future.add_done_callback(release)
+    return asyncio.wrap_future(future)
+
+def fallback_response(conversation_history: List[Dict[str, str]], reason: str,
+                      allergies: List[str] = ()) -> Dict[str, Any]:
+    """Build a /api/diagnose response from the local fallback engine."""
+    fallback_counts[reason] += 1
+    print(f"Using fallback diagnosis engine ({reason})")
+    with span("diagnosis.fallback", reason=reason):
+        diagnosis = fallback_engine.diagnose(conversation_history, allergies)
+    return {
+        "response": "Our full assessment service is busy, so here's a preliminary assessment based on what you've shared.",
+        "diagnosis": diagnosis,
+        "checkout_ready": bool(diagnosis["prescriptions"]),
+        "error": None
+    }
+
+# Sessions persisted across restarts (enable with SESSION_SNAPSHOT_PATH).
+# The previous snapshot is memory-mapped and sessions are decoded on first access.
+SESSION_SNAPSHOT_PATH = os.getenv("SESSION_SNAPSHOT_PATH", "")
+SESSION_SNAPSHOT_INTERVAL = float(os.getenv("SESSION_SNAPSHOT_INTERVAL", "60"))
+restored_sessions = open_snapshot(SESSION_SNAPSHOT_PATH) if SESSION_SNAPSHOT_PATH else None
+if restored_sessions is not None:
+    print(f"Mapped session snapshot with {len(restored_sessions)} sessions from {SESSION_SNAPSHOT_PATH}")
+
+# Session versions start from the process start time (in units of 2**20 changes), so versions
+# handed out after a restart are above any from before it, even for a session restored from a
+# snapshot taken before its last changes. Stays below 2**53 for JavaScript clients.
+SESSION_VERSION_BASE = int(time.time()) << 20
+
+def new_session(messages: Optional[List[Dict[str, str]]] = None) -> CompactSession:
+    """Create a session that shares the agent's system prompt; seeded with it when no messages are given."""
+    system_message = shared_agent.conversation_history[0]
+    return CompactSession(
+        system_message["content"], messages if messages is not None else [system_message], version=SESSION_VERSION_BASE
+    )
+
+def find_user_conversation(user_id: str) -> Optional[CompactSession]:
+    """Return a user's conversation history if one exists in memory or in the restored snapshot."""
+    if user_id not in user_conversations and restored_sessions is not None:
+        restored = restored_sessions.get(user_id)
+        if restored is not None:
+            user_conversations[user_id] = new_session(restored)
+    return user_conversations.get(user_id)
 
 # Function to get or initialize a user's conversation history
-def get_user_conversation(user_id: str) -> List[Dict[str, str]]:
+def get_user_conversation(user_id: str) -> CompactSession:
     """Get or initialize a conversation history for a specific user."""
-    if user_id not in user_conversations:
+    if find_user_conversation(user_id) is None:
         # Initialize with the system message from the agent
-        user_conversations[user_id] = [shared_agent.conversation_history[0].copy()]
+        user_conversations[user_id] = new_session()
     
     return user_conversations[user_id]
 
+# Compact diagnosis prompts (enable with COMPACT_DIAGNOSIS_PROMPT=true): a rule-based clinical
+# record, updated as each user message arrives, plus the last few messages replace the transcript
+COMPACT_DIAGNOSIS_PROMPT = os.getenv("COMPACT_DIAGNOSIS_PROMPT", "false").lower() == "true"
+COMPACT_DIAGNOSIS_RECENT_MESSAGES = int(os.getenv("COMPACT_DIAGNOSIS_RECENT_MESSAGES", "6"))
+symptom_records: Dict[str, SymptomRecord] = {}
+# Records are synced from the event loop (chat) and from diagnosis worker threads
+symptom_records_lock = threading.Lock()
+
+def clinical_record_for(user_id: str, conversation) -> str:
+    """Bring the user's symptom record up to date with the conversation and return its summary."""
+    with symptom_records_lock:
+        record = symptom_records.get(user_id)
+        if record is None:
+            record = symptom_records[user_id] = SymptomRecord()
+        record.sync(conversation)
+        return record.summary()
+
+def run_diagnosis(conversation_history: List[Dict[str, str]], on_demand: bool = False,
+                  cancel_event: Optional[threading.Event] = None, user_id: Optional[str] = None,
+                  medical_context: Optional[str] = None, on_delta=None) -> Dict[str, Any]:
+    """Generate a diagnosis for a conversation, recovering JSON from raw responses where possible.
+
+    ``on_delta`` receives the reply text as it streams in.
+    """
+    # Process the user's conversation history and generate a diagnosis
+    # Use a fresh agent to avoid any state conflicts
+    diagnosis_agent = new_agent(user_id=user_id, medical_context=medical_context)
+    diagnosis_agent.cancel_event = cancel_event
+    if COMPACT_DIAGNOSIS_PROMPT and user_id:
+        diagnosis_agent.clinical_record = clinical_record_for(user_id, conversation_history)
+        diagnosis_agent.recent_messages = COMPACT_DIAGNOSIS_RECENT_MESSAGES
+    if on_delta is not None:
+        diagnosis_agent.on_delta = on_delta
+        # A reply cut short by a learned cap can't be retried once its pieces have been streamed out
+        diagnosis_agent.token_caps = None
+    
+    # Add enhanced error handling
+    try:
+        diagnosis = diagnosis_agent.generate_diagnosis(
+            conversation_history=conversation_history, 
+            on_demand=on_demand
+        )
+        
+        # Log the diagnosis format for debugging
+        print(f"Generated diagnosis: {diagnosis}")
+        
+        # If we get a raw_response, try to parse it
+        diagnosis = repair_raw_diagnosis(diagnosis)
+
+    except (RequestCancelled, TokenBudgetExceeded):
+        raise
+    except Exception as diag_err:
+        print(f"Error in diagnosis generation: {str(diag_err)}")
+        diagnosis = {
+            "error": f"Error generating diagnosis: {str(diag_err)}",
+            "diagnosis": "Unable to generate diagnosis due to a system error",
+            "prescriptions": [],
+            "follow_up_recommendations": "Please try again later"
+        }
+    
+    return diagnosis
+
+def normalize_prescription(rx: Dict[str, Any]) -> Dict[str, Any]:
+    """Fill in missing PrescriptionItem fields of a prescription dict, in place."""
+    # Ensure all required fields exist
+    if "drug_name" not in rx and "drug" in rx:
+        rx["drug_name"] = rx["drug"]
+        del rx["drug"]
+    elif "drug_name" not in rx:
+        rx["drug_name"] = "Unknown medication"
+        
+    if "dosage" not in rx:
+        rx["dosage"] = "As directed"
+    if "form" not in rx:
+        rx["form"] = "tablet"
+    if "duration" not in rx:
+        rx["duration"] = "As needed"
+    if "instructions" not in rx:
+        rx["instructions"] = "Take as directed by healthcare provider"
+    return rx
+
+def normalize_diagnosis(diagnosis: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a raw diagnosis dict into the DiagnosisData shape, filling in missing prescription fields."""
+    # Prepare the response - ensure it uses the new format
+    # Convert old format to new format if needed
+    prescriptions = []
+    if "prescriptions" in diagnosis:
+        prescriptions = diagnosis.get("prescriptions", [])
+    elif "prescription" in diagnosis:
+        # Convert old format to new format
+        old_prescriptions = diagnosis.get("prescription", [])
+        if isinstance(old_prescriptions, list):
+            for rx in old_prescriptions:
+                if isinstance(rx, dict):
+                    new_rx = {
+                        "drug_name": rx.get("drug", "Unknown medication"),
+                        "dosage": rx.get("dosage", "As directed"),
+                        "form": "tablet",  # Default form
+                        "duration": rx.get("duration", "As needed"),
+                        "instructions": "Take as directed by healthcare provider"
+                    }
+                    prescriptions.append(new_rx)
+    
+    # Ensure each prescription has all required fields
+    for rx in prescriptions:
+        if isinstance(rx, dict):
+            normalize_prescription(rx)
+            
+    # Ensure follow_up_recommendations field exists
+    follow_up = diagnosis.get("follow_up_recommendations", "None")
+    
+    final_diagnosis = {
+        "diagnosis": diagnosis.get("diagnosis", "Unable to determine diagnosis"),
+        "prescriptions": prescriptions,
+        "follow_up_recommendations": follow_up
+    }
+    
+    return final_diagnosis
+
+# Upstream calls are aborted when the HTTP client goes away (closed tab, Next.js route timeout).
+# With KEEP_DIAGNOSIS_ON_DISCONNECT=true a disconnected diagnosis finishes anyway and is kept
+# for the user's next /api/diagnose instead.
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+KEEP_DIAGNOSIS_ON_DISCONNECT = os.getenv("KEEP_DIAGNOSIS_ON_DISCONNECT", "false").lower() == "true"
+cancellation_counts: Dict[str, int] = {"chat": 0, "diagnose": 0, "diagnose_deadline": 0, "diagnoses_kept": 0, "tokens_saved": 0}
+
+async def finished_before_disconnect(http_request: Optional[Request], work: "asyncio.Future") -> bool:
+    """Wait for ``work``; return False as soon as the client disconnects while it is still running."""
+    while not work.done():
+        await asyncio.wait({work}, timeout=DISCONNECT_POLL_SECONDS)
+        if not work.done() and http_request is not None and await http_request.is_disconnected():
+            return False
+    return True
+
+def cancel_upstream(kind: str, work: "asyncio.Future", cancel_event: threading.Event):
+    """Abort a running upstream call and count the tokens it no longer generates."""
+    def count_tokens(task):
+        if not task.cancelled() and isinstance(task.exception(), RequestCancelled):
+            cancellation_counts["tokens_saved"] += task.exception().tokens_saved
+    
+    cancel_event.set()
+    cancellation_counts[kind] += 1
+    work.add_done_callback(count_tokens)
+
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: SymptomRequest):
+async def chat(request: SymptomRequest, http_request: Request, response: Response,
+               idempotency_key: Optional[str] = Header(None)):
+    key = idempotency_key or request.client_message_id
+    if not key:
+        return await chat_turn(request, http_request)
+    try:
+        # The turn runs detached from this request and is only cancelled once every
+        # request waiting on it (the original and any retries) has disconnected
+        result, replayed = await chat_replays.run(
+            request.user_id, key, request.message, lambda waiters: chat_turn(request, waiters), http_request
+        )
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if replayed:
+        print(f"Replaying chat response for user {request.user_id} (idempotency key {key})")
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+async def chat_turn(request: SymptomRequest, http_request) -> Any:
+    """Append the user's message, generate the reply and update the session.
+
+    ``http_request`` only needs ``is_disconnected()``; it is the request itself
+    or the idempotency Waiters of every request sharing this turn.
+    """
     try:
         print(f"Received message from user {request.user_id}: {request.message}")
         
-        # Get the user's conversation history
-        conversation = get_user_conversation(request.user_id)
+        # A new message invalidates any diagnosis started for the previous conversation
+        speculative_diagnoses.discard(request.user_id)
         
-        # Add user message to conversation history
-        conversation.append({
-            "role": "user",
-            "content": request.message
-        })
+        with span("session.load", user_id=request.user_id):
+            # Get the user's conversation history
+            conversation = get_user_conversation(request.user_id)
+            
+            # Add user message to conversation history
+            user_message = {
+                "role": "user",
+                "content": request.message
+            }
+            conversation.append(user_message)
+            if COMPACT_DIAGNOSIS_PROMPT:
+                clinical_record_for(request.user_id, conversation)
         
         # Create a temporary copy of the PharmacistAgent with the user's conversation
-        temp_agent = PharmacistAgent()
-        temp_agent.conversation_history = conversation.copy()
+        with span("medical_context.load"):
+            medical_context = await medical_context_for(request.user_id)
+        temp_agent = new_agent(user_id=request.user_id, medical_context=medical_context, greeting_cache=greeting_cache,
+                               transition_templates=transition_templates)
+        # Hand over the session's pre-encoded JSON; only the new message was encoded this turn
+        temp_agent.encoded_history = conversation.encoded()
         
-        # Get response from agent
-        response = temp_agent.get_ai_response()
+        # Get response from agent in a worker thread, aborting it if the client disconnects
+        cancel_event = threading.Event()
+        temp_agent.cancel_event = cancel_event
+        work = asyncio.ensure_future(asyncio.to_thread(profiled(temp_agent.get_ai_response)))
+        if not await finished_before_disconnect(http_request, work):
+            print(f"Client disconnected, cancelling chat completion for user {request.user_id}")
+            cancel_upstream("chat", work, cancel_event)
+            # Drop the unanswered message so a retry doesn't duplicate it; a concurrent
+            # request may have added messages after it, so it isn't necessarily the last one
+            conversation.remove(user_message)
+            return JSONResponse(status_code=499, content={"detail": "Client closed request"})
+        response = work.result()
         print(f"Generated response: {response[:100]}...")
         
-        # Update the user's conversation with the assistant's response
-        # (The get_ai_response method already added the response to temp_agent.conversation_history)
-        conversation.clear()
-        conversation.extend(temp_agent.conversation_history)
+        # The conversation end and on-demand triggers hand over to the diagnosis
+        # (a first message is always answered with a greeting)
+        transition = conversation_transition(request.message) if len(conversation) > 2 else None
+        on_demand = "diagnose me" in request.message.lower() or "need a diagnosis" in request.message.lower()
+        readyForDiagnosis = transition is not None or on_demand
+        if transition is not None and transition_templates is not None:
+            template_replies[transition] += 1
+        elif on_demand:
+            # Add a special response for on-demand diagnosis (the templates already say so)
+            response += "\n\nI'll prepare a preliminary diagnosis based on the information you've shared so far."
         
-        # Check if we should trigger diagnosis
-        readyForDiagnosis = False
+        # Update the user's conversation with the assistant's response as the client sees it,
+        # so the stored session and the client's copy stay identical
+        conversation.append({
+            "role": "assistant",
+            "content": response
+        })
         
-        # Standard conversation end triggers
-        if request.message.lower() == 'no' or "no more" in request.message.lower() or "that's all" in request.message.lower():
-            if "prepare your diagnosis" in response.lower() or "prepare your prescription" in response.lower():
-                readyForDiagnosis = True
+        if conversation_writer is not None:
+            conversation_writer.add_turn(request.user_id, request.message, response)
         
-        # Add explicit on-demand diagnosis triggers
-        if "diagnose me" in request.message.lower() or "need a diagnosis" in request.message.lower():
-            readyForDiagnosis = True
-            # Add a special response for on-demand diagnosis
-            response += "\n\nI'll prepare a preliminary diagnosis based on the information you've shared so far."
+        # Start the diagnosis now so /api/diagnose can return without a second round-trip.
+        # It takes a diagnosis slot like any other diagnosis, and is skipped when none is free
+        # (acquire() doesn't wait once locked() is False); /api/diagnose then runs or sheds it.
+        if readyForDiagnosis and diagnosis_slots.locked():
+            print(f"All diagnosis slots busy, not starting a speculative diagnosis for user {request.user_id}")
+            speculative_diagnoses.skipped += 1
+        elif readyForDiagnosis:
+            diagnosis_history = conversation.to_messages()
+            cancel_event = threading.Event()
+            work = await start_in_diagnosis_slot(
+                profiled(run_diagnosis), diagnosis_history, on_demand, cancel_event, request.user_id, medical_context
+            )
+            speculative_diagnoses.start(request.user_id, diagnosis_history, work, cancel_event)
         
         return {
             "response": response,
             "conversation_id": request.user_id,
-            "readyForDiagnosis": readyForDiagnosis
+            "readyForDiagnosis": readyForDiagnosis,
+            "session_version": conversation.version
         }
+    except TokenBudgetExceeded as e:
+        # Drop the unanswered message so the retry after the budget window doesn't duplicate it
+        conversation.remove(user_message)
+        return budget_exceeded_response(e)
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def diagnosis_response(user_id: str, conversation_history: List[Dict[str, str]], on_demand: bool,
+                             http_request: Optional[Request] = None) -> Dict[str, Any]:
+    """Produce the /api/diagnose response body for a conversation."""
+    # Reuse a diagnosis started in the background when the chat reached the trigger
+    diagnosis = None
+    pending = speculative_diagnoses.take(user_id, conversation_history)
+    if pending is not None:
+        try:
+            with span("diagnosis.speculative_wait"):
+                diagnosis = await asyncio.wait_for(pending, timeout=DIAGNOSIS_DEADLINE_SECONDS)
+            print("Using speculative diagnosis started at the diagnosis trigger")
+        except asyncio.CancelledError:
+            diagnosis = None
+        except asyncio.TimeoutError:
+            if FALLBACK_DIAGNOSIS_ENABLED:
+                return fallback_response(conversation_history, "deadline", await known_allergies(user_id))
+    
+    if diagnosis is None:
+        # Admission control: shed to the local engine rather than queueing behind the upstream
+        if FALLBACK_DIAGNOSIS_ENABLED and diagnosis_slots.locked():
+            return fallback_response(conversation_history, "overloaded", await known_allergies(user_id))
+        with span("medical_context.load"):
+            medical_context = await medical_context_for(user_id)
+        cancel_event = threading.Event()
+        work = await start_in_diagnosis_slot(
+            profiled(run_diagnosis), conversation_history, on_demand, cancel_event, user_id, medical_context
+        )
+        try:
+            finished = await asyncio.wait_for(
+                finished_before_disconnect(http_request, work),
+                timeout=DIAGNOSIS_DEADLINE_SECONDS
+            )
+        except asyncio.TimeoutError:
+            cancel_upstream("diagnose_deadline", work, cancel_event)
+            if not FALLBACK_DIAGNOSIS_ENABLED:
+                raise
+            return fallback_response(conversation_history, "deadline", await known_allergies(user_id))
+        
+        if not finished:
+            if KEEP_DIAGNOSIS_ON_DISCONNECT:
+                print(f"Client disconnected, keeping diagnosis for user {user_id}")
+                speculative_diagnoses.put(user_id, conversation_history, work, cancel_event)
+                cancellation_counts["diagnoses_kept"] += 1
+            else:
+                print(f"Client disconnected, cancelling diagnosis for user {user_id}")
+                cancel_upstream("diagnose", work, cancel_event)
+            raise RequestCancelled()
+        diagnosis = work.result()
+    
+    allergies = await known_allergies(user_id) if "error" in diagnosis else []
+    return finish_diagnosis(diagnosis, conversation_history, allergies)
+
+def finish_diagnosis(diagnosis: Dict[str, Any], conversation_history: List[Dict[str, str]],
+                     allergies: List[str] = ()) -> Dict[str, Any]:
+    """Turn a generated diagnosis into the /api/diagnose response body, falling back on errors.
+
+    ``allergies`` from the patient's record are passed on to the fallback engine.
+    """
+    # If the diagnosis generation failed for any reason, provide a fallback
+    if "error" in diagnosis:
+        print(f"Diagnosis generation error: {diagnosis.get('error')}")
+        if FALLBACK_DIAGNOSIS_ENABLED:
+            # run_diagnosis already tried to repair the reply; a raw_response means the model
+            # answered but neither parse could recover a diagnosis from it
+            reason = "parse_error" if "raw_response" in diagnosis else "upstream_error"
+            return fallback_response(conversation_history, reason, allergies)
+        return {
+            "response": "I've prepared a preliminary assessment based on the limited information available.",
+            "diagnosis": {
+                "diagnosis": "Unable to provide a comprehensive diagnosis with the information provided. Please share more details about your symptoms for a more accurate assessment.",
+                "prescriptions": [],
+                "follow_up_recommendations": "Please provide more symptom information for a more accurate assessment."
+            },
+            "checkout_ready": False,
+            "error": diagnosis.get('error')
+        }
+    
+    with span("diagnosis.normalize"):
+        final_diagnosis = normalize_diagnosis(diagnosis)
+    
+    return {
+        "response": "Here's your diagnosis and prescription. I'm passing this to the system to prepare your checkout.",
+        "diagnosis": final_diagnosis,
+        "checkout_ready": True
+    }
+
+def sync_session(request: ConversationRequest):
+    """Reconcile the stored session with a diagnose request.
+
+    Returns (messages, version): the conversation to diagnose and the session
+    version. messages is None when the client's session_version doesn't match,
+    in which case it must resend the full conversation with that version.
+    """
+    conversation = get_user_conversation(request.user_id)
+    
+    if request.conversation:
+        incoming = [{"role": msg.role, "content": msg.content} for msg in request.conversation]
+        if incoming == [msg for msg in conversation if msg["role"] != "system"]:
+            return conversation.to_messages(), conversation.version
+        if request.session_version is None:
+            # Legacy request: diagnose what was sent (e.g. a history the client truncated)
+            # without touching the stored session
+            return [shared_agent.conversation_history[0]] + incoming, conversation.version
+        # Resync after a 409: the client's copy replaces the stored turns
+        conversation.clear()
+        conversation.append(shared_agent.conversation_history[0])
+        conversation.extend(incoming)
+    elif request.new_messages:
+        if request.session_version != conversation.version:
+            return None, conversation.version
+        conversation.extend({"role": msg.role, "content": msg.content} for msg in request.new_messages)
+    elif request.session_version is not None and request.session_version != conversation.version:
+        return None, conversation.version
+    
+    return conversation.to_messages(), conversation.version
+
+def record_diagnosis(user_id: str, conversation_history: List[Dict[str, str]], result: Dict[str, Any]):
+    """Keep the latest diagnosis for the export and queue it for the database."""
+    with span("diagnosis.record"):
+        user_diagnoses[user_id] = dict(result["diagnosis"], diagnosed_at=time.time())
+        if conversation_writer is not None:
+            last_user_message = next((m["content"] for m in reversed(conversation_history) if m["role"] == "user"), "")
+            conversation_writer.add_diagnosis(user_id, last_user_message, result["response"], result["diagnosis"])
+
 @app.post("/api/diagnose", response_model=DiagnosisResponse)
-async def diagnose(request: ConversationRequest):
+async def diagnose(request: ConversationRequest, http_request: Request):
     try:
         print(f"Generating diagnosis for user {request.user_id}")
         
@@ -131,138 +773,23 @@ async def diagnose(request: ConversationRequest):
         else:
             print("Generating standard end-of-conversation diagnosis")
         
-        # Convert the conversation history from the request to the format expected by PharmacistAgent
-        conversation_history = [
-            {"role": msg.role, "content": msg.content}
-            for msg in request.conversation
-        ]
-        
-        # If no conversation history in the request, try to use the stored history
-        if not conversation_history and request.user_id in user_conversations:
-            conversation_history = user_conversations[request.user_id]
-            
-        # Process the user's conversation history and generate a diagnosis
-        # Use a fresh agent to avoid any state conflicts
-        diagnosis_agent = PharmacistAgent()
-        
-        # Add enhanced error handling
-        try:
-            diagnosis = diagnosis_agent.generate_diagnosis(
-                conversation_history=conversation_history, 
-                on_demand=bool(request.on_demand)
-            )
-            
-            # Log the diagnosis format for debugging
-            print(f"Generated diagnosis: {diagnosis}")
-            
-            # If we get a raw_response, try to parse it
-            if "raw_response" in diagnosis:
-                try:
-                    import re
-                    import json
-                    
-                    raw_response = diagnosis["raw_response"]
-                    print(f"Attempting to parse raw response: {raw_response[:200]}...")
-                    
-                    # Try to extract JSON using regex
-                    json_match = re.search(r'```(?:json)?(.*?)```|(\{.*\})', raw_response, re.DOTALL)
-                    
-                    if json_match:
-                        # Get the matched content
-                        json_str = json_match.group(1) if json_match.group(1) else json_match.group(2)
-                        json_str = json_str.strip()
-                        
-                        # Clean up JSON
-                        json_str = re.sub(r',(\s*[\]}])', r'\1', json_str)  # Fix trailing commas
-                        json_str = re.sub(r'(\{|\,)\s*([a-zA-Z0-9_]+)\s*:', r'\1"\2":', json_str)  # Fix unquoted keys
-                        
-                        # Parse JSON
-                        parsed_diagnosis = json.loads(json_str)
-                        
-                        print(f"Successfully parsed raw JSON response: {parsed_diagnosis}")
-                        diagnosis = parsed_diagnosis
-                        
-                except Exception as json_err:
-                    print(f"Failed to parse raw response: {str(json_err)}")
-            
-        except Exception as diag_err:
-            print(f"Error in diagnosis generation: {str(diag_err)}")
-            diagnosis = {
-                "error": f"Error generating diagnosis: {str(diag_err)}",
-                "diagnosis": "Unable to generate diagnosis due to a system error",
-                "prescriptions": [],
-                "follow_up_recommendations": "Please try again later"
-            }
-        
-        # If the diagnosis generation failed for any reason, provide a fallback
-        if "error" in diagnosis:
-            print(f"Diagnosis generation error: {diagnosis.get('error')}")
-            return {
-                "response": "I've prepared a preliminary assessment based on the limited information available.",
-                "diagnosis": {
-                    "diagnosis": "Unable to provide a comprehensive diagnosis with the information provided. Please share more details about your symptoms for a more accurate assessment.",
-                    "prescriptions": [],
-                    "follow_up_recommendations": "Please provide more symptom information for a more accurate assessment."
-                },
-                "checkout_ready": False,
-                "error": diagnosis.get('error')
-            }
-        
-        # Prepare the response - ensure it uses the new format
-        # Convert old format to new format if needed
-        prescriptions = []
-        if "prescriptions" in diagnosis:
-            prescriptions = diagnosis.get("prescriptions", [])
-        elif "prescription" in diagnosis:
-            # Convert old format to new format
-            old_prescriptions = diagnosis.get("prescription", [])
-            if isinstance(old_prescriptions, list):
-                for rx in old_prescriptions:
-                    if isinstance(rx, dict):
-                        new_rx = {
-                            "drug_name": rx.get("drug", "Unknown medication"),
-                            "dosage": rx.get("dosage", "As directed"),
-                            "form": "tablet",  # Default form
-                            "duration": rx.get("duration", "As needed"),
-                            "instructions": "Take as directed by healthcare provider"
-                        }
-                        prescriptions.append(new_rx)
-        
-        # Ensure each prescription has all required fields
-        for rx in prescriptions:
-            if not isinstance(rx, dict):
-                continue
-                
-            # Ensure all required fields exist
-            if "drug_name" not in rx and "drug" in rx:
-                rx["drug_name"] = rx["drug"]
-                del rx["drug"]
-            elif "drug_name" not in rx:
-                rx["drug_name"] = "Unknown medication"
-                
-            if "dosage" not in rx:
-                rx["dosage"] = "As directed"
-            if "form" not in rx:
-                rx["form"] = "tablet"
-            if "duration" not in rx:
-                rx["duration"] = "As needed"
-            if "instructions" not in rx:
-                rx["instructions"] = "Take as directed by healthcare provider"
-                
-        # Ensure follow_up_recommendations field exists
-        follow_up = diagnosis.get("follow_up_recommendations", "None")
+        # Bring the stored session up to date with what the client sent
+        with span("session.sync", user_id=request.user_id):
+            conversation_history, session_version = sync_session(request)
+        if conversation_history is None:
+            return JSONResponse(status_code=409, content={
+                "error": "Session version mismatch, resend the full conversation",
+                "session_version": session_version
+            })
         
-        final_diagnosis = {
-            "diagnosis": diagnosis.get("diagnosis", "Unable to determine diagnosis"),
-            "prescriptions": prescriptions,
-            "follow_up_recommendations": follow_up
-        }
-        
-        return {
-            "response": "Here's your diagnosis and prescription. I'm passing this to the system to prepare your checkout.",
-            "diagnosis": final_diagnosis,
-            "checkout_ready": True
-        }
+        result = await diagnosis_response(request.user_id, conversation_history, bool(request.on_demand), http_request)
+        result["session_version"] = session_version
+        record_diagnosis(request.user_id, conversation_history, result)
+        return result
+    except RequestCancelled:
+        return JSONResponse(status_code=499, content={"detail": "Client closed request"})
+    except TokenBudgetExceeded as e:
+        return budget_exceeded_response(e)
     except Exception as e:
         print(f"Error in diagnose endpoint: {str(e)}")
         return {
@@ -276,19 +803,530 @@ async def diagnose(request: ConversationRequest):
             "error": str(e)
         }
 
+async def stream_diagnosis(user_id: str, conversation_history: List[Dict[str, str]], on_demand: bool, session_version: int):
+    """Generate a diagnosis as server-sent events, emitting fields as soon as the model completes them."""
+    try:
+        streamed = False
+        if speculative_diagnoses.has(user_id, conversation_history) or (FALLBACK_DIAGNOSIS_ENABLED and diagnosis_slots.locked()):
+            # Already generated in the background, or shed to the fallback engine: nothing left to stream
+            result = await diagnosis_response(user_id, conversation_history, on_demand)
+        else:
+            streamed = True
+            loop = asyncio.get_running_loop()
+            deltas: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+            parser = IncrementalDiagnosisParser()
+            medical_context = await medical_context_for(user_id)
+            cancel_event = threading.Event()
+            work = await start_in_diagnosis_slot(
+                profiled(run_diagnosis), conversation_history, on_demand, cancel_event, user_id, medical_context,
+                lambda text: loop.call_soon_threadsafe(deltas.put_nowait, text)
+            )
+            # Queued after the last delta, since both are scheduled on the loop in order
+            work.add_done_callback(lambda _: deltas.put_nowait(None))
+            deadline = loop.time() + DIAGNOSIS_DEADLINE_SECONDS
+            try:
+                while True:
+                    text = await asyncio.wait_for(deltas.get(), timeout=max(deadline - loop.time(), 0))
+                    if text is None:
+                        break
+                    for event, data in parser.feed(text):
+                        if event == "prescription":
+                            try:
+                                data = PrescriptionItem(**normalize_prescription(data)).model_dump()
+                            except ValueError:
+                                continue
+                        yield sse_event(event, data)
+                diagnosis = work.result()
+                allergies = await known_allergies(user_id) if "error" in diagnosis else []
+                result = finish_diagnosis(diagnosis, conversation_history, allergies)
+            except asyncio.TimeoutError:
+                cancel_upstream("diagnose_deadline", work, cancel_event)
+                if not FALLBACK_DIAGNOSIS_ENABLED:
+                    raise
+                result = fallback_response(conversation_history, "deadline", await known_allergies(user_id))
+            finally:
+                # The generator is closed early when the client disconnects
+                if not work.done() and not cancel_event.is_set():
+                    print(f"Client disconnected, cancelling streamed diagnosis for user {user_id}")
+                    cancel_upstream("diagnose", work, cancel_event)
+        
+        result["session_version"] = session_version
+        record_diagnosis(user_id, conversation_history, result)
+        final = DiagnosisResponse(**result).model_dump()
+        if not streamed:
+            yield sse_event("diagnosis", final["diagnosis"]["diagnosis"])
+            for rx in final["diagnosis"]["prescriptions"]:
+                yield sse_event("prescription", rx)
+        yield sse_event("final", final)
+    except TokenBudgetExceeded as e:
+        print(f"Rejecting request: {str(e)}")
+        yield sse_event("error", {"detail": "Token budget exceeded, please try again later", "retry_after": round(e.retry_after)})
+    except asyncio.TimeoutError:
+        yield sse_event("error", {"detail": "Diagnosis timed out"})
+    except Exception as e:
+        print(f"Error in streamed diagnosis: {str(e)}")
+        yield sse_event("error", {"detail": str(e)})
+
+# Streaming variant of /api/diagnose for clients that want to act on prescriptions before
+# generation finishes (e.g. start inventory lookups). Events: "diagnosis" with the diagnosis
+# text, one "prescription" per completed PrescriptionItem, then "final" with the full
+# DiagnosisResponse, which is authoritative (the reply may have needed repair, or the fallback
+# engine may have answered), or "error".
+@app.post("/api/diagnose/stream")
+async def diagnose_stream(request: ConversationRequest):
+    print(f"Streaming diagnosis for user {request.user_id}")
+    conversation_history, session_version = sync_session(request)
+    if conversation_history is None:
+        return JSONResponse(status_code=409, content={
+            "error": "Session version mismatch, resend the full conversation",
+            "session_version": session_version
+        })
+    return StreamingResponse(
+        stream_diagnosis(request.user_id, conversation_history, bool(request.on_demand), session_version),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def run_diagnosis_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Generate the diagnosis for a submitted job; the result is the /api/diagnose response body."""
+    # Continues the submitting request's trace when that one was sampled
+    with tracer.start("diagnosis.job", payload.get("traceparent"), user_id=payload["user_id"]):
+        result = await diagnosis_response(payload["user_id"], payload["conversation_history"], payload["on_demand"])
+        result["session_version"] = payload["session_version"]
+        record_diagnosis(payload["user_id"], payload["conversation_history"], result)
+        return DiagnosisResponse(**result).model_dump()
+
+# Diagnoses as jobs: submit returns at once and the client polls or subscribes, so no
+# connection (or serverless invocation) is held open while the completion is generated.
+# Keep DIAGNOSIS_JOB_WORKERS below DIAGNOSIS_MAX_CONCURRENCY so queued jobs don't push
+# interactive /api/diagnose requests onto the fallback engine.
+diagnosis_jobs = DiagnosisJobQueue(
+    InMemoryJobStore(
+        max_jobs=int(os.getenv("DIAGNOSIS_JOB_MAX_JOBS", "10000")),
+        ttl=float(os.getenv("DIAGNOSIS_JOB_TTL", "900")),
+    ),
+    run_diagnosis_job,
+    workers=int(os.getenv("DIAGNOSIS_JOB_WORKERS", "4")),
+    max_queued=int(os.getenv("DIAGNOSIS_JOB_MAX_QUEUED", "1000")),
+)
+# Longest a poll may wait for completion, and the keep-alive interval of job event streams
+DIAGNOSIS_JOB_MAX_WAIT = 30
+DIAGNOSIS_JOB_KEEPALIVE_SECONDS = 15
+
+@app.post("/api/diagnose/jobs", status_code=202, response_model=DiagnosisJob)
+async def submit_diagnosis_job(request: ConversationRequest, response: Response):
+    print(f"Queueing diagnosis job for user {request.user_id}")
+    with span("session.sync", user_id=request.user_id):
+        conversation_history, session_version = sync_session(request)
+    if conversation_history is None:
+        return JSONResponse(status_code=409, content={
+            "error": "Session version mismatch, resend the full conversation",
+            "session_version": session_version
+        })
+    try:
+        job = diagnosis_jobs.submit({
+            "user_id": request.user_id,
+            "conversation_history": conversation_history,
+            "on_demand": bool(request.on_demand),
+            "session_version": session_version,
+            "traceparent": current_traceparent(),
+        })
+    except QueueFull as e:
+        print(f"Rejecting diagnosis job: {str(e)}")
+        return JSONResponse(status_code=503, content={"detail": "Too many diagnoses queued, please try again later"},
+                            headers={"Retry-After": "5"})
+    response.headers["Location"] = f"/api/diagnose/jobs/{job['job_id']}"
+    return job
+
+# Poll a job; with ?wait=N (seconds) the request returns as soon as the job finishes
+@app.get("/api/diagnose/jobs/{job_id}", response_model=DiagnosisJob)
+async def get_diagnosis_job(job_id: str, wait: float = 0):
+    job = await diagnosis_jobs.wait(job_id, min(max(wait, 0), DIAGNOSIS_JOB_MAX_WAIT))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired diagnosis job")
+    return job
+
+async def diagnosis_job_events(job_id: str):
+    """Yield the job's status, keep-alive comments while it runs, then "final" or "error"."""
+    job = diagnosis_jobs.store.get(job_id)
+    if job is not None:
+        yield sse_event("status", {"job_id": job_id, "status": job["status"]})
+    while job is not None and job["status"] not in FINISHED:
+        job = await diagnosis_jobs.wait(job_id, DIAGNOSIS_JOB_KEEPALIVE_SECONDS)
+        if job is not None and job["status"] not in FINISHED:
+            yield b": keep-alive\n\n"
+    if job is None:
+        yield sse_event("error", {"detail": "Diagnosis job expired"})
+    elif job["status"] == "failed":
+        yield sse_event("error", {"detail": job["error"]})
+    else:
+        yield sse_event("final", job["result"])
+
+# Subscribe to a job as server-sent events instead of polling
+@app.get("/api/diagnose/jobs/{job_id}/events")
+async def diagnosis_job_event_stream(job_id: str):
+    if diagnosis_jobs.store.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired diagnosis job")
+    return StreamingResponse(
+        diagnosis_job_events(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Changes on every restart, since versions of sessions restored from a snapshot start over
+SERVER_INSTANCE_ID = secrets.token_hex(4)
+
+def conversation_etag(conversation: CompactSession, limit: int, before: Optional[str]) -> str:
+    """Strong ETag for one page of a session's history; versions only increase, even across a clear."""
+    return f'"{SERVER_INSTANCE_ID}-{conversation.version}-{limit}-{before or ""}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # If-None-Match uses the weak comparison, so W/-prefixed copies of the tag match too
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+# Read a session's history, newest page first, so reloads and polling clients don't need
+# their own copy. Send the ETag back in If-None-Match to get a 304 while nothing changed.
+@app.get("/api/conversation/{user_id}", response_model=ConversationPage)
+async def read_conversation(user_id: str, response: Response, limit: int = Query(50, ge=1, le=200),
+                            before: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
+    conversation = find_user_conversation(user_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail=f"No conversation history found for user {user_id}")
+    etag = conversation_etag(conversation, limit, before)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    total = len(conversation)
+    end = total
+    if before is not None:
+        if not before.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        end = min(int(before), total)
+    # The leading system prompt is the agent's, not part of the conversation
+    first = 1 if total and conversation[0]["role"] == "system" else 0
+    start = max(end - limit, first)
+    messages = [
+        dict(message, index=index)
+        for index, message in enumerate(conversation[start:end] if start < end else [], start)
+        if message["role"] != "system"
+    ]
+    response.headers.update(headers)
+    return {
+        "user_id": user_id,
+        "session_version": conversation.version,
+        "total": total - first,
+        "messages": messages,
+        "next_cursor": str(start) if start > first else None,
+    }
+
 # Add a utility endpoint to clear a user's conversation history (useful for testing)
 @app.delete("/api/conversation/{user_id}")
 async def clear_conversation(user_id: str):
-    if user_id in user_conversations:
-        # Reset to just the system message
-        user_conversations[user_id] = [shared_agent.conversation_history[0].copy()]
+    speculative_diagnoses.discard(user_id)
+    user_diagnoses.pop(user_id, None)
+    with symptom_records_lock:
+        symptom_records.pop(user_id, None)
+    conversation = find_user_conversation(user_id)
+    if conversation is not None:
+        # Reset to just the system message, keeping the version increasing for synced clients
+        conversation.clear()
+        conversation.append(shared_agent.conversation_history[0])
         return {"message": f"Conversation history cleared for user {user_id}"}
     return {"message": f"No conversation history found for user {user_id}"}
 
+# Called by the app after it writes a user's medical history or prescriptions
+# (with the same user_id it sends to /api/chat, since blocks are cached under that id)
+@app.post("/api/admin/medical-context/{user_id}/invalidate", dependencies=[Depends(require_admin)])
+async def invalidate_medical_context(user_id: str):
+    if medical_contexts is not None:
+        medical_contexts.invalidate(user_id)
+    return {"message": f"Medical context invalidated for user {user_id}"}
+
+def iter_all_sessions():
+    """Yield (user_id, messages) for every live session and every restored session not loaded yet."""
+    # Only the ids are copied up front; each session is decoded when the consumer reaches it
+    live_ids = list(user_conversations)
+    for user_id in live_ids:
+        conversation = user_conversations.get(user_id)
+        if conversation is not None:
+            yield user_id, conversation.to_messages()
+    if restored_sessions is not None:
+        live = set(live_ids)
+        for user_id, messages in restored_sessions.items():
+            if user_id not in live:
+                yield user_id, messages
+
+# Sessions and latest diagnoses for analytics. The generators run on Starlette's thread pool
+# one chunk at a time, so large exports neither buffer in memory nor block request handling.
+@app.get("/api/admin/export", dependencies=[Depends(require_admin)])
+async def export_sessions(format: str = "ndjson", include_messages: bool = False, row_group_size: int = 10000):
+    records = iter_records(iter_all_sessions(), user_diagnoses, include_messages)
+    if format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Parquet export needs pyarrow installed")
+        return StreamingResponse(
+            iter_parquet(records, row_group_size),
+            media_type="application/vnd.apache.parquet",
+            headers={"Content-Disposition": "attachment; filename=sessions.parquet"}
+        )
+    if format != "ndjson":
+        raise HTTPException(status_code=400, detail="format must be ndjson or parquet")
+    return StreamingResponse(iter_ndjson(records), media_type="application/x-ndjson")
+
+# Sessions copied per event-loop iteration while taking a snapshot
+SNAPSHOT_COPY_CHUNK = 1000
+
+async def snapshot_sessions() -> int:
+    """Write every live and not-yet-restored session to the snapshot file."""
+    # Copy roles and contents on the loop so request handlers can keep mutating the live
+    # sessions, a chunk at a time so requests aren't held up; the message dicts are only
+    # built on the writer's thread
+    sessions = list(user_conversations.items())
+    live = []
+    for start in range(0, len(sessions), SNAPSHOT_COPY_CHUNK):
+        live.extend((user_id, messages.snapshot()) for user_id, messages in sessions[start:start + SNAPSHOT_COPY_CHUNK])
+        await asyncio.sleep(0)
+    live_ids = {user_id for user_id, _ in live}
+    previous = restored_sessions
+
+    def all_sessions():
+        for user_id, (roles, contents) in live:
+            yield user_id, messages_from_snapshot(roles, contents)
+        if previous is not None:
+            for user_id, messages in previous.items():
+                if user_id not in live_ids:
+                    yield user_id, messages
+
+    return await asyncio.to_thread(
+        write_snapshot, SESSION_SNAPSHOT_PATH, all_sessions(), shared_agent.conversation_history[0]["content"]
+    )
+
+async def periodic_snapshots():
+    while True:
+        await asyncio.sleep(SESSION_SNAPSHOT_INTERVAL)
+        try:
+            count = await snapshot_sessions()
+            print(f"Snapshotted {count} sessions to {SESSION_SNAPSHOT_PATH}")
+        except Exception as e:
+            print(f"Session snapshot failed: {str(e)}")
+
+@app.on_event("startup")
+async def start_session_snapshots():
+    if SESSION_SNAPSHOT_PATH:
+        app.state.snapshot_task = asyncio.create_task(periodic_snapshots())
+
+async def periodic_usage_flush():
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(usage_tracker.flush)
+        except Exception as e:
+            print(f"Usage flush failed: {str(e)}")
+
+@app.on_event("startup")
+async def start_usage_flush():
+    if usage_tracker.sink_path:
+        app.state.usage_flush_task = asyncio.create_task(periodic_usage_flush())
+
+@app.on_event("shutdown")
+async def flush_usage():
+    if usage_tracker.sink_path:
+        app.state.usage_flush_task.cancel()
+        usage_tracker.flush()
+
+@app.on_event("startup")
+async def start_conversation_writer():
+    if conversation_writer is not None:
+        app.state.conversation_writer_task = asyncio.create_task(conversation_writer.run())
+
+@app.on_event("shutdown")
+async def close_database_pool():
+    if conversation_writer is not None:
+        app.state.conversation_writer_task.cancel()
+        flushed = conversation_writer.flush()
+        print(f"Flushed {flushed} queued conversation records on shutdown")
+    if database_pool is not None:
+        database_pool.closeall()
+
+@app.on_event("startup")
+async def start_diagnosis_jobs():
+    diagnosis_jobs.start()
+
+@app.on_event("shutdown")
+async def stop_diagnosis_jobs():
+    diagnosis_jobs.stop()
+
+@app.on_event("shutdown")
+async def stop_diagnosis_threads():
+    # Diagnoses still running were abandoned by their requests; don't start queued ones
+    diagnosis_executor.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+async def save_session_snapshot():
+    if not SESSION_SNAPSHOT_PATH:
+        return
+    app.state.snapshot_task.cancel()
+    count = await snapshot_sessions()
+    print(f"Saved {count} sessions to {SESSION_SNAPSHOT_PATH} on shutdown")
+
+# The upstream check is repeated every UPSTREAM_RETRY_INTERVAL seconds while it fails, so a brief
+# outage at startup doesn't keep the instance unready, and every UPSTREAM_CHECK_INTERVAL seconds
+# once it passes (0 stops checking after the first success).
+UPSTREAM_CHECK_INTERVAL = float(os.getenv("UPSTREAM_CHECK_INTERVAL", "300"))
+UPSTREAM_RETRY_INTERVAL = float(os.getenv("UPSTREAM_RETRY_INTERVAL", "15"))
+
+async def check_upstream():
+    result = await asyncio.to_thread(shared_agent.validate_connection)
+    upstream_status.update(result)
+    upstream_status["checked_at"] = time.time()
+
+async def periodic_upstream_checks():
+    started = time.perf_counter()
+    while True:
+        try:
+            await check_upstream()
+        except Exception as e:
+            print(f"Upstream check failed: {str(e)}")
+        if STARTUP_PROFILE and started is not None:
+            print(f"[startup] upstream check took {time.perf_counter() - started:.2f}s")
+            started = None
+        interval = UPSTREAM_CHECK_INTERVAL if upstream_status["ok"] else max(UPSTREAM_RETRY_INTERVAL, 1)
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+
+@app.on_event("startup")
+async def start_upstream_check():
+    app.state.upstream_check = asyncio.create_task(periodic_upstream_checks())
+
+@app.on_event("shutdown")
+async def stop_upstream_checks():
+    app.state.upstream_check.cancel()
+
+# Liveness: answers as soon as the process is serving, never touches the upstream
 @app.get("/api/health")
 async def health_check():
     return {"status": "ok", "agent": "PharmaAI Assistant", "model": shared_agent.model}
 
+# Readiness: reports the cached result of the periodic background upstream check
+@app.get("/api/ready")
+async def readiness_check():
+    body = {"ready": bool(upstream_status["ok"]), "model": shared_agent.model, "upstream": upstream_status}
+    return JSONResponse(status_code=200 if body["ready"] else 503, content=body)
+
+@app.get("/api/admin/usage", dependencies=[Depends(require_admin)])
+async def token_usage(limit: int = 10):
+    return {
+        "by_call_type": usage_tracker.by_call_type(),
+        "top_consumers": usage_tracker.top_consumers(limit),
+        "user_token_budget": usage_tracker.user_token_budget or None
+    }
+
+# Sampling profiler: samples every thread's stack for a few seconds and returns collapsed
+# stacks (flamegraph.pl / speedscope input). Nothing runs between calls.
+profiler_busy = asyncio.Lock()
+
+@app.get("/api/admin/profile", dependencies=[Depends(require_admin)], response_class=PlainTextResponse)
+async def sampling_profile(seconds: float = 10, interval_ms: float = 5):
+    if profiler_busy.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    async with profiler_busy:
+        counts = await asyncio.to_thread(sample_stacks, min(max(seconds, 0.1), 120), max(interval_ms, 1) / 1000)
+    return collapsed_text(counts)
+
+@app.get("/api/admin/profiles", dependencies=[Depends(require_admin)])
+async def list_request_profiles():
+    return {"profiles": profile_store.ids()}
+
+@app.get("/api/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)], response_class=PlainTextResponse)
+async def get_request_profile(profile_id: str):
+    stats = profile_store.get(profile_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return stats
+
+# Memory accounting: approximate bytes per component, the largest sessions and, with
+# tracemalloc=true, the allocations that grew since the previous tracemalloc call
+memory_diff = TracemallocDiff()
+
+def session_sizes() -> List[Dict[str, Any]]:
+    return [
+        {"user_id": user_id, "bytes": sys.getsizeof(user_id) + session.nbytes(), "messages": len(session)}
+        for user_id, session in list(user_conversations.items())
+    ]
+
+@app.get("/api/admin/memory", dependencies=[Depends(require_admin)])
+async def memory_report(top: int = Query(10, ge=0, le=1000), tracemalloc: bool = False,
+                        tracemalloc_limit: int = Query(20, ge=1, le=200)):
+    sessions = session_sizes()
+    with symptom_records_lock:
+        symptom_bytes = deep_sizeof(symptom_records)
+    components = {
+        # The system prompt is shared by every session and counted once
+        "sessions": sum(entry["bytes"] for entry in sessions) + sys.getsizeof(user_conversations)
+                    + sys.getsizeof(shared_agent.conversation_history[0]["content"]),
+        "diagnoses": deep_sizeof(user_diagnoses),
+        "symptom_records": symptom_bytes,
+        "greeting_cache": greeting_cache.nbytes() if greeting_cache else None,
+        "medical_context": medical_contexts.nbytes() if medical_contexts else None,
+        "idempotency": chat_replays.nbytes(),
+        "diagnosis_jobs": diagnosis_jobs.store.nbytes(),
+        "queued_diagnosis_jobs": diagnosis_jobs.queued_nbytes(),
+        "conversation_writer": conversation_writer.nbytes() if conversation_writer else None,
+        "usage_tracker": usage_tracker.nbytes(),
+        "max_tokens_caps": token_caps.nbytes() if token_caps else None,
+        "request_profiles": profile_store.nbytes(),
+    }
+    report = {
+        "process": process_memory(),
+        "components": components,
+        "accounted_bytes": sum(size for size in components.values() if size),
+        "session_count": len(sessions),
+        "session_messages": sum(entry["messages"] for entry in sessions),
+        "session_snapshot_mapped_bytes": restored_sessions.mapped_bytes() if restored_sessions is not None else None,
+        "in_flight": dict(
+            inflight_requests.stats(),
+            idempotent_calls=chat_replays.stats()["in_flight"],
+            speculative_diagnoses=speculative_diagnoses.stats()["pending"],
+            queued_diagnosis_jobs=diagnosis_jobs.stats()["queued"],
+        ),
+        "top_sessions": heapq.nlargest(top, sessions, key=lambda entry: entry["bytes"]),
+        "tracemalloc": None,
+    }
+    if tracemalloc:
+        report["tracemalloc"] = await asyncio.to_thread(memory_diff.diff, tracemalloc_limit)
+    return report
+
+@app.delete("/api/admin/memory/tracemalloc", dependencies=[Depends(require_admin)])
+async def stop_memory_tracing():
+    return {"stopped": memory_diff.stop()}
+
+@app.get("/api/metrics")
+async def metrics():
+    return {
+        "greeting_cache": greeting_cache.stats() if greeting_cache else None,
+        "speculative_diagnoses": speculative_diagnoses.stats(),
+        "idempotency": chat_replays.stats(),
+        "diagnosis_jobs": diagnosis_jobs.stats(),
+        "fallback_diagnoses": dict(fallback_counts),
+        "template_replies": dict(template_replies) if transition_templates is not None else None,
+        "tracing": tracer.stats(),
+        "cancellations": dict(cancellation_counts),
+        "max_tokens_caps": token_caps.stats(DEFAULT_MAX_TOKENS) if token_caps else None,
+        "medical_context": medical_contexts.stats() if medical_contexts else None,
+        "conversation_writer": conversation_writer.stats() if conversation_writer else None
+    }
+
+if STARTUP_PROFILE:
+    print(f"[startup] api_server imported in {time.perf_counter() - _import_started:.3f}s")
+
 if __name__ == "__main__":
+    import uvicorn
     print(f"Starting PharmaAI Assistant API with model: {shared_agent.model}")
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
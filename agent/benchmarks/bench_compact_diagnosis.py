@@ -0,0 +1,130 @@
+"""Compare full-transcript and compact (symptom record + recent turns) diagnosis prompts.
+
+Usage:
+    python benchmarks/bench_compact_diagnosis.py                      # synthetic sessions
+    python benchmarks/bench_compact_diagnosis.py --snapshot sessions.bin [--limit 500]
+
+``--snapshot`` replays sessions recorded by the API server (SESSION_SNAPSHOT_PATH).
+Prompts are captured from PharmacistAgent.generate_diagnosis with a StubClient,
+so they are exactly what would be sent upstream. Tokens are counted with
+tiktoken's cl100k_base when available, otherwise estimated at ~4 characters
+per token. Extraction time is the incremental SymptomRecord.sync cost per
+user message; prompt time is the agent's local work per diagnosis call
+(summary, prompt assembly, parsing the stub reply) with the record already
+synced, as on the server; rebuild is the from-scratch extraction cost.
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+from pharma_agent import PharmacistAgent  # noqa: E402
+from symptom_record import SymptomRecord  # noqa: E402
+from synthetic import StubClient, make_conversation, make_raw_output  # noqa: E402
+
+RECENT_MESSAGES = 6
+
+
+def token_counter():
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text)), "cl100k_base"
+    except Exception:
+        return lambda text: len(text) // 4, "~4 chars/token"
+
+
+def load_sessions(args, system_prompt):
+    if args.snapshot:
+        from session_snapshot import SnapshotReader
+        reader = SnapshotReader(args.snapshot)
+        sessions = []
+        for _, messages in reader.items():
+            if sum(1 for msg in messages if msg["role"] == "user") >= 2:
+                sessions.append((f"{len(messages)} msgs", messages))
+            if len(sessions) >= args.limit:
+                break
+        return sessions
+    return [(f"{turns} turns", make_conversation(turns, system_prompt=system_prompt, seed=turns))
+            for turns in (3, 8, 15, 30, 60)]
+
+
+def diagnosis_prompt(agent, messages, record=None):
+    """Return (prompt messages, seconds) for one diagnosis call"""
+    agent.clinical_record = None
+    agent.recent_messages = RECENT_MESSAGES
+    started = time.perf_counter()
+    if record is not None:
+        # The server keeps the record synced turn by turn, so only the summary is built here
+        agent.clinical_record = record.summary()
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent.generate_diagnosis(conversation_history=messages)
+    return agent.client.last_request["messages"], time.perf_counter() - started
+
+
+def rebuild_ms(messages):
+    """Cost of building a record from scratch, e.g. after a restart"""
+    started = time.perf_counter()
+    SymptomRecord().sync(messages)
+    return (time.perf_counter() - started) * 1e3
+
+
+def incremental_extraction_us(messages):
+    """Average cost of syncing a record after each new user message"""
+    record = SymptomRecord()
+    timings = []
+    for end in range(1, len(messages) + 1):
+        if messages[end - 1]["role"] != "user":
+            continue
+        started = time.perf_counter()
+        record.sync(messages[:end])
+        timings.append(time.perf_counter() - started)
+    return statistics.mean(timings) * 1e6 if timings else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--snapshot", help="Session snapshot written by the API server")
+    parser.add_argument("--limit", type=int, default=500, help="Sessions to replay from the snapshot")
+    args = parser.parse_args()
+
+    count_tokens, tokenizer = token_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent = PharmacistAgent(validate=False)
+    agent.client = StubClient(make_raw_output(800))
+    sessions = load_sessions(args, agent.conversation_history[0]["content"])
+
+    print(f"tokens: {tokenizer}, recent messages kept: {RECENT_MESSAGES}")
+    print(f"{'session':>10} {'full tok':>9} {'compact tok':>12} {'saved':>6} {'full ms':>8} {'compact ms':>11} "
+          f"{'rebuild ms':>11} {'extract us/msg':>15}")
+    totals = [0, 0]
+    for name, messages in sessions:
+        record = SymptomRecord()
+        record.sync(messages)
+        full, full_time = diagnosis_prompt(agent, messages)
+        compact, compact_time = diagnosis_prompt(agent, messages, record)
+        full_tokens = sum(count_tokens(msg["content"]) for msg in full)
+        compact_tokens = sum(count_tokens(msg["content"]) for msg in compact)
+        totals[0] += full_tokens
+        totals[1] += compact_tokens
+        if not args.snapshot:
+            print(f"{name:>10} {full_tokens:>9} {compact_tokens:>12} {1 - compact_tokens / full_tokens:>6.0%} "
+                  f"{full_time * 1e3:>8.2f} {compact_time * 1e3:>11.2f} {rebuild_ms(messages):>11.3f} "
+                  f"{incremental_extraction_us(messages):>15.1f}")
+    print(f"{'all':>10} {totals[0]:>9} {totals[1]:>12} {1 - totals[1] / totals[0]:>6.0%}  ({len(sessions)} sessions)")
+    if not args.snapshot:
+        print("\nSample record (60 turns):")
+        record = SymptomRecord()
+        record.sync(sessions[-1][1])
+        print(record.summary())
+
+
+if __name__ == "__main__":
+    main()
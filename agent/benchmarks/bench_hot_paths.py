@@ -0,0 +1,138 @@
+"""Microbenchmarks for the agent's CPU hot paths, with regression thresholds.
+
+Usage:
+    python benchmarks/bench_hot_paths.py                  # compare against baseline.json
+    python benchmarks/bench_hot_paths.py --save-baseline  # record a new baseline
+    python benchmarks/bench_hot_paths.py --threshold 50 --filter diagnosis
+
+Upstream calls go to a StubClient, so no network access is needed. Each case
+reports the best per-call time over several repeats; the run exits non-zero
+when any case is slower than its baseline by more than the threshold
+(default 25%, or BENCH_REGRESSION_THRESHOLD).
+
+Timings are machine-specific: record the baseline on the machine that runs
+the comparison.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+from pharma_agent import PharmacistAgent  # noqa: E402
+from synthetic import StubClient, make_conversation, make_diagnosis, make_raw_output  # noqa: E402
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+TURNS = (5, 50, 500)
+OUTPUT_KB = (1, 3, 5)
+
+
+def _agent(reply=None):
+    agent = PharmacistAgent(validate=False)
+    agent.client = StubClient(reply) if reply is not None else StubClient()
+    return agent
+
+
+def build_cases():
+    """Return {name: zero-argument callable}"""
+    cases = {}
+    agent = _agent()
+    system_prompt = agent.conversation_history[0]["content"]
+
+    for turns in TURNS:
+        conversation = make_conversation(turns, system_prompt)
+        cases[f"detect_pain_symptoms[{turns}]"] = lambda c=conversation: agent.detect_pain_symptoms(c)
+
+        def prompt_assembly(c=conversation, a=_agent()):
+            a.conversation_history = list(c) + [{"role": "user", "content": "It hurts more at night"}]
+            a.get_ai_response()
+        cases[f"get_ai_response_prompt[{turns}]"] = prompt_assembly
+
+    for kb in OUTPUT_KB:
+        valid = make_diagnosis(kb * 1024)
+        legacy = make_diagnosis(kb * 1024, legacy=True)
+        cases[f"validate_diagnosis_format[{kb}KB]"] = lambda d=valid: agent._validate_diagnosis_format(d)
+        cases[f"fix_diagnosis_format[{kb}KB]"] = lambda d=legacy: agent._fix_diagnosis_format(json.loads(json.dumps(d)))
+
+        for style in ("json", "fenced", "broken"):
+            diag_agent = _agent(make_raw_output(kb * 1024, style))
+            conversation = make_conversation(5, system_prompt)
+            cases[f"generate_diagnosis_{style}[{kb}KB]"] = (
+                lambda a=diag_agent, c=conversation: a.generate_diagnosis(conversation_history=c)
+            )
+
+    try:
+        from api_server import normalize_diagnosis
+    except ImportError as e:
+        print(f"Skipping normalize_diagnosis cases: {str(e)}")
+    else:
+        for kb in OUTPUT_KB:
+            legacy = make_diagnosis(kb * 1024, legacy=True)
+            cases[f"normalize_diagnosis[{kb}KB]"] = lambda d=legacy: normalize_diagnosis(json.loads(json.dumps(d)))
+
+    return cases
+
+
+def measure(func, repeat=7):
+    """Best per-call time in microseconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save-baseline", action="store_true", help="write results to baseline.json")
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("BENCH_REGRESSION_THRESHOLD", "25")),
+                        help="allowed slowdown in percent before a case fails")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this string")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    cases = build_cases()
+    results = {}
+    regressions = []
+    print(f"{'case':<40} {'us/call':>12} {'baseline':>12} {'change':>8}")
+    for name, func in cases.items():
+        if args.filter not in name:
+            continue
+        # The agent logs with print(); keep that out of the measurement output
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = measure(func)
+        base = baseline.get(name)
+        if base:
+            change = (results[name] - base) / base * 100
+            flag = "  REGRESSION" if change > args.threshold else ""
+            if flag:
+                regressions.append(name)
+            print(f"{name:<40} {results[name]:12.2f} {base:12.2f} {change:+7.1f}%{flag}")
+        else:
+            print(f"{name:<40} {results[name]:12.2f} {'-':>12} {'new':>8}")
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(dict(sorted(baseline.items())), f, indent=2)
+            f.write("\n")
+        print(f"Saved baseline for {len(results)} cases to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"{len(regressions)} case(s) regressed by more than {args.threshold:.0f}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
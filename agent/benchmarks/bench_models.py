@@ -0,0 +1,261 @@
+"""Compare models and prompt versions on recorded conversations: latency, tokens and JSON validity.
+
+Usage:
+    python benchmarks/bench_models.py --stub                     # offline, simulated models
+    python benchmarks/bench_models.py --model llama3-8b-8192 --model llama-3.1-8b-instant --snapshot sessions.bin
+    python benchmarks/bench_models.py --model gpt-4o-mini@https://api.openai.com/v1 --api-key-env OPENAI_API_KEY \\
+        --corpus sessions.ndjson --prompt full --prompt compact --json results.json
+
+Conversations come from a session snapshot (``--snapshot``, see
+SESSION_SNAPSHOT_PATH), from NDJSON written with messages included
+(/api/admin/export?include_messages=true or ``session_export.py
+--include-messages``) via ``--corpus``, or are synthetic. Each conversation
+replays its last ``--chat-turns`` user turns through get_ai_response, then
+runs generate_diagnosis on the whole conversation followed by the same
+repair_raw_diagnosis step /api/diagnose applies.
+
+``--model`` takes ``model`` (Groq) or ``model@base_url`` for any
+OpenAI-compatible endpoint; the key is read from ``--api-key-env``.
+``--prompt`` picks diagnosis prompt versions: ``full`` sends the
+transcript, ``compact`` the SymptomRecord summary plus the last messages
+(COMPACT_DIAGNOSIS_PROMPT). ``--stub`` replaces the models with simulated
+ones whose reply formats and latencies differ, for offline runs.
+
+Latency and tokens come from the agent's successful upstream.completion
+trace spans (tokens are estimated at ~4 characters each when the endpoint
+reports no usage); failed attempts are counted as upstream errors. A
+diagnosis is a first parse when the reply parsed as JSON directly, a repair
+when it only parsed after extraction and cleanup (by the agent or the
+server's repair step), and a fallback when /api/diagnose would answer from
+the fallback engine because it still carries an error.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+from pharma_agent import PharmacistAgent, repair_raw_diagnosis  # noqa: E402
+from symptom_record import SymptomRecord  # noqa: E402
+from synthetic import StubClient, make_conversation, make_raw_output  # noqa: E402
+from tracing import Tracer  # noqa: E402
+
+RECENT_MESSAGES = 6
+# Simulated models for --stub: share of each diagnosis reply format, fixed overhead and decode time
+STUB_MODELS = {
+    "stub-clean-slow": {"formats": {"json": 1.0}, "overhead": 0.030, "per_token": 0.0002},
+    "stub-messy-fast": {"formats": {"json": 0.6, "fenced": 0.2, "broken": 0.1, "prose": 0.1},
+                        "overhead": 0.010, "per_token": 0.0001},
+}
+
+
+class SpanCollector:
+    """Trace exporter keeping finished spans in memory"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, record):
+        self.spans.append(record)
+
+
+class SimulatedModel:
+    """StubClient reply callable drawing diagnosis reply formats and latency from a STUB_MODELS profile"""
+
+    def __init__(self, profile, seed=0):
+        self.profile = profile
+        self.rng = random.Random(seed)
+
+    def __call__(self, request):
+        if request.get("response_format"):
+            formats = self.profile["formats"]
+            style = self.rng.choices(list(formats), weights=list(formats.values()))[0]
+            size = self.rng.randint(400, 1200)
+            if style == "prose":
+                content = "Based on your symptoms this looks like a tension headache. Rest and take ibuprofen."
+            else:
+                content = make_raw_output(size, style, seed=self.rng.randrange(1000))
+        else:
+            content = "Thanks for sharing. How long has this been going on, and does anything make it better?"
+        time.sleep(self.profile["overhead"] + len(content) / 4 * self.profile["per_token"])
+        return content
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))] if ordered else 0.0
+
+
+def load_corpus(args, system_prompt):
+    """Return conversations as message lists starting with the system prompt"""
+    conversations = []
+    if args.snapshot:
+        from session_snapshot import SnapshotReader
+        for _, messages in SnapshotReader(args.snapshot).items():
+            conversations.append(messages)
+            if len(conversations) >= args.limit:
+                break
+    elif args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    messages = record.get("messages") or []
+                    conversations.append([{"role": "system", "content": system_prompt}] + messages)
+                if len(conversations) >= args.limit:
+                    break
+    else:
+        conversations = [make_conversation((3, 5, 8, 12)[i % 4], system_prompt, seed=i) for i in range(args.limit)]
+    # Only conversations with a user turn can be replayed
+    return [messages for messages in conversations if any(msg["role"] == "user" for msg in messages)]
+
+
+def make_agent(model, args):
+    agent = PharmacistAgent(validate=False)
+    if args.stub:
+        agent.model = model
+        # Same seed for every prompt version, so they see the same reply formats
+        agent.client = StubClient(SimulatedModel(STUB_MODELS[model]))
+        return agent
+    name, _, base_url = model.partition("@")
+    agent.model = name
+    if base_url:
+        agent.base_url = base_url
+    agent.api_key = os.getenv(args.api_key_env) or agent.api_key
+    return agent
+
+
+def replay(agent, messages, prompt, chat_turns):
+    """Replay one conversation; returns (diagnosis, chat errors)"""
+    chat_errors = 0
+    user_positions = [i for i, msg in enumerate(messages) if msg["role"] == "user"]
+    for position in user_positions[-chat_turns:] if chat_turns else []:
+        agent.conversation_history = messages[:position + 1]
+        try:
+            agent.get_ai_response()
+        except Exception as e:
+            print(f"Chat turn failed: {str(e)}", file=sys.stderr)
+            chat_errors += 1
+    agent.clinical_record = None
+    if prompt == "compact":
+        record = SymptomRecord()
+        record.sync(messages)
+        agent.clinical_record = record.summary()
+        agent.recent_messages = RECENT_MESSAGES
+    # As run_diagnosis does; a diagnosis that isn't a dict ends up as an error there too
+    diagnosis = agent.generate_diagnosis(conversation_history=messages)
+    if isinstance(diagnosis, dict):
+        diagnosis = repair_raw_diagnosis(diagnosis)
+    return diagnosis, chat_errors
+
+
+def run(model, prompt, conversations, args):
+    collector = SpanCollector()
+    tracer = Tracer(collector, sample_rate=1.0)
+    agent = make_agent(model, args)
+    outcomes = {"direct": 0, "extracted": 0, "fallback": 0}
+    chat_errors = 0
+    for messages in conversations:
+        first_span = len(collector.spans)
+        with contextlib.redirect_stdout(io.StringIO()), tracer.start("replay"):
+            diagnosis, errors = replay(agent, messages, prompt, args.chat_turns)
+        chat_errors += errors
+        spans = collector.spans[first_span:]
+        extracted = any(s["name"] == "diagnosis.parse" and s["attributes"].get("path") == "extracted" for s in spans)
+        repaired = any(s["name"] == "diagnosis.repair" and s["attributes"].get("repaired") for s in spans)
+        if not isinstance(diagnosis, dict) or "error" in diagnosis:
+            outcomes["fallback"] += 1
+        elif extracted or repaired:
+            outcomes["extracted"] += 1
+        else:
+            outcomes["direct"] += 1
+
+    calls = {"follow_up": [], "diagnosis": []}
+    upstream_errors = 0
+    for s in collector.spans:
+        if s["name"] == "upstream.completion" and s["status"] != "ok":
+            upstream_errors += 1
+        elif s["name"] == "upstream.completion":
+            call_type = "diagnosis" if s["attributes"]["call_type"] == "diagnosis" else "follow_up"
+            calls[call_type].append(s)
+    diagnoses = len(conversations)
+
+    def tokens(call_type, key):
+        spans = calls[call_type]
+        return statistics.mean(s["attributes"][key] or 0 for s in spans) if spans else 0.0
+
+    def latencies(call_type):
+        return [s["duration_ms"] for s in calls[call_type]]
+
+    return {
+        "model": model,
+        "prompt": prompt,
+        "conversations": diagnoses,
+        "chat_calls": len(calls["follow_up"]),
+        "chat_p50_ms": percentile(latencies("follow_up"), 0.5),
+        "chat_p95_ms": percentile(latencies("follow_up"), 0.95),
+        "diagnosis_p50_ms": percentile(latencies("diagnosis"), 0.5),
+        "diagnosis_p95_ms": percentile(latencies("diagnosis"), 0.95),
+        "diagnosis_p99_ms": percentile(latencies("diagnosis"), 0.99),
+        "chat_tokens_in": tokens("follow_up", "prompt_tokens"),
+        "chat_tokens_out": tokens("follow_up", "completion_tokens"),
+        "diagnosis_tokens_in": tokens("diagnosis", "prompt_tokens"),
+        "diagnosis_tokens_out": tokens("diagnosis", "completion_tokens"),
+        "first_parse_rate": outcomes["direct"] / diagnoses,
+        "repair_rate": outcomes["extracted"] / diagnoses,
+        "fallback_rate": outcomes["fallback"] / diagnoses,
+        "chat_errors": chat_errors,
+        "upstream_errors": upstream_errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", action="append", default=[], help="model or model@base_url (repeatable)")
+    parser.add_argument("--api-key-env", default="GROQ_API_KEY", help="Environment variable holding the API key")
+    parser.add_argument("--prompt", action="append", choices=["full", "compact"], help="Diagnosis prompt versions")
+    parser.add_argument("--stub", action="store_true", help="Use simulated models instead of endpoints")
+    parser.add_argument("--snapshot", help="Session snapshot written by the API server")
+    parser.add_argument("--corpus", help="NDJSON export with messages")
+    parser.add_argument("--limit", type=int, default=20, help="Conversations to replay")
+    parser.add_argument("--chat-turns", type=int, default=1, help="User turns replayed per conversation")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    models = list(STUB_MODELS) if args.stub else args.model
+    if not models:
+        parser.error("give at least one --model, or --stub")
+    prompts = args.prompt or ["full"]
+    system_prompt = PharmacistAgent(validate=False).conversation_history[0]["content"]
+    conversations = load_corpus(args, system_prompt)
+    if not conversations:
+        parser.error("no conversations with user turns in the corpus")
+
+    results = [run(model, prompt, conversations, args) for model in models for prompt in prompts]
+
+    source = args.snapshot or args.corpus or "synthetic"
+    print(f"{len(conversations)} conversations from {source}, {args.chat_turns} chat turn(s) each")
+    print(f"{'model':<24} {'prompt':<8} {'chat p50/p95 ms':>16} {'diag p50/p95/p99 ms':>22} "
+          f"{'chat tok in/out':>16} {'diag tok in/out':>16} {'1st parse':>9} {'repair':>7} {'fallback':>9} {'upstream errors':>16}")
+    for r in results:
+        print(f"{r['model'][:24]:<24} {r['prompt']:<8} "
+              f"{r['chat_p50_ms']:>7.0f}/{r['chat_p95_ms']:<8.0f} "
+              f"{r['diagnosis_p50_ms']:>8.0f}/{r['diagnosis_p95_ms']:.0f}/{r['diagnosis_p99_ms']:<6.0f} "
+              f"{r['chat_tokens_in']:>8.0f}/{r['chat_tokens_out']:<7.0f} "
+              f"{r['diagnosis_tokens_in']:>8.0f}/{r['diagnosis_tokens_out']:<7.0f} "
+              f"{r['first_parse_rate']:>9.0%} {r['repair_rate']:>7.0%} {r['fallback_rate']:>9.0%} {r['upstream_errors']:>16}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Per-turn CPU of building the chat request: copied history vs. pre-encoded session JSON.
+
+Usage: python benchmarks/bench_request_body.py [turns ...]
+
+Each case appends one user message to a CompactSession holding ``turns``
+exchanges and sends a follow-up completion through the real openai client,
+whose HTTP transport is replaced by an in-process mock (no network). The
+"copy" path is the previous one (session.copy() into the agent, request
+serialized by the client); "encoded" hands the agent session.encoded() and
+posts the spliced body. The reply is popped afterwards so every repeat sees
+the same history. Reported times are process CPU per turn.
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import httpx  # noqa: E402
+from openai import OpenAI  # noqa: E402
+
+from compact_session import CompactSession  # noqa: E402
+from pharma_agent import PharmacistAgent  # noqa: E402
+from synthetic import make_conversation  # noqa: E402
+
+REPLY = json.dumps({
+    "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "llama3-8b-8192",
+    "choices": [{"index": 0, "finish_reason": "stop",
+                 "message": {"role": "assistant", "content": "How long has this been going on?"}}],
+    "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+}).encode()
+REPEATS = 50
+
+
+def mock_client():
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=REPLY,
+                                                                   headers={"content-type": "application/json"}))
+    return OpenAI(api_key="bench", base_url="http://upstream.invalid/v1", http_client=httpx.Client(transport=transport))
+
+
+def per_turn_cpu(agent, session, encoded):
+    message = {"role": "user", "content": "The pain is around 6 out of 10 and gets worse in the evening"}
+    started = time.process_time()
+    for _ in range(REPEATS):
+        session.append(message)
+        if encoded:
+            agent.encoded_history = session.encoded()
+        else:
+            agent.conversation_history = session.copy()
+        agent.get_ai_response()
+        session.pop()
+    return (time.process_time() - started) / REPEATS
+
+
+def main():
+    turn_counts = [int(arg) for arg in sys.argv[1:]] or [10, 100, 500]
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent = PharmacistAgent(validate=False)
+    agent.client = mock_client()
+    system_prompt = agent.conversation_history[0]["content"]
+
+    print(f"{'turns':>6} {'copy us/turn':>13} {'encoded us/turn':>16} {'speedup':>8}")
+    for turns in turn_counts:
+        messages = make_conversation(turns, system_prompt=system_prompt)
+        results = []
+        for encoded in (False, True):
+            session = CompactSession(system_prompt, messages)
+            agent.encoded_history = None
+            with contextlib.redirect_stdout(io.StringIO()):
+                per_turn_cpu(agent, session, encoded)  # warm-up, builds the encoded cache
+                results.append(per_turn_cpu(agent, session, encoded))
+        print(f"{turns:>6} {results[0] * 1e6:>13.0f} {results[1] * 1e6:>16.0f} {results[0] / results[1]:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
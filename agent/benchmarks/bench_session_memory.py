@@ -0,0 +1,78 @@
+"""Compare session memory of the dict-of-lists layout and CompactSession.
+
+Usage: python benchmarks/bench_session_memory.py [turns]
+
+"encoded" is CompactSession after encoded() has been called, as it is on
+every chat turn, so it also holds the session's JSON encoding.
+"""
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from compact_session import CompactSession  # noqa: E402
+from pharma_agent import PharmacistAgent  # noqa: E402
+
+SYSTEM_MESSAGE = PharmacistAgent(validate=False).conversation_history[0]
+SYSTEM_PROMPT = SYSTEM_MESSAGE["content"]
+
+
+def turns_for(i, turns):
+    for turn in range(turns):
+        yield {"role": "user", "content": f"I have had a headache for {turn + 2} days, user {i}"}
+        yield {"role": "assistant", "content": f"How intense is the pain on a scale of 1-10? ({i})"}
+
+
+def build_dicts(count, turns):
+    # The layout api_server used: a copied system dict plus one dict per message
+    sessions = {}
+    for i in range(count):
+        messages = [SYSTEM_MESSAGE.copy()]
+        messages.extend(turns_for(i, turns))
+        sessions[f"user_{i}"] = messages
+    return sessions
+
+
+def build_compact(count, turns):
+    sessions = {}
+    for i in range(count):
+        session = CompactSession(SYSTEM_PROMPT, [SYSTEM_MESSAGE])
+        session.extend(turns_for(i, turns))
+        sessions[f"user_{i}"] = session
+    return sessions
+
+
+def build_encoded(count, turns):
+    sessions = build_compact(count, turns)
+    for session in sessions.values():
+        session.encoded()
+    return sessions
+
+
+def measure(builder, count, turns):
+    gc.collect()
+    tracemalloc.start()
+    sessions = builder(count, turns)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del sessions
+    return current
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"turns per session: {turns} (user + assistant message each)")
+    print(f"system prompt: {len(SYSTEM_PROMPT)} characters")
+    print(f"{'sessions':>9} {'dict MB':>9} {'compact MB':>11} {'saved':>7} {'encoded MB':>11} {'saved':>7}")
+    for count in (10_000, 100_000):
+        dict_bytes = measure(build_dicts, count, turns)
+        compact_bytes = measure(build_compact, count, turns)
+        encoded_bytes = measure(build_encoded, count, turns)
+        print(f"{count:>9} {dict_bytes / 1e6:9.1f} {compact_bytes / 1e6:11.1f} {1 - compact_bytes / dict_bytes:7.0%} "
+              f"{encoded_bytes / 1e6:11.1f} {1 - encoded_bytes / dict_bytes:7.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Measure session snapshot write, open and lazy restore times, and how long
+a periodic snapshot blocks the event loop.
+
+The loop measurement copies live CompactSessions the way the server's
+snapshot_sessions does, a chunk per loop iteration, writes them on a worker
+thread, and records the longest and p99 delay of a 5 ms ticker running on
+the loop meanwhile (full garbage collections of a large heap show up here).
+
+Usage: python benchmarks/bench_session_snapshot.py [sessions] [turns]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from compact_session import CompactSession, messages_from_snapshot  # noqa: E402
+from session_snapshot import open_snapshot, write_snapshot  # noqa: E402
+
+# Same as api_server.SNAPSHOT_COPY_CHUNK
+SNAPSHOT_COPY_CHUNK = 1000
+SYSTEM_PROMPT = "You are a professional AI medical assistant embedded in a digital pharmacist web app. " * 40
+
+
+def make_sessions(count, turns):
+    sessions = {}
+    for i in range(count):
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        for turn in range(turns):
+            messages.append({"role": "user", "content": f"I have had a headache for {turn + 2} days, user {i}"})
+            messages.append({"role": "assistant", "content": "How intense is the pain on a scale of 1-10?"})
+        sessions[f"user_{i}"] = messages
+    return sessions
+
+
+async def measure_loop_block(path, sessions):
+    """Return (seconds spent copying, max loop delay ms, p99 loop delay ms) for one snapshot"""
+    live_sessions = {user_id: CompactSession(SYSTEM_PROMPT, messages) for user_id, messages in sessions.items()}
+    interval = 0.005
+    delays = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            delays.append(time.perf_counter() - start - interval)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.1)
+    start = time.perf_counter()
+    items = list(live_sessions.items())
+    live = []
+    for chunk in range(0, len(items), SNAPSHOT_COPY_CHUNK):
+        live.extend((user_id, session.snapshot()) for user_id, session in items[chunk:chunk + SNAPSHOT_COPY_CHUNK])
+        await asyncio.sleep(0)
+    copy_s = time.perf_counter() - start
+    await asyncio.to_thread(
+        write_snapshot, path, ((user_id, messages_from_snapshot(*snap)) for user_id, snap in live), SYSTEM_PROMPT
+    )
+    done.set()
+    await task
+    delays.sort()
+    return copy_s, delays[-1] * 1000, delays[int(len(delays) * 0.99)] * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    sessions = make_sessions(count, turns)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sessions.snapshot")
+
+        start = time.perf_counter()
+        write_snapshot(path, sessions.items(), SYSTEM_PROMPT)
+        write_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reader = open_snapshot(path)
+        open_ms = (time.perf_counter() - start) * 1000
+
+        keys = [f"user_{i}" for i in range(0, count, max(1, count // 1000))]
+        start = time.perf_counter()
+        for key in keys:
+            assert reader.get(key) == sessions[key]
+        lookup_us = (time.perf_counter() - start) / len(keys) * 1e6
+
+        start = time.perf_counter()
+        restored = sum(1 for _ in reader.items())
+        full_s = time.perf_counter() - start
+        assert restored == count
+
+        print(f"sessions={count} turns={turns} file={os.path.getsize(path) / 1e6:.1f} MB")
+        print(f"snapshot write:      {write_s:.2f} s")
+        print(f"open (mmap):         {open_ms:.3f} ms")
+        print(f"lazy restore/session {lookup_us:.1f} us")
+        print(f"full decode:         {full_s:.2f} s")
+        reader.close()
+
+        copy_s, max_delay_ms, p99_delay_ms = asyncio.run(measure_loop_block(path, sessions))
+        print(f"copy (chunked):      {copy_s * 1000:.0f} ms")
+        print(f"loop delay max/p99:  {max_delay_ms:.0f} / {p99_delay_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Compare fixed and adaptive max_tokens against a simulated upstream.
+
+Usage: python benchmarks/bench_token_caps.py [calls_per_type]
+
+The stub draws each reply length from a per-call-type distribution, with a
+small share of runaway generations that keep going until max_tokens. The
+simulated latency is a fixed overhead plus a per-output-token decode time.
+Reserved tokens (prompt + max_tokens) are what counts against an upstream
+tokens-per-minute limit, so lower reservations mean more rate-limit headroom.
+"""
+import contextlib
+import io
+import os
+import random
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+from pharma_agent import PharmacistAgent  # noqa: E402
+from synthetic import StubClient, make_conversation  # noqa: E402
+from token_caps import AdaptiveTokenCaps  # noqa: E402
+
+PROMPT_TOKENS = 900
+OVERHEAD_SECONDS = 0.15
+SECONDS_PER_TOKEN = 0.004
+RUNAWAY_RATE = 0.02
+# (mean, stddev) of reply length in tokens per call type
+OUTPUT_LENGTHS = {"follow_up": (70, 20), "diagnosis": (350, 90)}
+
+
+class SimulatedUpstream:
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.latencies = []
+        self.reserved = []
+        self.call_type = "follow_up"
+
+    def __call__(self, request):
+        max_tokens = request["max_tokens"]
+        mean, stddev = OUTPUT_LENGTHS[self.call_type]
+        wanted = max(5, int(self.rng.gauss(mean, stddev)))
+        if self.rng.random() < RUNAWAY_RATE:
+            wanted = 10 ** 6
+        produced = min(wanted, max_tokens)
+        self.latencies.append(OVERHEAD_SECONDS + produced * SECONDS_PER_TOKEN)
+        self.reserved.append(PROMPT_TOKENS + max_tokens)
+        content = '{"diagnosis": "x", "prescriptions": []}' if self.call_type == "diagnosis" else "How long has it hurt?"
+        return {
+            "content": content,
+            "finish_reason": "length" if wanted > max_tokens else "stop",
+            "prompt_tokens": PROMPT_TOKENS,
+            "completion_tokens": produced,
+        }
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def run(calls, token_caps):
+    upstream = SimulatedUpstream()
+    agent = PharmacistAgent(validate=False)
+    agent.client = StubClient(upstream)
+    agent.token_caps = token_caps
+    conversation = make_conversation(5, agent.conversation_history[0]["content"])
+
+    results = {}
+    for call_type in OUTPUT_LENGTHS:
+        upstream.call_type = call_type
+        upstream.latencies, upstream.reserved = [], []
+        # Latency per logical call, including the retry after a truncated reply
+        call_latencies = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(calls):
+                first_attempt = len(upstream.latencies)
+                if call_type == "diagnosis":
+                    agent.generate_diagnosis(conversation_history=conversation)
+                else:
+                    agent.conversation_history = list(conversation)
+                    agent.get_ai_response()
+                call_latencies.append(sum(upstream.latencies[first_attempt:]))
+        results[call_type] = {
+            "p50": percentile(call_latencies, 0.5),
+            "p99": percentile(call_latencies, 0.99),
+            "reserved": sum(upstream.reserved) / calls,
+            "upstream_calls": len(upstream.latencies),
+        }
+    return results
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    fixed = run(calls, None)
+    adaptive_caps = AdaptiveTokenCaps()
+    adaptive = run(calls, adaptive_caps)
+
+    print(f"{calls} calls per type, simulated latency = {OVERHEAD_SECONDS}s + {SECONDS_PER_TOKEN * 1000:.0f}ms/token, "
+          f"{RUNAWAY_RATE:.0%} runaway generations")
+    print(f"{'call type':<11} {'mode':<9} {'p50 s':>7} {'p99 s':>7} {'reserved tok/call':>18} {'upstream calls':>15}")
+    for call_type in OUTPUT_LENGTHS:
+        for mode, results in (("fixed", fixed), ("adaptive", adaptive)):
+            r = results[call_type]
+            print(f"{call_type:<11} {mode:<9} {r['p50']:7.2f} {r['p99']:7.2f} {r['reserved']:18.0f} {r['upstream_calls']:15}")
+        headroom = fixed[call_type]["reserved"] / adaptive[call_type]["reserved"]
+        print(f"{'':<11} rate-limit headroom: {headroom:.1f}x more calls per token budget")
+    print(f"caps: {adaptive_caps.stats({'follow_up': 2000, 'diagnosis': 4000})}")
+
+
+if __name__ == "__main__":
+    main()
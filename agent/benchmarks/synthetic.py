@@ -0,0 +1,169 @@
+"""Synthetic conversations, LLM outputs and a stub OpenAI client for benchmarks."""
+import json
+import random
+
+USER_LINES = [
+    "I have a throbbing headache behind my eyes",
+    "It started about three days ago and gets worse in the evening",
+    "The pain is around 6 out of 10",
+    "I also feel a bit nauseous and bright light bothers me",
+    "I tried drinking more water but it didn't help much",
+    "No allergies that I know of, and I'm not taking any medication",
+    "My lower back is stiff in the morning after sleeping",
+    "Sometimes there's a sharp pain when I bend over",
+]
+ASSISTANT_LINES = [
+    "I'm sorry to hear that. How long have you been experiencing this?",
+    "Thank you for sharing. On a scale of 1-10, how intense is the pain?",
+    "That's helpful. Have you noticed anything that makes it better or worse?",
+    "Understood. Do you have any allergies or take any regular medications?",
+]
+DRUGS = ["Ibuprofen", "Acetaminophen", "Naproxen Sodium", "Loratadine", "Omeprazole", "Cetirizine"]
+
+
+def make_conversation(turns, system_prompt="You are a professional AI medical assistant.", seed=0):
+    """Return a system prompt plus ``turns`` user/assistant exchanges"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": system_prompt}]
+    for _ in range(turns):
+        messages.append({"role": "user", "content": rng.choice(USER_LINES)})
+        messages.append({"role": "assistant", "content": rng.choice(ASSISTANT_LINES)})
+    return messages
+
+
+def make_diagnosis(target_bytes, legacy=False, seed=0):
+    """Return a diagnosis dict whose JSON encoding is roughly ``target_bytes`` long.
+
+    ``legacy`` uses the old ``prescription``/``drug`` keys and drops fields so the
+    fix-up paths have work to do.
+    """
+    rng = random.Random(seed)
+    diagnosis = {
+        "diagnosis": "Tension-type headache with mild dehydration",
+        "follow_up_recommendations": "See a doctor if symptoms persist for more than 3 days.",
+    }
+    prescriptions = []
+    while len(json.dumps(diagnosis | {"prescriptions": prescriptions})) < target_bytes:
+        drug = rng.choice(DRUGS)
+        if legacy:
+            prescriptions.append({"drug": drug, "dosage": "400mg", "duration": "5 days"})
+        else:
+            prescriptions.append({
+                "drug_name": drug,
+                "dosage": "400mg",
+                "form": "tablet",
+                "duration": "5 days",
+                "instructions": "Take every 6-8 hours with food as needed. Do not exceed the daily maximum.",
+            })
+    diagnosis["prescription" if legacy else "prescriptions"] = prescriptions
+    return diagnosis
+
+
+def make_raw_output(target_bytes, style="json", seed=0):
+    """Return an LLM diagnosis output of about ``target_bytes``.
+
+    ``json`` is clean JSON, ``fenced`` wraps it in prose and a code fence, and
+    ``broken`` adds trailing commas and unquoted keys so the repair path runs.
+    """
+    body = json.dumps(make_diagnosis(target_bytes, seed=seed), indent=2)
+    if style == "json":
+        return body
+    if style == "fenced":
+        return f"Here is the diagnosis you asked for:\n```json\n{body}\n```\nLet me know if you need anything else."
+    if style == "broken":
+        broken = body.replace('"dosage":', "dosage:").replace('"form":', "form:")
+        return "Diagnosis:\n" + broken.replace('"\n    }', '",\n    }')
+    raise ValueError(f"Unknown output style {style}")
+
+
+class _Message:
+    def __init__(self, content):
+        self.content = content
+        self.role = "assistant"
+
+
+class _Choice:
+    def __init__(self, content, finish_reason="stop"):
+        self.message = _Message(content)
+        self.finish_reason = finish_reason
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, completion_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.total_tokens = prompt_tokens + completion_tokens
+
+
+class _Response:
+    def __init__(self, content, finish_reason="stop", usage=None):
+        self.choices = [_Choice(content, finish_reason)]
+        self.usage = usage
+
+
+class _Delta:
+    def __init__(self, content):
+        self.content = content
+
+
+class _ChunkChoice:
+    def __init__(self, content, finish_reason=None):
+        self.delta = _Delta(content)
+        self.finish_reason = finish_reason
+
+
+class _Chunk:
+    def __init__(self, content, finish_reason=None, usage=None):
+        self.choices = [_ChunkChoice(content, finish_reason)]
+        self.usage = usage
+
+
+class _Stream:
+    """Iterable of chunks shaped like ``openai.Stream[ChatCompletionChunk]``"""
+
+    def __init__(self, response, chunk_chars=16):
+        content = response.choices[0].message.content
+        pieces = [content[i:i + chunk_chars] for i in range(0, len(content), chunk_chars)] or [""]
+        self._chunks = [_Chunk(piece) for piece in pieces]
+        self._chunks[-1] = _Chunk(pieces[-1], response.choices[0].finish_reason, response.usage)
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if self.closed:
+                return
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class StubClient:
+    """Minimal stand-in for ``openai.OpenAI`` that returns canned completions.
+
+    ``reply`` is a string or a callable taking the request kwargs. A callable
+    may return a dict with ``content`` and optionally ``finish_reason``,
+    ``prompt_tokens`` and ``completion_tokens`` to control the response
+    metadata. The last request is kept on ``last_request`` so callers can
+    inspect the prompt. ``stream=True`` returns the reply in chunks.
+    """
+
+    def __init__(self, reply="Thanks for sharing. How long has this been going on?"):
+        self.reply = reply
+        self.last_request = None
+        self.calls = 0
+        self.chat = self
+        self.completions = self
+
+    def create(self, **kwargs):
+        self.last_request = kwargs
+        self.calls += 1
+        content = self.reply(kwargs) if callable(self.reply) else self.reply
+        if isinstance(content, dict):
+            usage = None
+            if "completion_tokens" in content:
+                usage = _Usage(content.get("prompt_tokens", 0), content["completion_tokens"])
+            response = _Response(content["content"], content.get("finish_reason", "stop"), usage)
+        else:
+            response = _Response(content)
+        return _Stream(response) if kwargs.get("stream") else response
@@ -0,0 +1,180 @@
+import sys
+from array import array
+from enum import IntEnum
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+from request_body import EncodedMessages, encode_message, encode_shared_message
+
+
+class Role(IntEnum):
+    SYSTEM = 0
+    USER = 1
+    ASSISTANT = 2
+
+
+ROLE_BY_NAME = {role.name.lower(): role for role in Role}
+ROLE_NAMES = [role.name.lower() for role in Role]
+
+
+def messages_from_snapshot(roles: bytes, contents: List[str]) -> List[Dict[str, str]]:
+    """Build the message-list format from a ``CompactSession.snapshot()``"""
+    return [{"role": ROLE_NAMES[role], "content": content} for role, content in zip(roles, contents)]
+
+
+class CompactSession:
+    """Memory-compact conversation history for one user.
+
+    Roles are stored as one byte each in an ``array`` and contents in a plain
+    list, instead of one dict per message. Messages equal to the shared system
+    prompt keep a reference to the prompt string rather than a copy.
+
+    The class behaves like the list of ``{"role", "content"}`` dicts it replaces
+    (``append``, ``extend``, ``clear``, ``copy``, indexing, iteration), and dicts
+    are only built when the history is read, e.g. to assemble a prompt.
+
+    ``encoded()`` returns the history as ready-to-send JSON. The encoding is
+    built on first use and then kept up to date one message at a time, so
+    a new turn encodes only the new message; each call copies the buffer
+    (a single memcpy) so the result stays valid while the session changes.
+    A leading system prompt isn't part of the session's buffer: its
+    encoding is shared by all sessions.
+    """
+
+    __slots__ = ("system_prompt", "version", "_roles", "_contents", "_encoded", "_offsets")
+
+    def __init__(self, system_prompt: str, messages: Iterable[Dict[str, str]] = (), version: int = 0):
+        self.system_prompt = system_prompt
+        # Incremented on every change so clients can sync by version instead of resending history.
+        # Starting from a per-process base keeps a session restored from an older snapshot from
+        # reusing version numbers a client saw before the restart
+        self.version = version
+        self._roles = array("B")
+        self._contents: List[str] = []
+        # JSON encoding of the messages after the first, each preceded by a comma, and where
+        # each of them starts in it
+        self._encoded: Optional[bytearray] = None
+        self._offsets: Optional[array] = None
+        self.extend(messages)
+
+    def append(self, message: Dict[str, str]):
+        content = message["content"]
+        if content == self.system_prompt:
+            content = self.system_prompt
+        role = ROLE_BY_NAME.get(message["role"])
+        if role is None:
+            raise ValueError(f"Unknown message role {message['role']!r}, expected one of {', '.join(ROLE_NAMES)}")
+        self._roles.append(role)
+        self._contents.append(content)
+        if self._encoded is not None and len(self._contents) > 1:
+            self._encode(role, content)
+        self.version += 1
+
+    def _encode(self, role: Role, content: str):
+        self._offsets.append(len(self._encoded))
+        self._encoded += b","
+        self._encoded += encode_message(ROLE_NAMES[role], content)
+
+    def extend(self, messages: Iterable[Dict[str, str]]):
+        for message in messages:
+            self.append(message)
+
+    def pop(self) -> Dict[str, str]:
+        """Remove and return the last message"""
+        role = self._roles.pop()
+        content = self._contents.pop()
+        if self._encoded is not None and self._contents:
+            del self._encoded[self._offsets.pop():]
+        self.version += 1
+        return {"role": ROLE_NAMES[role], "content": content}
+
+    def remove(self, message: Dict[str, str]) -> bool:
+        """Remove the most recent message equal to ``message``, even if others were added after it.
+
+        Returns False when there is no such message (e.g. the session was cleared meanwhile).
+        """
+        role = ROLE_BY_NAME.get(message["role"])
+        content = message["content"]
+        for index in range(len(self._contents) - 1, -1, -1):
+            if self._roles[index] == role and self._contents[index] == content:
+                break
+        else:
+            return False
+        del self._roles[index]
+        del self._contents[index]
+        if self._encoded is not None:
+            if index == 0 or not self._contents:
+                # The second message becomes the head, which isn't kept in the buffer
+                self._encoded = self._offsets = None
+            else:
+                start = self._offsets[index - 1]
+                end = self._offsets[index] if index < len(self._offsets) else len(self._encoded)
+                del self._encoded[start:end]
+                del self._offsets[index - 1]
+                for i in range(index - 1, len(self._offsets)):
+                    self._offsets[i] -= end - start
+        self.version += 1
+        return True
+
+    def clear(self):
+        del self._roles[:]
+        self._contents.clear()
+        self._encoded = self._offsets = None
+        self.version += 1
+
+    def to_messages(self) -> List[Dict[str, str]]:
+        """Build the OpenAI message-list format"""
+        return [
+            {"role": ROLE_NAMES[role], "content": content}
+            for role, content in zip(self._roles, self._contents)
+        ]
+
+    copy = to_messages
+
+    def snapshot(self):
+        """Return a cheap copy of the roles and contents, for building dicts off the event loop"""
+        return self._roles.tobytes(), self._contents[:]
+
+    def encoded(self) -> EncodedMessages:
+        """Return the history as pre-encoded JSON messages for a request body"""
+        if self._encoded is None:
+            self._encoded = bytearray()
+            self._offsets = array("Q")
+            for role, content in zip(self._roles[1:], self._contents[1:]):
+                self._encode(role, content)
+        head = b""
+        if self._contents:
+            role, content = ROLE_NAMES[self._roles[0]], self._contents[0]
+            head = encode_shared_message(role, content) if content is self.system_prompt else encode_message(role, content)
+        last_user = next(
+            (content for role, content in zip(reversed(self._roles), reversed(self._contents)) if role == Role.USER),
+            None
+        )
+        return EncodedMessages(
+            head, bytes(self._encoded), len(self._encoded), len(self._contents),
+            self._contents[1] if len(self._contents) > 1 else None, last_user
+        )
+
+    def __len__(self) -> int:
+        return len(self._contents)
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        for role, content in zip(self._roles, self._contents):
+            yield {"role": ROLE_NAMES[role], "content": content}
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            return [
+                {"role": ROLE_NAMES[role], "content": content}
+                for role, content in zip(self._roles[index], self._contents[index])
+            ]
+        return {"role": ROLE_NAMES[self._roles[index]], "content": self._contents[index]}
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by this session, not counting the shared system prompt"""
+        size = sys.getsizeof(self) + sys.getsizeof(self._roles) + sys.getsizeof(self._contents)
+        if self._encoded is not None:
+            size += sys.getsizeof(self._encoded) + sys.getsizeof(self._offsets)
+        for content in self._contents:
+            if content is not self.system_prompt:
+                size += sys.getsizeof(content)
+        return size
@@ -0,0 +1,59 @@
+import threading
+
+
+class PoolExhausted(Exception):
+    """Every connection stayed checked out for the pool's whole acquire timeout"""
+
+
+class LazyConnectionPool:
+    """psycopg2 ThreadedConnectionPool created on first use.
+
+    Startup never waits on the database, and modules that only need the
+    pool when a feature is enabled don't import psycopg2 otherwise. Exposes
+    the pool's ``getconn``/``putconn``/``closeall`` so any DB-API pool with
+    the same methods (e.g. a SQLite stand-in) can be used in its place.
+
+    psycopg2 raises PoolError as soon as all connections are checked out, so
+    ``getconn`` first waits up to ``acquire_timeout`` seconds for one to be
+    returned and raises PoolExhausted only after that.
+    """
+
+    def __init__(self, dsn, min_connections=1, max_connections=4, connect_timeout=3, acquire_timeout=5):
+        self.dsn = dsn
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.acquire_timeout = acquire_timeout
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+                self._pool = ThreadedConnectionPool(
+                    self.min_connections, self.max_connections, self.dsn, connect_timeout=self.connect_timeout
+                )
+            return self._pool
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise PoolExhausted(f"All {self.max_connections} database connections are in use")
+        try:
+            return self._get_pool().getconn()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            self._get_pool().putconn(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
@@ -0,0 +1,176 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from memory_report import deep_sizeof
+
+FINISHED = ("done", "failed")
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while ``max_queued`` jobs are already waiting"""
+
+
+class InMemoryJobStore:
+    """Diagnosis jobs kept in this process as plain dicts keyed by job id.
+
+    Finished jobs expire ``ttl`` seconds after they finish, and once more
+    than ``max_jobs`` are held the oldest finished ones are dropped. Another
+    backend (e.g. Redis, so that any replica can answer polls) can be used
+    in its place by implementing ``put``, ``get``, ``update``, ``purge`` and
+    ``__len__``.
+    """
+
+    def __init__(self, max_jobs=10000, ttl=900):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def _expired(self, job: Dict[str, Any]) -> bool:
+        return job["finished_at"] is not None and job["finished_at"] + self.ttl < time.time()
+
+    def put(self, job: Dict[str, Any]):
+        self._jobs[job["job_id"]] = job
+        while len(self._jobs) > self.max_jobs:
+            oldest = next((job_id for job_id, held in self._jobs.items() if held["status"] in FINISHED), None)
+            if oldest is None:
+                break
+            del self._jobs[oldest]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        if job is not None and self._expired(job):
+            del self._jobs[job_id]
+            return None
+        return dict(job) if job is not None else None
+
+    def update(self, job_id: str, fields: Dict[str, Any]):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+
+    def purge(self) -> int:
+        """Drop expired jobs; returns how many were removed"""
+        expired = [job_id for job_id, job in self._jobs.items() if self._expired(job)]
+        for job_id in expired:
+            del self._jobs[job_id]
+        return len(expired)
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by stored jobs and their results"""
+        return deep_sizeof(self._jobs)
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+
+class DiagnosisJobQueue:
+    """Diagnoses submitted as jobs and generated by a fixed pool of workers.
+
+    ``submit`` stores the job and returns at once; ``workers`` tasks take
+    jobs in submission order and run ``run_job(payload)``, whose return value
+    becomes the job's result (an exception marks it failed). At most
+    ``max_queued`` jobs wait at a time, beyond that ``submit`` raises
+    QueueFull. ``wait`` returns as soon as a job run by this process
+    finishes; jobs only visible through a shared store are re-read every
+    ``poll_interval`` seconds.
+    """
+
+    def __init__(self, store, run_job: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]], workers=4,
+                 max_queued=1000, purge_interval=60, poll_interval=1.0):
+        self.store = store
+        self.run_job = run_job
+        self.workers = workers
+        self.purge_interval = purge_interval
+        self.poll_interval = poll_interval
+        self._queue: "asyncio.Queue" = asyncio.Queue(max_queued)
+        self._finished: Dict[str, asyncio.Event] = {}
+        self._tasks: List["asyncio.Task"] = []
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._purge()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def submit(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Queue a job for ``payload`` and return its initial record"""
+        if self._queue.full():
+            self.rejected += 1
+            raise QueueFull(f"{self._queue.maxsize} diagnosis jobs are already queued")
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        self.store.put(job)
+        self._finished[job["job_id"]] = asyncio.Event()
+        self._queue.put_nowait((job["job_id"], payload))
+        self.submitted += 1
+        return dict(job)
+
+    async def _work(self):
+        while True:
+            job_id, payload = await self._queue.get()
+            self.store.update(job_id, {"status": "running", "started_at": time.time()})
+            try:
+                fields = {"status": "done", "result": await self.run_job(payload)}
+                self.completed += 1
+            except Exception as e:
+                print(f"Diagnosis job {job_id} failed: {str(e)}")
+                fields = {"status": "failed", "error": str(e)}
+                self.failed += 1
+            fields["finished_at"] = time.time()
+            self.store.update(job_id, fields)
+            finished = self._finished.pop(job_id, None)
+            if finished is not None:
+                finished.set()
+
+    async def _purge(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            self.store.purge()
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Return the job once it has finished, or as it is after ``timeout`` seconds"""
+        job = self.store.get(job_id)
+        if job is None or job["status"] in FINISHED or timeout <= 0:
+            return job
+        finished = self._finished.get(job_id)
+        if finished is None:
+            await asyncio.sleep(min(timeout, self.poll_interval))
+        else:
+            try:
+                await asyncio.wait_for(finished.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.store.get(job_id)
+
+    def queued_nbytes(self) -> int:
+        """Approximate bytes held by the payloads of jobs waiting for a worker"""
+        return deep_sizeof(self._queue._queue)
+
+    def stats(self) -> Dict[str, int]:
+        """Return counters for the metrics endpoint"""
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "max_queued": self._queue.maxsize,
+            "stored": len(self.store),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
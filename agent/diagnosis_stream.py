@@ -0,0 +1,109 @@
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+# Top-level keys whose array items are emitted as prescriptions ("prescription" is the legacy name)
+PRESCRIPTION_KEYS = ("prescriptions", "prescription")
+
+
+class IncrementalDiagnosisParser:
+    """Pick completed fields out of a diagnosis JSON object while it is still being generated.
+
+    ``feed`` takes the next chunk of model output and returns the events it
+    completed: ``("diagnosis", text)`` once the diagnosis string is closed and
+    ``("prescription", item)`` for each closed object in the prescriptions
+    array. Only string, bracket and brace boundaries are tracked, so each
+    character is scanned once. Text before the first "{" (prose, code
+    fences) is skipped. Fragments get the same repairs as the full reply
+    (trailing commas, unquoted keys) and are dropped if they still don't
+    parse; the caller parses the complete reply at the end either way.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._position = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key: Optional[str] = None
+        self._item_start: Optional[int] = None
+        self._diagnosis_sent = False
+        self.done = False
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        events: List[Tuple[str, Any]] = []
+        if self.done:
+            return events
+        self._buffer += text
+        buffer = self._buffer
+        stack = self._stack
+        for i in range(self._position, len(buffer)):
+            ch = buffer[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._string_closed(buffer[self._string_start:i + 1], events)
+                continue
+            if not stack and ch != "{":
+                continue
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == "{" or ch == "[":
+                stack.append(ch)
+                if len(stack) == 1:
+                    self._expect_key = True
+                elif len(stack) == 3 and ch == "{" and stack[1] == "[" and self._key in PRESCRIPTION_KEYS:
+                    self._item_start = i
+            elif ch == "}" or ch == "]":
+                stack.pop()
+                if len(stack) == 2 and self._item_start is not None:
+                    item = _loads(buffer[self._item_start:i + 1])
+                    if isinstance(item, dict):
+                        events.append(("prescription", item))
+                    self._item_start = None
+                elif not stack:
+                    self.done = True
+                    break
+            elif len(stack) == 1:
+                if ch == ",":
+                    self._expect_key = True
+                elif ch == ":":
+                    self._expect_key = False
+        self._position = len(buffer)
+        return events
+
+    def _string_closed(self, literal: str, events: List[Tuple[str, Any]]):
+        if len(self._stack) != 1:
+            return
+        if self._expect_key:
+            self._key = _loads(literal)
+        elif self._key == "diagnosis" and not self._diagnosis_sent:
+            diagnosis = _loads(literal)
+            if isinstance(diagnosis, str):
+                self._diagnosis_sent = True
+                events.append(("diagnosis", diagnosis))
+
+
+def _loads(fragment: str) -> Any:
+    try:
+        return json.loads(fragment)
+    except json.JSONDecodeError:
+        pass
+    repaired = re.sub(r',(\s*[\]}])', r'\1', fragment)
+    repaired = re.sub(r'(\{|\,)\s*([a-zA-Z0-9_]+)\s*:', r'\1"\2":', repaired)
+    try:
+        return json.loads(repaired)
+    except json.JSONDecodeError:
+        return None
+
+
+def sse_event(event: str, data: Any) -> bytes:
+    """Encode one server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
@@ -0,0 +1,227 @@
+import re
+from typing import Any, Dict, Iterable, List, Set
+
+# Phrases that always need a clinician; no medication is suggested when any appear
+RED_FLAGS = [
+    "chest pain", "shortness of breath", "difficulty breathing", "can't breathe", "cannot breathe",
+    "fainted", "passed out", "unconscious", "seizure", "stroke", "slurred", "numbness",
+    "coughing blood", "vomiting blood", "blood in", "severe bleeding", "worst headache",
+    "suicid", "overdose", "pregnan",
+]
+
+# Conditions that rule out NSAIDs (ibuprofen, naproxen)
+NSAID_CAUTIONS = ["ulcer", "kidney", "blood thinner", "warfarin"]
+
+# Names a patient may use for each drug; an allergy to any one rules the drug out.
+# An allergy to any NSAID rules out all of them, since they cross-react.
+NSAID_NAMES = ["ibuprofen", "advil", "motrin", "naproxen", "aleve", "aspirin", "nsaid"]
+DRUG_NAMES = {
+    "Acetaminophen": ["acetaminophen", "paracetamol", "tylenol", "panadol"],
+    "Ibuprofen": NSAID_NAMES,
+    "Naproxen Sodium": NSAID_NAMES,
+    "Loratadine": ["loratadine", "claritin", "antihistamine"],
+    "Calcium Carbonate": ["calcium carbonate", "tums", "antacid"],
+}
+ALLERGY_MENTION = re.compile(r"\b(?:allergic|allerg(?:y|ies)|reaction)\s+to\s+([^.;!?]+)")
+
+# Standard OTC regimens, matching the pain guidance in the agent's system prompt
+ACETAMINOPHEN = {
+    "drug_name": "Acetaminophen",
+    "dosage": "500mg",
+    "form": "tablet",
+    "duration": "3 days",
+    "instructions": "Take every 4-6 hours as needed. Do not exceed 3000mg in 24 hours.",
+}
+IBUPROFEN = {
+    "drug_name": "Ibuprofen",
+    "dosage": "400mg",
+    "form": "tablet",
+    "duration": "3 days",
+    "instructions": "Take every 6-8 hours with food as needed. Do not exceed 1200mg in 24 hours.",
+}
+NAPROXEN = {
+    "drug_name": "Naproxen Sodium",
+    "dosage": "220mg",
+    "form": "tablet",
+    "duration": "5 days",
+    "instructions": "Take every 8-12 hours with food as needed. Do not exceed 660mg in 24 hours.",
+}
+LORATADINE = {
+    "drug_name": "Loratadine",
+    "dosage": "10mg",
+    "form": "tablet",
+    "duration": "7 days",
+    "instructions": "Take once daily.",
+}
+CALCIUM_CARBONATE = {
+    "drug_name": "Calcium Carbonate",
+    "dosage": "500mg",
+    "form": "chewable tablet",
+    "duration": "3 days",
+    "instructions": "Chew 1-2 tablets as symptoms occur. Do not exceed 7 tablets in 24 hours.",
+}
+
+# Conditions in priority order; the rule with the most keyword hits wins. Keywords match whole
+# words (a trailing "s"/"es" is allowed) and don't count after a negation such as "no" or "not".
+RULES: List[Dict[str, Any]] = [
+    {
+        "name": "headache",
+        "keywords": ["headache", "migraine", "head hurts", "head is hurting", "head has been hurting", "head pain",
+                     "head ache", "head is pounding"],
+        "diagnosis": "Tension-type headache",
+        "prescriptions": [ACETAMINOPHEN, IBUPROFEN],
+    },
+    {
+        "name": "musculoskeletal",
+        "keywords": ["back pain", "back hurts", "neck", "shoulder", "muscle", "strain", "strained", "sprain", "sprained",
+                     "stiff", "stiffness", "lower back"],
+        "diagnosis": "Musculoskeletal pain, likely muscle strain",
+        "prescriptions": [IBUPROFEN, NAPROXEN],
+    },
+    {
+        "name": "joint",
+        "keywords": ["joint", "knee", "ankle", "wrist", "hip", "elbow"],
+        "diagnosis": "Joint pain",
+        "prescriptions": [NAPROXEN],
+    },
+    {
+        "name": "menstrual",
+        "keywords": ["my period", "period pain", "period cramp", "menstrual", "menstruation", "cramps"],
+        "diagnosis": "Menstrual cramps (dysmenorrhea)",
+        "prescriptions": [IBUPROFEN],
+    },
+    {
+        "name": "dental",
+        "keywords": ["tooth", "teeth", "dental", "gum"],
+        "diagnosis": "Dental pain",
+        "prescriptions": [IBUPROFEN],
+    },
+    {
+        "name": "fever",
+        "keywords": ["fever", "temperature", "chills", "flu", "cold", "body aches", "sore throat"],
+        "diagnosis": "Viral upper respiratory infection or flu-like illness",
+        "prescriptions": [ACETAMINOPHEN],
+    },
+    {
+        "name": "allergy",
+        "keywords": ["sneeze", "sneezing", "itchy eyes", "watery eyes", "runny nose", "hay fever"],
+        "diagnosis": "Allergic rhinitis",
+        "prescriptions": [LORATADINE],
+    },
+    {
+        "name": "heartburn",
+        "keywords": ["heartburn", "acid reflux", "indigestion", "burning in my chest after eating"],
+        "diagnosis": "Heartburn / indigestion",
+        "prescriptions": [CALCIUM_CARBONATE],
+    },
+    {
+        "name": "general_pain",
+        "keywords": ["pain", "hurt", "hurting", "ache", "aching", "sore", "tender", "cramp", "throbbing"],
+        "diagnosis": "Mild to moderate pain",
+        "prescriptions": [ACETAMINOPHEN],
+    },
+]
+
+PRELIMINARY_PREFIX = "Preliminary automated assessment (our full assessment service is temporarily unavailable): "
+FOLLOW_UP = (
+    "This is a conservative preliminary recommendation generated without a full review. "
+    "Please confirm with a pharmacist before use, and see a doctor if symptoms worsen or last more than 3 days."
+)
+
+
+NEGATION = re.compile(r"\b(?:no|not|don't|dont|doesn't|didn't|haven't|without|never|nor)\b")
+
+
+def _negated(text: str, position: int) -> bool:
+    """Whether a negation precedes ``position`` within its clause"""
+    clause = re.split(r"[.,;!?]| but ", text[max(0, position - 24):position])[-1]
+    return NEGATION.search(clause) is not None
+
+
+def _keyword_pattern(keyword: str) -> "re.Pattern":
+    return re.compile(r"\b" + re.escape(keyword) + r"(?:s|es)?\b")
+
+
+def contraindicated_drugs(text: str, allergies: Iterable[str] = ()) -> Set[str]:
+    """Drug names ruled out by allergies (mentioned in ``text`` or given) and NSAID cautions"""
+    mentions = ALLERGY_MENTION.findall(text) + [allergy.lower() for allergy in allergies]
+    excluded = {
+        drug_name for drug_name, names in DRUG_NAMES.items()
+        if any(name in mention for mention in mentions for name in names)
+    }
+    if any(caution in text for caution in NSAID_CAUTIONS):
+        excluded.update((IBUPROFEN["drug_name"], NAPROXEN["drug_name"]))
+    return excluded
+
+
+class FallbackDiagnosisEngine:
+    """Rule-based diagnosis used when the LLM is unavailable or overloaded.
+
+    Matching is a whole-word keyword lookup over the user's messages, so a
+    diagnosis takes well under a millisecond. Results use the normal diagnosis format and
+    are marked ``"preliminary": True``.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else RULES
+        self._patterns = [[_keyword_pattern(keyword) for keyword in rule["keywords"]] for rule in self.rules]
+
+    def _user_text(self, conversation_history: List[Dict[str, str]]) -> str:
+        text = " ".join(msg.get("content", "") for msg in conversation_history if msg.get("role") == "user")
+        return re.sub(r"\s+", " ", text.lower())
+
+    def diagnose(self, conversation_history: List[Dict[str, str]], allergies: Iterable[str] = ()) -> Dict[str, Any]:
+        """Return a preliminary diagnosis dict for the conversation.
+
+        ``allergies`` are known from the patient's record; allergies mentioned
+        in the conversation are found in the text.
+        """
+        text = self._user_text(conversation_history)
+
+        if any(flag in text for flag in RED_FLAGS):
+            return {
+                "diagnosis": PRELIMINARY_PREFIX + "Your symptoms may need prompt medical attention.",
+                "prescriptions": [],
+                "follow_up_recommendations": "Please contact a doctor or emergency services promptly. We can't recommend medication for these symptoms without a clinician's review.",
+                "preliminary": True,
+            }
+
+        best_rule, best_hits = None, 0
+        for rule, patterns in zip(self.rules, self._patterns):
+            hits = sum(
+                1 for pattern in patterns
+                if any(not _negated(text, match.start()) for match in pattern.finditer(text))
+            )
+            if hits > best_hits:
+                best_rule, best_hits = rule, hits
+
+        if best_rule is None:
+            return {
+                "diagnosis": PRELIMINARY_PREFIX + "We couldn't identify your condition from the information shared.",
+                "prescriptions": [],
+                "follow_up_recommendations": "Please try again shortly or speak with a pharmacist.",
+                "preliminary": True,
+            }
+
+        excluded = contraindicated_drugs(text, allergies)
+        prescriptions = [dict(rx) for rx in best_rule["prescriptions"] if rx["drug_name"] not in excluded]
+        # Acetaminophen stands in for NSAIDs the patient can't take, unless it is ruled out too
+        dropped_nsaid = any(rx["drug_name"] in excluded for rx in best_rule["prescriptions"]
+                            if rx["drug_name"] in (IBUPROFEN["drug_name"], NAPROXEN["drug_name"]))
+        if not prescriptions and dropped_nsaid and ACETAMINOPHEN["drug_name"] not in excluded:
+            prescriptions = [dict(ACETAMINOPHEN)]
+
+        if not prescriptions:
+            return {
+                "diagnosis": PRELIMINARY_PREFIX + best_rule["diagnosis"],
+                "prescriptions": [],
+                "follow_up_recommendations": "The usual over-the-counter options conflict with the allergies or conditions on record. Please speak with a pharmacist before taking any medication.",
+                "preliminary": True,
+            }
+
+        return {
+            "diagnosis": PRELIMINARY_PREFIX + best_rule["diagnosis"],
+            "prescriptions": prescriptions,
+            "follow_up_recommendations": FOLLOW_UP,
+            "preliminary": True,
+        }
@@ -0,0 +1,112 @@
+import random
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from memory_report import deep_sizeof
+
+# Words that carry no clinical signal in an opening complaint
+FILLER_WORDS = {
+    "i", "im", "ive", "a", "an", "the", "my", "have", "has", "got", "been",
+    "am", "is", "its", "having", "really", "very", "so", "hi", "hello", "hey",
+    "please", "help", "me", "some", "kind", "of", "bit", "little",
+}
+
+
+def normalize_complaint(text: str) -> str:
+    """Normalize an opening complaint into a stable cache key"""
+    text = text.lower().replace("'", "")
+    tokens = re.findall(r"[a-z0-9]+", text)
+    return " ".join(token for token in tokens if token not in FILLER_WORDS)
+
+
+def lexical_similarity(a: str, b: str) -> float:
+    """Jaccard similarity of the token sets of two normalized complaints"""
+    tokens_a = set(a.split())
+    tokens_b = set(b.split())
+    if not tokens_a or not tokens_b:
+        return 0.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+
+class GreetingCache:
+    """Bounded cache of first-turn greeting responses keyed on normalized complaints.
+
+    Each complaint cluster collects up to ``variants_per_entry`` distinct LLM
+    replies before it starts serving hits, and hits pick one of those variants
+    at random so repeated openings don't all get the same wording.
+    """
+
+    def __init__(self, max_entries=256, variants_per_entry=3, similarity_threshold=0.75, max_tokens=12):
+        self.max_entries = max_entries
+        self.variants_per_entry = variants_per_entry
+        self.similarity_threshold = similarity_threshold
+        self.max_tokens = max_tokens
+        self._entries: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _find_key(self, key: str) -> Optional[str]:
+        """Find the cluster for a key, exactly or by lexical similarity"""
+        if key in self._entries:
+            return key
+        best_key, best_score = None, 0.0
+        for candidate in self._entries:
+            score = lexical_similarity(key, candidate)
+            if score > best_score:
+                best_key, best_score = candidate, score
+        if best_score >= self.similarity_threshold:
+            return best_key
+        return None
+
+    def _cacheable_key(self, message: str) -> Optional[str]:
+        """Return the cache key for a message, or None if it is too long or empty to cache"""
+        key = normalize_complaint(message)
+        if not key or len(key.split()) > self.max_tokens:
+            return None
+        return key
+
+    def get(self, message: str) -> Optional[str]:
+        """Return a cached greeting for this opening message, or None on a miss"""
+        key = self._cacheable_key(message)
+        with self._lock:
+            cluster = self._find_key(key) if key else None
+            variants = self._entries.get(cluster) if cluster else None
+            if variants and len(variants) >= self.variants_per_entry:
+                self._entries.move_to_end(cluster)
+                self.hits += 1
+                return random.choice(variants)
+            self.misses += 1
+            return None
+
+    def put(self, message: str, response: str):
+        """Record an LLM greeting as a variant for this message's complaint cluster"""
+        key = self._cacheable_key(message)
+        if not key or not response:
+            return
+        with self._lock:
+            cluster = self._find_key(key) or key
+            variants = self._entries.setdefault(cluster, [])
+            self._entries.move_to_end(cluster)
+            if response not in variants and len(variants) < self.variants_per_entry:
+                variants.append(response)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by cached greetings"""
+        with self._lock:
+            return deep_sizeof(self._entries)
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit/miss counters and the hit rate"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,113 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+from memory_report import deep_sizeof
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an idempotency key is reused for a different request"""
+
+
+class Waiters:
+    """The HTTP requests waiting on one in-flight call.
+
+    Handed to the call in place of its own request: ``is_disconnected`` is
+    True only once every waiting client has gone away, so a retry keeps the
+    upstream call alive after the original client disconnected.
+    """
+
+    def __init__(self):
+        self.requests: List[Any] = []
+
+    def add(self, request):
+        if request is not None:
+            self.requests.append(request)
+
+    async def is_disconnected(self) -> bool:
+        for request in self.requests:
+            if not await request.is_disconnected():
+                return False
+        return bool(self.requests)
+
+
+class ReplayCache:
+    """Responses to requests carrying an idempotency key, replayed for retries.
+
+    Keys are scoped per user. The first request with a key runs its call as
+    a task of its own; duplicates that arrive while it runs await the same
+    task, and later ones get the stored result for ``ttl`` seconds (at most
+    ``max_entries`` keys, least recently used evicted). Only successful
+    results (dicts) are stored, so a call that failed or was cancelled can
+    be retried with the same key. Reusing a key for a request with a
+    different fingerprint raises IdempotencyConflict.
+    """
+
+    def __init__(self, ttl=600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._results: "OrderedDict[Tuple[str, str], Tuple[float, Hashable, Dict[str, Any]]]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str], Tuple[Hashable, "asyncio.Task", Waiters]] = {}
+        self.calls = 0
+        self.replayed = 0
+        self.joined = 0
+        self.conflicts = 0
+
+    async def run(self, user_id: str, key: str, fingerprint: Hashable,
+                  call: Callable[[Waiters], Awaitable[Any]], request=None) -> Tuple[Any, bool]:
+        """Return (result, replayed), running ``call(waiters)`` only for the first request with this key"""
+        cache_key = (user_id, key)
+        entry = self._results.get(cache_key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self._results[cache_key]
+            entry = None
+        if entry is not None:
+            self._check(fingerprint, entry[1])
+            self._results.move_to_end(cache_key)
+            self.replayed += 1
+            return entry[2], True
+
+        inflight = self._inflight.get(cache_key)
+        replayed = inflight is not None
+        if replayed:
+            self._check(fingerprint, inflight[0])
+            self.joined += 1
+        else:
+            waiters = Waiters()
+            task = asyncio.ensure_future(call(waiters))
+            inflight = (fingerprint, task, waiters)
+            self._inflight[cache_key] = inflight
+            task.add_done_callback(lambda done: self._store(cache_key, fingerprint, done))
+            self.calls += 1
+        inflight[2].add(request)
+        return await asyncio.shield(inflight[1]), replayed
+
+    def _check(self, fingerprint: Hashable, original: Hashable):
+        if fingerprint != original:
+            self.conflicts += 1
+            raise IdempotencyConflict("Idempotency key was already used for a different request")
+
+    def _store(self, cache_key: Tuple[str, str], fingerprint: Hashable, task: "asyncio.Task"):
+        self._inflight.pop(cache_key, None)
+        if task.cancelled() or task.exception() is not None or not isinstance(task.result(), dict):
+            return
+        self._results[cache_key] = (time.monotonic() + self.ttl, fingerprint, task.result())
+        self._results.move_to_end(cache_key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by stored responses"""
+        return deep_sizeof(self._results)
+
+    def stats(self) -> Dict[str, int]:
+        """Return counters for the metrics endpoint"""
+        return {
+            "keys": len(self._results),
+            "in_flight": len(self._inflight),
+            "calls": self.calls,
+            "replayed": self.replayed,
+            "joined": self.joined,
+            "conflicts": self.conflicts,
+        }
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+from db_pool import PoolExhausted
+from memory_report import deep_sizeof
+
+CONTEXT_HEADER = (
+    "Patient record on file from the pharmacy account. Take it into account and do not ask "
+    "the patient again for details already listed here:"
+)
+
+# Prisma's table and column names (quoted because they are camelCase)
+HISTORY_QUERY = (
+    'SELECT u.id, mh."diagnosedWith", mh.medications, mh.allergies '
+    'FROM "User" u LEFT JOIN "MedicalHistory" mh ON mh."userId" = u.id '
+    'WHERE u.id = %s OR u."clerkId" = %s LIMIT 1'
+)
+PRESCRIPTIONS_QUERY = (
+    'SELECT medication, dosage, frequency, "endDate" FROM "Prescription" '
+    "WHERE \"userId\" = %s AND status = 'ACTIVE' ORDER BY \"prescribedAt\" DESC LIMIT 10"
+)
+
+
+def _as_list(value: Any) -> List[str]:
+    """Postgres arrays arrive as lists; JSON text is accepted for SQLite stand-ins"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return [value]
+    return [str(item) for item in value if item]
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def build_context_block(record: Dict[str, List[str]], token_budget: int) -> str:
+    """Render a medical record as a compact prompt block of at most ``token_budget`` tokens.
+
+    Sections are added in order of clinical importance; when one doesn't fit,
+    its remaining items are summarized as "+N more" and later sections are dropped.
+    """
+    sections = [
+        ("Allergies", record.get("allergies", [])),
+        ("Current medications", record.get("medications", [])),
+        ("Active prescriptions", record.get("prescriptions", [])),
+        ("Previously diagnosed with", record.get("diagnosed_with", [])),
+    ]
+    lines = [CONTEXT_HEADER]
+    used = _estimate_tokens(CONTEXT_HEADER)
+    for label, items in sections:
+        if not items:
+            continue
+        line = f"- {label}:"
+        included = 0
+        for item in items:
+            candidate = f"{line}{',' if included else ''} {item}"
+            if used + _estimate_tokens(candidate) > token_budget:
+                break
+            line, included = candidate, included + 1
+        if included == 0:
+            break
+        if included < len(items):
+            line += f" (+{len(items) - included} more)"
+        lines.append(line)
+        used += _estimate_tokens(line)
+        if included < len(items):
+            break
+    return "\n".join(lines) if len(lines) > 1 else ""
+
+
+class MedicalContextStore:
+    """Per-user medical-history prompt blocks read from the app's Postgres database.
+
+    Queries go through a thread-safe connection pool (``getconn``/``putconn``,
+    e.g. db_pool.LazyConnectionPool) on worker threads, so the event loop
+    never blocks on the database. Blocks are cached for ``ttl`` seconds, at
+    most ``max_entries`` users (least recently used are evicted);
+    users without a record are cached too, as an empty block, and failed
+    lookups for ``error_ttl`` seconds so an unreachable database doesn't
+    delay every request. A lookup that only failed because every pooled
+    connection was busy is not cached; the next request queries again. Concurrent lookups for the same user share one
+    query, and ``invalidate`` drops a user's block, including one still
+    being fetched.
+    """
+
+    def __init__(self, pool, ttl=300, max_entries=10000, token_budget=150, error_ttl=30):
+        self.pool = pool
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_entries = max_entries
+        self.token_budget = token_budget
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Tuple[float, str, List[str]]]" = OrderedDict()
+        self._inflight: Dict[str, "asyncio.Future"] = {}
+        self._stale = set()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.invalidations = 0
+
+    def fetch_record(self, user_id: str) -> Dict[str, List[str]]:
+        """Query the medical history and active prescriptions for a user (blocking)"""
+        pool = self.pool
+        conn = pool.getconn()
+        try:
+            with conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(HISTORY_QUERY, (user_id, user_id))
+                    row = cursor.fetchone()
+                    if row is None:
+                        return {}
+                    db_user_id, diagnosed_with, medications, allergies = row
+                    cursor.execute(PRESCRIPTIONS_QUERY, (db_user_id,))
+                    prescriptions = []
+                    for medication, dosage, frequency, end_date in cursor.fetchall():
+                        until = f" until {str(end_date)[:10]}" if end_date else ""
+                        prescriptions.append(f"{medication} {dosage}, {frequency}{until}")
+                finally:
+                    cursor.close()
+        finally:
+            pool.putconn(conn)
+        return {
+            "allergies": _as_list(allergies),
+            "medications": _as_list(medications),
+            "prescriptions": prescriptions,
+            "diagnosed_with": _as_list(diagnosed_with),
+        }
+
+    def _load(self, user_id: str) -> Tuple[str, List[str]]:
+        record = self.fetch_record(user_id)
+        return build_context_block(record, self.token_budget), record.get("allergies", [])
+
+    async def get(self, user_id: str) -> str:
+        """Return the user's context block, or "" if there is none or the database is unavailable"""
+        return (await self._lookup(user_id))[0]
+
+    async def get_allergies(self, user_id: str) -> List[str]:
+        """Return all of the user's recorded allergies, which the context block may truncate"""
+        return (await self._lookup(user_id))[1]
+
+    async def _lookup(self, user_id: str) -> Tuple[str, List[str]]:
+        with self._lock:
+            entry = self._cache.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(user_id)
+                self.hits += 1
+                return entry[1:]
+            pending = self._inflight.get(user_id)
+            if pending is None:
+                self.misses += 1
+                pending = asyncio.ensure_future(asyncio.to_thread(self._load, user_id))
+                self._inflight[user_id] = pending
+                pending.add_done_callback(lambda task: self._store(user_id, task))
+        try:
+            return await asyncio.shield(pending)
+        except Exception as e:
+            print(f"Medical context lookup failed for user {user_id}: {str(e)}")
+            return "", []
+
+    def _store(self, user_id: str, task: "asyncio.Future"):
+        with self._lock:
+            self._inflight.pop(user_id, None)
+            stale = user_id in self._stale
+            self._stale.discard(user_id)
+            failed = task.cancelled() or task.exception() is not None
+            if failed:
+                self.errors += 1
+            if stale or (not task.cancelled() and isinstance(task.exception(), PoolExhausted)):
+                return
+            if failed:
+                self._cache[user_id] = (time.monotonic() + self.error_ttl, "", [])
+            else:
+                self._cache[user_id] = (time.monotonic() + self.ttl, *task.result())
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        """Forget a user's block after their history or prescriptions change"""
+        with self._lock:
+            self._cache.pop(user_id, None)
+            if user_id in self._inflight:
+                self._stale.add(user_id)
+            self.invalidations += 1
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by cached patient records"""
+        with self._lock:
+            return deep_sizeof(self._cache)
+
+    def stats(self) -> Dict[str, int]:
+        """Return counters for the metrics endpoint"""
+        with self._lock:
+            return {
+                "cached_users": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,141 @@
+import os
+import sys
+import tracemalloc
+from collections import deque
+from typing import Any, Dict, Optional, Set
+
+_CONTAINERS = (list, tuple, set, frozenset, deque)
+
+
+def deep_sizeof(obj: Any, seen: Optional[Set[int]] = None) -> int:
+    """Approximate bytes held by ``obj`` and the containers and strings it references.
+
+    Walks dicts, lists, tuples, sets, deques and ``__slots__`` objects;
+    objects with an ``nbytes`` method report their own size and anything
+    else (tasks, locks, clients) counts as its shallow size only. Pass the
+    same ``seen`` set across calls so shared objects are counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return sys.getsizeof(obj)
+    nbytes = getattr(obj, "nbytes", None)
+    if callable(nbytes):
+        return nbytes()
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, _CONTAINERS):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    else:
+        for slot in getattr(type(obj), "__slots__", ()):
+            size += deep_sizeof(getattr(obj, slot, None), seen)
+    return size
+
+
+def process_memory() -> Dict[str, Optional[int]]:
+    """Resident and peak resident bytes of this process (None where the platform doesn't report it)"""
+    rss = None
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = None
+    try:
+        import resource
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+    return {"rss": rss, "peak_rss": peak}
+
+
+class TracemallocDiff:
+    """Allocation growth between consecutive calls, from tracemalloc snapshots.
+
+    The first ``diff`` starts tracing and records a baseline; each later one
+    returns the ``limit`` source lines whose allocations grew the most since
+    the previous call and becomes the new baseline. Tracing slows every
+    allocation down, so ``stop`` it once done.
+    """
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self._previous: Optional[tracemalloc.Snapshot] = None
+
+    def diff(self, limit=20) -> Dict[str, Any]:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._previous = None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        previous, self._previous = self._previous, snapshot
+        traced, peak = tracemalloc.get_traced_memory()
+        result: Dict[str, Any] = {"traced": traced, "traced_peak": peak}
+        if previous is None:
+            result["top"] = []
+            result["note"] = "Tracing started; call again for the allocations made since this call"
+            return result
+        result["top"] = [
+            {
+                "location": str(stat.traceback[0]),
+                "size": stat.size,
+                "size_diff": stat.size_diff,
+                "count": stat.count,
+                "count_diff": stat.count_diff,
+            }
+            for stat in snapshot.compare_to(previous, "lineno")[:limit]
+        ]
+        return result
+
+    def stop(self) -> bool:
+        """Stop tracing; returns whether it was running"""
+        self._previous = None
+        if not tracemalloc.is_tracing():
+            return False
+        tracemalloc.stop()
+        return True
+
+
+class InflightCounter:
+    """In-progress HTTP requests and their declared body bytes, kept by InflightRequests"""
+
+    def __init__(self):
+        self.requests = 0
+        self.body_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"requests": self.requests, "body_bytes": self.body_bytes}
+
+
+class InflightRequests:
+    """ASGI middleware that keeps ``counter`` up to date at the cost of one header scan per request"""
+
+    def __init__(self, app, counter: InflightCounter):
+        self.app = app
+        self.counter = counter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        body_bytes = 0
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit():
+                body_bytes = int(value)
+        counter = self.counter
+        counter.requests += 1
+        counter.body_bytes += body_bytes
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            counter.requests -= 1
+            counter.body_bytes -= body_bytes
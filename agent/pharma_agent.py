@@ -1,55 +1,151 @@
 import os
 import json
+import random
 import re
-from openai import OpenAI
+import time
+import inspect
+from types import SimpleNamespace
+from usage_tracker import TokenBudgetExceeded
+from request_body import decode_messages, encode_request_body
+from tracing import NOOP_SPAN, current_span, span
+
+
+class RequestCancelled(Exception):
+    """Raised when an in-flight completion is aborted through the agent's cancel_event"""
+    def __init__(self, tokens_saved=0):
+        super().__init__("Request cancelled before the completion finished")
+        # Upper-bound estimate: the max_tokens reservation minus the chunks already received
+        self.tokens_saved = max(tokens_saved, 0)
+
+
+def _usage_counts(usage):
+    """Return (prompt_tokens, completion_tokens) from a usage object or dict, or (None, None)"""
+    if usage is None:
+        return None, None
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0
+
+
+_raw_body_support = {}
+
+
+def _accepts_raw_body(client):
+    """Whether the client can post a pre-encoded request body (openai's ``post(..., content=...)``)"""
+    client_type = type(client)
+    if client_type not in _raw_body_support:
+        post = getattr(client, "post", None)
+        try:
+            _raw_body_support[client_type] = post is not None and "content" in inspect.signature(post).parameters
+        except (TypeError, ValueError):
+            _raw_body_support[client_type] = False
+    return _raw_body_support[client_type]
+
+
+# Default replies for turns that only hand the conversation over to the diagnosis, used
+# instead of a completion when the agent is given transition_templates
+TRANSITION_TEMPLATES = {
+    "completion": [
+        "Thank you for sharing all of that. I'll prepare your diagnosis and prescription based on the information you've shared.",
+    ],
+    "on_demand": [
+        "Understood. I'll prepare a preliminary diagnosis based on the information you've shared so far. The system will generate it now.",
+    ],
+}
+
+
+def conversation_transition(message):
+    """Return "completion" when the user has nothing more to add, "on_demand" when they ask for a diagnosis, else None"""
+    text = message.lower() if message else ""
+    if text == "no" or "no more" in text or "that's all" in text:
+        return "completion"
+    if "diagnose me" in text or "need a diagnosis" in text:
+        return "on_demand"
+    return None
+
+
+def repair_raw_diagnosis(diagnosis):
+    """Second parsing attempt on the raw reply of a diagnosis the agent couldn't parse.
+
+    /api/diagnose runs this on every generated diagnosis; it returns the
+    recovered diagnosis, or ``diagnosis`` unchanged when there is no raw reply
+    or it still doesn't parse.
+    """
+    if "raw_response" not in diagnosis:
+        return diagnosis
+    with span("diagnosis.repair", repaired=False) as repair:
+        try:
+            raw_response = diagnosis["raw_response"]
+            print(f"Attempting to parse raw response: {raw_response[:200]}...")
+        
+            # Try to extract JSON using regex
+            json_match = re.search(r'```(?:json)?(.*?)```|(\{.*\})', raw_response, re.DOTALL)
+        
+            if json_match:
+                # Get the matched content
+                json_str = json_match.group(1) if json_match.group(1) else json_match.group(2)
+                json_str = json_str.strip()
+            
+                # Clean up JSON
+                json_str = re.sub(r',(\s*[\]}])', r'\1', json_str)  # Fix trailing commas
+                json_str = re.sub(r'(\{|\,)\s*([a-zA-Z0-9_]+)\s*:', r'\1"\2":', json_str)  # Fix unquoted keys
+            
+                # Parse JSON
+                parsed_diagnosis = json.loads(json_str)
+            
+                print(f"Successfully parsed raw JSON response: {parsed_diagnosis}")
+                repair.set(repaired=True)
+                diagnosis = parsed_diagnosis
+            
+        except Exception as json_err:
+            print(f"Failed to parse raw response: {str(json_err)}")
+    return diagnosis
+
 
 class PharmacistAgent:
-    def __init__(self, api_key=None, model="llama3-8b-8192"):
-        """Initialize the PharmacistAgent with API key and model"""
+    def __init__(self, api_key=None, model="llama3-8b-8192", greeting_cache=None, validate=True,
+                 transition_templates=None):
+        """Initialize the PharmacistAgent with API key and model
+
+        Args:
+            greeting_cache (GreetingCache, optional): Shared cache for first-turn greetings.
+                When provided, near-identical opening complaints skip the LLM call.
+            transition_templates (dict, optional): Replies per transition ("completion",
+                "on_demand"). When provided, those turns are answered from a template
+                instead of a completion.
+            validate (bool): Check the API key and list models on construction.
+                Servers pass False and call validate_connection() in the background.
+        """
         # Hard-code API parameters that are known to work
         self.api_key = api_key or "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"
         self.base_url = "https://api.groq.com/openai/v1"
         
         self.model = model
-        self.client = OpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url
-        )
+        self.greeting_cache = greeting_cache
+        self.transition_templates = transition_templates
+        self._client = None
+        # Set to a threading.Event to make completions abortable (e.g. on client disconnect)
+        self.cancel_event = None
+        # Optional callable receiving each piece of content as it streams in; makes completions stream
+        self.on_delta = None
+        # Optional UsageTracker recording tokens per call type and per user_id
+        self.usage_tracker = None
+        self.user_id = None
+        # Optional AdaptiveTokenCaps lowering max_tokens to observed output lengths
+        self.token_caps = None
+        # Optional patient record block (allergies, medications...) added to every prompt
+        self.medical_context = None
+        # Optional SymptomRecord summary; when set and the session is longer than
+        # recent_messages turns, diagnosis prompts send it plus those last turns
+        # instead of the whole transcript
+        self.clinical_record = None
+        self.recent_messages = 6
+        # Optional EncodedMessages snapshot of the history; when set, prompts are
+        # spliced into its pre-encoded JSON instead of copying conversation_history
+        self.encoded_history = None
         
-        # Check if API key is valid
-        try:
-            print(f"Validating Groq API key with model {self.model}...")
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": "Hello"}],
-                max_tokens=10
-            )
-            if response and response.choices and response.choices[0].message.content:
-                print("✅ Groq API key validation successful")
-                # Add details about available models
-                try:
-                    models = self.client.models.list()
-                    print(f"Available models: {[model.id for model in models.data]}")
-                except Exception as model_err:
-                    print(f"Could not retrieve model list: {str(model_err)}")
-            else:
-                print("⚠️ API key validation returned empty response")
-        except Exception as e:
-            # More detailed error message based on error type
-            if "401" in str(e):
-                print(f"⚠️ API key authentication failed: Invalid API key or unauthorized access")
-                print(f"Details: {str(e)}")
-                print("Please check your Groq API key and ensure it's valid")
-            elif "404" in str(e):
-                print(f"⚠️ API endpoint not found: {str(e)}")
-                print(f"Please check that the model '{self.model}' exists and is available")
-            elif "429" in str(e):
-                print(f"⚠️ API rate limit exceeded: {str(e)}")
-                print("You may need to wait before making more requests")
-            else:
-                print(f"⚠️ API key validation failed: {str(e)}")
-            
-            print("Will attempt to proceed anyway, but API calls may fail")
+        if validate:
+            self.validate_connection()
         
         self.conversation_history = []
         
@@ -100,6 +196,207 @@ IMPORTANT: Never say "I'm not a doctor" or that you can't recommend medications.
             """
         })
         
+    @property
+    def client(self):
+        """OpenAI client, created on first use so importing this module stays cheap"""
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url
+            )
+        return self._client
+    
+    @client.setter
+    def client(self, client):
+        self._client = client
+    
+    def _with_medical_context(self, messages):
+        """Return messages with the patient's record inserted after the leading system prompt"""
+        if not self.medical_context:
+            return messages
+        return messages[:1] + [{"role": "system", "content": self.medical_context}] + messages[1:]
+    
+    def _prompt_messages(self, after_first=(), after=()):
+        """Return the history with per-call system prompts added after the first message and at the end.
+
+        Returns JSON-encoded bytes when encoded_history is set, a list otherwise.
+        """
+        with span("prompt.build", encoded=self.encoded_history is not None):
+            if self.medical_context:
+                after_first = [{"role": "system", "content": self.medical_context}, *after_first]
+            if self.encoded_history is not None:
+                return self.encoded_history.spliced(after_first, after)
+            # One copy of the history, however long it is
+            messages = self.conversation_history.copy()
+            messages[1:1] = after_first
+            messages.extend(after)
+            return messages
+    
+    def _create_completion(self, call_type, **kwargs):
+        """Create a chat completion, recording its token usage under ``call_type``.
+
+        The user's token budget is checked before the call is issued. With
+        token_caps attached, max_tokens is lowered to the cap learned for the
+        call type and a reply truncated by that cap is retried once at the
+        original max_tokens.
+        """
+        default_max_tokens = kwargs.get("max_tokens")
+        if self.token_caps is not None and default_max_tokens:
+            kwargs["max_tokens"] = self.token_caps.cap(call_type, default_max_tokens)
+        
+        attempt = 0
+        while True:
+            if self.usage_tracker is not None:
+                self.usage_tracker.check_budget(self.user_id)
+            
+            attempt += 1
+            with span("upstream.completion", call_type=call_type, attempt=attempt, model=kwargs.get("model"),
+                      max_tokens=kwargs.get("max_tokens")) as upstream:
+                started = time.perf_counter()
+                response = self._request_completion(**kwargs)
+                latency = time.perf_counter() - started
+                # Token counts are only worked out when the usage tracker, a sampled span or the
+                # token caps use them; the prompt is only measured for the first two
+                recording = self.usage_tracker is not None or upstream is not NOOP_SPAN
+                if recording or self.token_caps is not None:
+                    prompt_tokens, completion_tokens = _usage_counts(response.usage)
+                    estimated = prompt_tokens is None
+                    if estimated:
+                        # No usage reported (e.g. some streamed responses): estimate ~4 characters per token
+                        completion_tokens = len(response.choices[0].message.content or "") // 4
+                        if recording:
+                            messages = kwargs.get("messages", [])
+                            prompt_chars = len(messages) if isinstance(messages, bytes) else sum(len(msg["content"]) for msg in messages)
+                            prompt_tokens = prompt_chars // 4
+                    upstream.set(finish_reason=response.choices[0].finish_reason, prompt_tokens=prompt_tokens,
+                                 completion_tokens=completion_tokens, estimated_tokens=estimated)
+            
+            if self.usage_tracker is not None:
+                self.usage_tracker.record(call_type, self.user_id, prompt_tokens, completion_tokens, latency)
+            
+            if self.token_caps is not None and default_max_tokens:
+                truncated = response.choices[0].finish_reason == "length"
+                if truncated and kwargs["max_tokens"] < default_max_tokens:
+                    print(f"{call_type} reply hit the learned cap of {kwargs['max_tokens']} tokens, retrying with {default_max_tokens}")
+                    self.token_caps.record_truncation(call_type)
+                    kwargs["max_tokens"] = default_max_tokens
+                    continue
+                if not truncated:
+                    self.token_caps.observe(call_type, completion_tokens)
+            return response
+    
+    def _request_completion(self, **kwargs):
+        """Issue the completion request, streaming it when a cancel_event or on_delta is attached.
+
+        Streaming lets a cancelled call stop reading and close the upstream
+        connection instead of waiting for the full generation. The streamed
+        result is returned in the same shape as a regular completion.
+        Pre-encoded ``messages`` bytes are posted as-is when the client
+        supports raw bodies and decoded back into a list otherwise.
+        """
+        raw_body = isinstance(kwargs.get("messages"), bytes)
+        if raw_body and not _accepts_raw_body(self.client):
+            kwargs["messages"] = decode_messages(kwargs["messages"])
+            raw_body = False
+        
+        if self.cancel_event is None and self.on_delta is None:
+            if raw_body:
+                return self._post_raw(kwargs)
+            return self.client.chat.completions.create(**kwargs)
+        
+        max_tokens = kwargs.get("max_tokens", 0)
+        cancelled = self.cancel_event.is_set if self.cancel_event is not None else (lambda: False)
+        if cancelled():
+            raise RequestCancelled(max_tokens)
+        
+        if raw_body:
+            stream = self._post_raw(kwargs, stream=True)
+        else:
+            stream = self.client.chat.completions.create(stream=True, **kwargs)
+        parts = []
+        finish_reason = None
+        usage = None
+        try:
+            for chunk in stream:
+                if cancelled():
+                    raise RequestCancelled(max_tokens - len(parts))
+                if chunk.choices:
+                    choice = chunk.choices[0]
+                    if choice.delta and choice.delta.content:
+                        parts.append(choice.delta.content)
+                        if self.on_delta is not None:
+                            self.on_delta(choice.delta.content)
+                    finish_reason = choice.finish_reason or finish_reason
+                # Groq reports usage for streams in the final chunk's x_groq field
+                x_groq = getattr(chunk, "x_groq", None)
+                if isinstance(x_groq, dict) and x_groq.get("usage"):
+                    usage = x_groq["usage"]
+                usage = getattr(chunk, "usage", None) or usage
+        finally:
+            stream.close()
+        
+        message = SimpleNamespace(role="assistant", content="".join(parts))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=message, finish_reason=finish_reason)],
+            usage=usage
+        )
+    
+    def _post_raw(self, kwargs, stream=False):
+        """POST /chat/completions with the encoded messages spliced into the body, skipping re-serialization"""
+        from openai import Stream
+        from openai.types.chat import ChatCompletion, ChatCompletionChunk
+        params = {key: value for key, value in kwargs.items() if key != "messages"}
+        if stream:
+            params["stream"] = True
+        return self.client.post(
+            "/chat/completions",
+            cast_to=ChatCompletion,
+            content=encode_request_body(params, kwargs["messages"]),
+            stream=stream,
+            stream_cls=Stream[ChatCompletionChunk] if stream else None,
+        )
+    
+    def validate_connection(self):
+        """Check that the API key works and return a status dict"""
+        try:
+            print(f"Validating Groq API key with model {self.model}...")
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": "Hello"}],
+                max_tokens=10
+            )
+            if response and response.choices and response.choices[0].message.content:
+                print("✅ Groq API key validation successful")
+                # Add details about available models
+                models = []
+                try:
+                    models = [model.id for model in self.client.models.list().data]
+                    print(f"Available models: {models}")
+                except Exception as model_err:
+                    print(f"Could not retrieve model list: {str(model_err)}")
+                return {"ok": True, "detail": "API key validated", "models": models}
+            else:
+                print("⚠️ API key validation returned empty response")
+                return {"ok": False, "detail": "API key validation returned empty response"}
+        except Exception as e:
+            # More detailed error message based on error type
+            if "401" in str(e):
+                print(f"⚠️ API key authentication failed: Invalid API key or unauthorized access")
+                print(f"Details: {str(e)}")
+                print("Please check your Groq API key and ensure it's valid")
+            elif "404" in str(e):
+                print(f"⚠️ API endpoint not found: {str(e)}")
+                print(f"Please check that the model '{self.model}' exists and is available")
+            elif "429" in str(e):
+                print(f"⚠️ API rate limit exceeded: {str(e)}")
+                print("You may need to wait before making more requests")
+            else:
+                print(f"⚠️ API key validation failed: {str(e)}")
+            
+            print("Will attempt to proceed anyway, but API calls may fail")
+            return {"ok": False, "detail": str(e)}
+        
     def _print_agent_info(self):
         """Print agent information"""
         print("╭─ PharmaAI Agent " + "─" * 60 + "╮")
@@ -115,42 +412,77 @@ IMPORTANT: Never say "I'm not a doctor" or that you can't recommend medications.
         """Get response from LLM based on conversation history"""
         print(f"Making API call to {self.model}...")
         
+        if self.encoded_history is not None:
+            message_count = self.encoded_history.count
+            first_message = self.encoded_history.first_message
+            last_user_content = self.encoded_history.last_user_message
+        else:
+            message_count = len(self.conversation_history)
+            first_message = self.conversation_history[1]["content"] if message_count > 1 else None
+            last_user_message = next((m for m in reversed(self.conversation_history) if m["role"] == "user"), None)
+            last_user_content = last_user_message["content"] if last_user_message else None
+        
         # If this is the first message, add a greeting instruction
-        if len(self.conversation_history) == 2:  # System prompt + first user message
+        if message_count == 2:  # System prompt + first user message
+            
+            # Serve a cached greeting for common opening complaints. Greetings written with a
+            # patient record may mention that patient's allergies or medications, so they bypass the cache.
+            greeting_cache = self.greeting_cache if not self.medical_context else None
+            if greeting_cache is not None:
+                cached_greeting = greeting_cache.get(first_message)
+                if cached_greeting:
+                    print("Serving first-turn greeting from cache")
+                    self.conversation_history.append({
+                        "role": "assistant",
+                        "content": cached_greeting
+                    })
+                    return cached_greeting
+            
             greeting_prompt = {
                 "role": "system",
                 "content": "This is the patient's first message. Start with a warm greeting and introduce yourself briefly. Then ask exactly TWO specific follow-up questions to better understand their condition."
             }
-            temp_history = self.conversation_history.copy()
-            temp_history.insert(1, greeting_prompt)
-            
-            response = self.client.chat.completions.create(
+            response = self._create_completion(
+                "greeting",
                 model=self.model,
-                messages=temp_history,
+                messages=self._prompt_messages(after_first=[greeting_prompt]),
                 temperature=0.4,
                 max_tokens=2000
             )
+            
+            if greeting_cache is not None:
+                greeting_cache.put(first_message, response.choices[0].message.content)
         else:
-            # Check if the user indicated they've shared everything
-            last_user_message = next((m for m in reversed(self.conversation_history) if m["role"] == "user"), None)
+            # Check if the user indicated they've shared everything or asked for a diagnosis
+            transition = conversation_transition(last_user_content)
+            
+            # These turns only hand over to the diagnosis, so a template reply can stand in for the LLM
+            if transition is not None and self.transition_templates:
+                print(f"Answering {transition} turn from a template")
+                assistant_message = random.choice(self.transition_templates[transition])
+                self.conversation_history.append({
+                    "role": "assistant",
+                    "content": assistant_message
+                })
+                return assistant_message
             
             # Handle standard conversation end
-            if last_user_message and (last_user_message["content"].lower() == "no" or "no more" in last_user_message["content"].lower() or "that's all" in last_user_message["content"].lower()):
+            if transition == "completion":
                 completion_prompt = {
                     "role": "system",
                     "content": "The user has indicated they have no more symptoms to share. Respond that you'll prepare their diagnosis and prescription based on the information they've shared. Do NOT generate the actual diagnosis yet."
                 }
-                temp_history = self.conversation_history.copy()
-                temp_history.append(completion_prompt)
+                hint = completion_prompt
+                call_type = "completion"
             
             # Handle on-demand diagnosis request
-            elif last_user_message and ("diagnose me" in last_user_message["content"].lower() or "need a diagnosis" in last_user_message["content"].lower()):
+            elif transition == "on_demand":
                 on_demand_prompt = {
                     "role": "system",
                     "content": "The user has requested an immediate diagnosis. Acknowledge their request and let them know you'll provide a preliminary assessment based on the information available so far. Tell them the system will generate a diagnosis."
                 }
-                temp_history = self.conversation_history.copy()
-                temp_history.append(on_demand_prompt)
+                hint = on_demand_prompt
+                call_type = "on_demand"
             
             else:
                 # Standard follow-up with two questions
@@ -166,13 +498,14 @@ IMPORTANT: Never say "I'm not a doctor" or that you can't recommend medications.
    - Allergies or current medications
    
 Remember: Ask EXACTLY ONE question - no more, no less. Format them clearly on separate lines."""
-            }
-            temp_history = self.conversation_history.copy()
-            temp_history.append(follow_up_prompt)
+                }
+                hint = follow_up_prompt
+                call_type = "follow_up"
             
-            response = self.client.chat.completions.create(
+            response = self._create_completion(
+                call_type,
                 model=self.model,
-                messages=temp_history,
+                messages=self._prompt_messages(after=[hint]),
                 temperature=0.4,
                 max_tokens=2000
             )
@@ -258,26 +591,37 @@ RULES:
 5. For multiple medications, add separate prescription objects in the array
 6. Never include brand names in parentheses in drug_name"""
         
-        # Prepare messages for LLM
-        messages = [
-            {"role": "system", "content": system_message}
-        ]
+        with span("prompt.build") as build:
+            # Prepare messages for LLM
+            messages = [
+                {"role": "system", "content": system_message}
+            ]
         
-        # Add all messages from the conversation history
-        messages.extend(conv_history)
+            turns = [msg for msg in conv_history if msg["role"] != "system"]
+            compact = bool(self.clinical_record) and len(turns) > self.recent_messages
+            if compact:
+                # Compact prompt: the extracted record stands in for the older turns
+                messages.extend(msg for msg in conv_history if msg["role"] == "system")
+                messages.append({"role": "system", "content": self.clinical_record})
+                messages.extend(turns[-self.recent_messages:])
+            else:
+                # Add all messages from the conversation history
+                messages.extend(conv_history)
         
-        # Add a final prompt to reinforce JSON format
-        messages.append({
-            "role": "system",
-            "content": "Remember to format your entire response as a valid JSON object with no text before or after."
-        })
+            # Add a final prompt to reinforce JSON format
+            messages.append({
+                "role": "system",
+                "content": "Remember to format your entire response as a valid JSON object with no text before or after."
+            })
+            build.set(messages=len(messages), compact=compact)
         
         # Make the API call
         try:
             print("Making API call for diagnosis generation...")
-            response = self.client.chat.completions.create(
-            model=self.model,
-                messages=messages,
+            response = self._create_completion(
+                "diagnosis",
+                model=self.model,
+                messages=self._with_medical_context(messages),
                 temperature=0.2,  # Lower temperature for more consistent JSON formatting
                 max_tokens=4000,
                 response_format={"type": "json_object"}  # Request JSON format if the model supports it
@@ -306,88 +650,102 @@ RULES:
                 
             print(f"Raw LLM response: {raw_response[:100]}...")
             
-            # Try to parse the response as JSON
+            with span("diagnosis.parse", chars=len(raw_response)):
+                return self._parse_diagnosis_response(raw_response)
+        except (RequestCancelled, TokenBudgetExceeded):
+            raise
+        except Exception as e:
+            print(f"Diagnosis generation error: {str(e)}")
+            return {
+                "error": str(e),
+                "diagnosis": "Unable to generate diagnosis due to an API error",
+                "prescriptions": [],
+                "follow_up_recommendations": "Please try again later"
+            }
+    
+    def _parse_diagnosis_response(self, raw_response):
+        """Parse the diagnosis JSON from a reply, repairing common formatting mistakes.
+
+        The parse path ("direct", "extracted" or "failed") is recorded on the current trace span.
+        """
+        # Try to parse the response as JSON
+        try:
+            # First try to parse the entire response as JSON directly
             try:
-                # First try to parse the entire response as JSON directly
-                try:
-                    diagnosis = json.loads(raw_response)
-                    print("Successfully parsed full response as JSON")
-                    
-                    # Validate the diagnosis structure
-                    if not self._validate_diagnosis_format(diagnosis):
-                        print("WARNING: Diagnosis has invalid format, applying fixes")
-                        diagnosis = self._fix_diagnosis_format(diagnosis)
+                diagnosis = json.loads(raw_response)
+                print("Successfully parsed full response as JSON")
+                current_span().set(path="direct")
+                
+                # Validate the diagnosis structure
+                if not self._validate_diagnosis_format(diagnosis):
+                    print("WARNING: Diagnosis has invalid format, applying fixes")
+                    diagnosis = self._fix_diagnosis_format(diagnosis)
+                
+                return diagnosis
+                
+            except json.JSONDecodeError:
+                # If direct parsing fails, try to extract JSON using regex
+                print("Direct JSON parsing failed, trying to extract JSON with regex")
+                current_span().set(path="failed")
+                
+                # Sometimes the LLM returns text before or after the JSON
+                # Try to extract just the JSON part using regex
+                json_match = re.search(r'```(?:json)?(.*?)```|(\{.*\})', raw_response, re.DOTALL)
+                
+                if json_match:
+                    # Extract the matched group, handling both code block and direct JSON cases
+                    json_str = json_match.group(1) if json_match.group(1) else json_match.group(2)
+                    json_str = json_str.strip()
                     
-                    return diagnosis
+                    # Fix common JSON issues
+                    # Remove any trailing commas before closing brackets
+                    json_str = re.sub(r',(\s*[\]}])', r'\1', json_str)
                     
-                except json.JSONDecodeError:
-                    # If direct parsing fails, try to extract JSON using regex
-                    print("Direct JSON parsing failed, trying to extract JSON with regex")
+                    # Fix missing quotes around keys
+                    json_str = re.sub(r'(\{|\,)\s*([a-zA-Z0-9_]+)\s*:', r'\1"\2":', json_str)
                     
-                    # Sometimes the LLM returns text before or after the JSON
-                    # Try to extract just the JSON part using regex
-                    json_match = re.search(r'```(?:json)?(.*?)```|(\{.*\})', raw_response, re.DOTALL)
+                    # Replace single quotes with double quotes
+                    json_str = json_str.replace("'", '"')
                     
-                    if json_match:
-                        # Extract the matched group, handling both code block and direct JSON cases
-                        json_str = json_match.group(1) if json_match.group(1) else json_match.group(2)
-                        json_str = json_str.strip()
-                        
-                        # Fix common JSON issues
-                        # Remove any trailing commas before closing brackets
-                        json_str = re.sub(r',(\s*[\]}])', r'\1', json_str)
-                        
-                        # Fix missing quotes around keys
-                        json_str = re.sub(r'(\{|\,)\s*([a-zA-Z0-9_]+)\s*:', r'\1"\2":', json_str)
-                        
-                        # Replace single quotes with double quotes
-                        json_str = json_str.replace("'", '"')
+                    try:
+                        diagnosis = json.loads(json_str)
+                        print(f"Successfully parsed extracted JSON: {diagnosis}")
+                        current_span().set(path="extracted")
                         
-                        try:
-                            diagnosis = json.loads(json_str)
-                            print(f"Successfully parsed extracted JSON: {diagnosis}")
+                        # Validate the diagnosis structure
+                        if not self._validate_diagnosis_format(diagnosis):
+                            print("WARNING: Extracted diagnosis has invalid format, applying fixes")
+                            diagnosis = self._fix_diagnosis_format(diagnosis)
                             
-                            # Validate the diagnosis structure
-                            if not self._validate_diagnosis_format(diagnosis):
-                                print("WARNING: Extracted diagnosis has invalid format, applying fixes")
-                                diagnosis = self._fix_diagnosis_format(diagnosis)
-                                
-                            return diagnosis
-                            
-                        except json.JSONDecodeError as e:
-                            print(f"JSON parsing error: {str(e)}")
-                            print(f"Problematic JSON string: {json_str}")
-                            # Return the raw response for debugging
-                            return {
-                                "error": f"Invalid JSON: {str(e)}",
-                                "diagnosis": "Unable to generate diagnosis due to a formatting error",
-                                "raw_response": raw_response,
-                                "prescriptions": [],
-                                "follow_up_recommendations": "Please try again later"
-                            }
-                else:
-                        print(f"No JSON object found in response: {raw_response}")
+                        return diagnosis
+                        
+                    except json.JSONDecodeError as e:
+                        print(f"JSON parsing error: {str(e)}")
+                        print(f"Problematic JSON string: {json_str}")
+                        # Return the raw response for debugging
                         return {
-                            "error": "No JSON object found in response",
+                            "error": f"Invalid JSON: {str(e)}",
                             "diagnosis": "Unable to generate diagnosis due to a formatting error",
                             "raw_response": raw_response,
                             "prescriptions": [],
                             "follow_up_recommendations": "Please try again later"
                         }
-            except Exception as e:
-                print(f"Diagnosis parsing error: {str(e)}")
-                return {
-                    "error": str(e),
-                    "diagnosis": "Unable to generate diagnosis due to a parsing error",
-                    "raw_response": raw_response,
-                    "prescriptions": [],
-                    "follow_up_recommendations": "Please try again later"
-                }
+                else:
+                    print(f"No JSON object found in response: {raw_response}")
+                    return {
+                        "error": "No JSON object found in response",
+                        "diagnosis": "Unable to generate diagnosis due to a formatting error",
+                        "raw_response": raw_response,
+                        "prescriptions": [],
+                        "follow_up_recommendations": "Please try again later"
+                    }
         except Exception as e:
-            print(f"Diagnosis generation error: {str(e)}")
+            print(f"Diagnosis parsing error: {str(e)}")
+            current_span().set(path="failed")
             return {
                 "error": str(e),
-                "diagnosis": "Unable to generate diagnosis due to an API error",
+                "diagnosis": "Unable to generate diagnosis due to a parsing error",
+                "raw_response": raw_response,
                 "prescriptions": [],
                 "follow_up_recommendations": "Please try again later"
             }
@@ -0,0 +1,160 @@
+import contextvars
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Callable, List, Optional
+
+from memory_report import deep_sizeof
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> Counter:
+    """Sample the stacks of every other thread for ``seconds``.
+
+    Returns a Counter of collapsed stacks ("thread;outer;...;inner") to
+    sample counts. Runs on the calling thread; nothing is installed in the
+    sampled threads, so their overhead is limited to the GIL handoffs.
+    """
+    me = threading.get_ident()
+    counts: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def collapsed_text(counts: Counter) -> str:
+    """Render sample counts in the collapsed-stack format read by flamegraph.pl and speedscope"""
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+# Profilers for the current request; set only when the request asked to be profiled
+_request_profilers: contextvars.ContextVar[Optional[List[cProfile.Profile]]] = contextvars.ContextVar(
+    "request_profilers", default=None
+)
+
+
+def profiled(fn: Callable) -> Callable:
+    """Wrap work handed to a worker thread so it is profiled with the request that started it.
+
+    asyncio.to_thread copies the request's context into the worker, and a
+    cProfile.Profile only sees the thread that enabled it, so each worker
+    call gets its own profiler that is merged into the request's stats.
+    Returns ``fn`` unchanged when the request isn't being profiled.
+    """
+    if _request_profilers.get() is None:
+        return fn
+
+    def run(*args, **kwargs):
+        profilers = _request_profilers.get()
+        if profilers is None:
+            return fn(*args, **kwargs)
+        profiler = cProfile.Profile()
+        profilers.append(profiler)
+        return profiler.runcall(fn, *args, **kwargs)
+    return run
+
+
+class ProfileStore:
+    """Rendered cProfile stats for the last ``keep`` profiled requests.
+
+    With ``dump_dir`` the merged stats are also written as ``<id>.prof``
+    files for snakeviz or pstats.
+    """
+
+    def __init__(self, keep=20, dump_dir=None, top_n=60):
+        self.keep = keep
+        self.dump_dir = dump_dir
+        self.top_n = top_n
+        self._profiles: "OrderedDict[str, str]" = OrderedDict()
+
+    def save(self, profile_id: str, path: str, profilers: List[cProfile.Profile]):
+        output = io.StringIO()
+        stats = pstats.Stats(profilers[0], stream=output)
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        if self.dump_dir:
+            stats.dump_stats(os.path.join(self.dump_dir, f"{profile_id}.prof"))
+        output.write(f"{path} profile {profile_id} ({len(profilers) - 1} worker calls)\n")
+        stats.sort_stats("cumulative").print_stats(self.top_n)
+        self._profiles[profile_id] = output.getvalue()
+        while len(self._profiles) > self.keep:
+            self._profiles.popitem(last=False)
+        print(f"Stored profile {profile_id} for {path}")
+
+    def get(self, profile_id: str) -> Optional[str]:
+        return self._profiles.get(profile_id)
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by stored profiles"""
+        return deep_sizeof(self._profiles)
+
+    def ids(self) -> List[str]:
+        return list(self._profiles)
+
+
+class RequestProfiler:
+    """ASGI middleware that runs cProfile for requests carrying an ``X-Profile`` header.
+
+    Only ``paths`` are considered and ``authorize(headers)`` must accept the
+    request. Stats for the event-loop thread and every worker call wrapped
+    with ``profiled`` are merged into ``store`` and the response carries the
+    profile id in ``X-Profile-Id``. Note that the event-loop profile also
+    includes whatever other requests ran on the loop meanwhile. Other
+    requests pay one path check.
+    """
+
+    def __init__(self, app, paths, authorize: Callable[[dict], bool], store: ProfileStore):
+        self.app = app
+        self.paths = set(paths)
+        self.authorize = authorize
+        self.store = store
+        self._active = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        # cProfile allows one active profiler per thread, so overlapping requests run unprofiled
+        if "x-profile" not in headers or self._active or not self.authorize(headers):
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex[:12]
+        profilers: List[cProfile.Profile] = []
+        token = _request_profilers.set(profilers)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())])
+            await send(message)
+
+        loop_profiler = cProfile.Profile()
+        self._active = True
+        loop_profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            loop_profiler.disable()
+            self._active = False
+            _request_profilers.reset(token)
+            self.store.save(profile_id, scope["path"], [loop_profiler] + profilers)
@@ -0,0 +1,61 @@
+import json
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional
+
+
+def encode_message(role: str, content: str) -> bytes:
+    """JSON-encode one chat message"""
+    return b'{"role":"' + role.encode("ascii") + b'","content":' + json.dumps(content).encode("ascii") + b"}"
+
+
+@lru_cache(maxsize=16)
+def encode_shared_message(role: str, content: str) -> bytes:
+    """JSON-encode a message many sessions share (the system prompt) once, and reuse the bytes"""
+    return encode_message(role, content)
+
+
+def _encode_all(messages: Iterable[Dict[str, str]]) -> bytes:
+    return b"".join(b"," + encode_message(msg["role"], msg["content"]) for msg in messages)
+
+
+class EncodedMessages:
+    """A conversation history already encoded as JSON, ready to go into a request body.
+
+    ``head`` is the encoding of the first message (usually the shared
+    system prompt's bytes), where per-call system prompts are spliced in
+    after, and the first ``length`` bytes of ``rest`` encode the other
+    messages, each preceded by a comma. ``rest`` is an immutable copy of the
+    session's buffer taken on the event loop, so a worker thread can build
+    the body while the session appends or drops messages. The message count and the first
+    and last user messages are kept so the agent can decide how to respond
+    without decoding the history.
+    """
+
+    __slots__ = ("head", "rest", "length", "count", "first_message", "last_user_message")
+
+    def __init__(self, head: bytes, rest: bytes, length: int, count: int,
+                 first_message: Optional[str] = None, last_user_message: Optional[str] = None):
+        self.head = head
+        self.rest = rest
+        self.length = length
+        self.count = count
+        self.first_message = first_message
+        self.last_user_message = last_user_message
+
+    def spliced(self, after_first: Iterable[Dict[str, str]] = (), after: Iterable[Dict[str, str]] = ()) -> bytes:
+        """Return the JSON array with extra messages after the first message and at the end"""
+        if not self.head:
+            return b"[" + _encode_all(list(after_first) + list(after))[1:] + b"]"
+        rest = self.rest if len(self.rest) == self.length else self.rest[:self.length]
+        return b"".join((b"[", self.head, _encode_all(after_first), rest, _encode_all(after), b"]"))
+
+
+def encode_request_body(params: Dict[str, Any], messages: bytes) -> bytes:
+    """Build a chat completion request body around an already-encoded messages array"""
+    head = json.dumps(params, separators=(",", ":")).encode("utf-8")
+    return head[:-1] + (b',"messages":' if len(head) > 2 else b'"messages":') + messages + b"}"
+
+
+def decode_messages(messages: bytes) -> List[Dict[str, str]]:
+    """Turn an encoded messages array back into a list, for clients that can't send raw bodies"""
+    return json.loads(messages)
@@ -0,0 +1,181 @@
+"""Export sessions and diagnoses for analytics as NDJSON or Parquet.
+
+Usage:
+  python session_export.py --snapshot sessions.bin --output sessions.ndjson
+  python session_export.py --url http://localhost:8000 --admin-token TOKEN --format parquet --output sessions.parquet
+
+``--snapshot`` reads a session snapshot file offline (sessions only, no
+diagnoses); ``--url`` streams /api/admin/export from a running server.
+Records are produced one session at a time, so memory use doesn't grow with
+the number of sessions. Parquet output needs pyarrow and is written in row
+groups of ``--row-group-size`` records.
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from fallback_diagnosis import RULES
+
+# Column order and Arrow types for Parquet output
+PARQUET_COLUMNS = [
+    ("user_id", "string"),
+    ("message_count", "int32"),
+    ("user_turns", "int32"),
+    ("first_complaint", "string"),
+    ("symptom_categories", "list<string>"),
+    ("diagnosis", "string"),
+    ("prescriptions", "list<string>"),
+    ("preliminary", "bool"),
+    ("diagnosed_at", "float64"),
+]
+
+
+def session_record(user_id: str, messages: Iterable[Dict[str, str]], diagnosis: Optional[Dict[str, Any]] = None,
+                   include_messages: bool = False) -> Dict[str, Any]:
+    """Summarize one session (and its latest diagnosis, if any) as a flat export record"""
+    turns = [{"role": msg["role"], "content": msg["content"]} for msg in messages if msg["role"] != "system"]
+    user_messages = [msg["content"] for msg in turns if msg["role"] == "user"]
+    user_text = " ".join(user_messages).lower()
+    record = {
+        "user_id": user_id,
+        "message_count": len(turns),
+        "user_turns": len(user_messages),
+        "first_complaint": user_messages[0] if user_messages else None,
+        "symptom_categories": [rule["name"] for rule in RULES if any(k in user_text for k in rule["keywords"])],
+        "diagnosis": diagnosis.get("diagnosis") if diagnosis else None,
+        "prescriptions": [rx.get("drug_name") for rx in diagnosis.get("prescriptions", [])] if diagnosis else [],
+        "preliminary": bool(diagnosis.get("preliminary")) if diagnosis else None,
+        "diagnosed_at": diagnosis.get("diagnosed_at") if diagnosis else None,
+    }
+    if include_messages:
+        record["messages"] = turns
+    return record
+
+
+def iter_records(sessions: Iterable[Tuple[str, Iterable[Dict[str, str]]]],
+                 diagnoses: Optional[Dict[str, Dict[str, Any]]] = None,
+                 include_messages: bool = False) -> Iterator[Dict[str, Any]]:
+    diagnoses = diagnoses or {}
+    for user_id, messages in sessions:
+        yield session_record(user_id, messages, diagnoses.get(user_id), include_messages)
+
+
+def iter_ndjson(records: Iterable[Dict[str, Any]], lines_per_chunk: int = 256) -> Iterator[bytes]:
+    """Encode records as NDJSON, yielding a chunk of bytes every ``lines_per_chunk`` records"""
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, ensure_ascii=False))
+        if len(lines) >= lines_per_chunk:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _StreamSink:
+    """Write-only file object that hands written bytes back to a generator"""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _arrow_schema():
+    import pyarrow as pa
+    types = {"string": pa.string(), "int32": pa.int32(), "bool": pa.bool_(), "float64": pa.float64(),
+             "list<string>": pa.list_(pa.string())}
+    return pa.schema([(name, types[kind]) for name, kind in PARQUET_COLUMNS])
+
+
+def iter_parquet(records: Iterable[Dict[str, Any]], row_group_size: int = 10000) -> Iterator[bytes]:
+    """Encode records as a Parquet file, yielding bytes after each row group and the footer"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema()
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+
+    def write_group(rows):
+        columns = {name: [row.get(name) for row in rows] for name, _ in PARQUET_COLUMNS}
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+
+    rows = []
+    for record in records:
+        rows.append(record)
+        if len(rows) >= row_group_size:
+            write_group(rows)
+            rows = []
+            yield sink.drain()
+    if rows:
+        write_group(rows)
+    writer.close()
+    yield sink.drain()
+
+
+def _records_from_ndjson(lines: Iterable[bytes]) -> Iterator[Dict[str, Any]]:
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export sessions and diagnoses as NDJSON or Parquet")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--snapshot", help="Session snapshot file written by the API server")
+    source.add_argument("--url", help="Base URL of a running API server, e.g. http://localhost:8000")
+    parser.add_argument("--admin-token", default="", help="X-Admin-Token for --url")
+    parser.add_argument("--format", choices=("ndjson", "parquet"), default="ndjson")
+    parser.add_argument("--output", required=True, help="Output file ('-' for stdout, NDJSON only)")
+    parser.add_argument("--include-messages", action="store_true", help="Include full transcripts (NDJSON only)")
+    parser.add_argument("--row-group-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.snapshot:
+        from session_snapshot import SnapshotReader
+        reader = SnapshotReader(args.snapshot)
+        records = iter_records(reader.items(), include_messages=args.include_messages)
+    else:
+        import requests
+        response = requests.get(
+            f"{args.url.rstrip('/')}/api/admin/export",
+            params={"include_messages": str(args.include_messages).lower()},
+            headers={"X-Admin-Token": args.admin_token},
+            stream=True,
+        )
+        response.raise_for_status()
+        records = _records_from_ndjson(response.iter_lines())
+
+    chunks = iter_parquet(records, args.row_group_size) if args.format == "parquet" else iter_ndjson(records)
+    out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
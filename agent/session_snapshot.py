@@ -0,0 +1,172 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# File layout (all integers little-endian):
+#   header:  magic "PHSS" | u16 version | u32 system prompt length | system prompt bytes
+#   records: u32 user_id length | user_id | u32 message count |
+#            per message: u8 role | u32 content length | content
+#   index:   per session, sorted by key hash: u64 key hash | u64 record offset
+#   footer:  u64 index offset | u64 session count | magic "PHSS"
+# Messages whose content equals the shared system prompt are written with
+# SHARED_PROMPT as their length and no content bytes.
+MAGIC = b"PHSS"
+VERSION = 1
+SHARED_PROMPT = 0xFFFFFFFF
+ROLE_CODES = {"system": 0, "user": 1, "assistant": 2}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+_U32 = struct.Struct("<I")
+_INDEX_ENTRY = struct.Struct("<QQ")
+_FOOTER = struct.Struct("<QQ4s")
+
+
+def _key_hash(user_id: str) -> int:
+    """Stable 64-bit hash of a user id for the on-disk index"""
+    return int.from_bytes(hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def write_snapshot(path: str, sessions: Iterable[Tuple[str, List[Dict[str, str]]]], system_prompt: str) -> int:
+    """Write all sessions to ``path`` atomically and return the number written"""
+    prompt_bytes = system_prompt.encode("utf-8")
+    index = []
+    # Unique temp file so a periodic snapshot and the shutdown snapshot can't interleave
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<HI", VERSION, len(prompt_bytes)) + prompt_bytes)
+        offset = f.tell()
+        for user_id, messages in sessions:
+            user_bytes = user_id.encode("utf-8")
+            parts = [_U32.pack(len(user_bytes)), user_bytes, _U32.pack(len(messages))]
+            for msg in messages:
+                content = msg["content"]
+                parts.append(bytes((ROLE_CODES.get(msg["role"], ROLE_CODES["user"]),)))
+                if content == system_prompt:
+                    parts.append(_U32.pack(SHARED_PROMPT))
+                else:
+                    content_bytes = content.encode("utf-8")
+                    parts.append(_U32.pack(len(content_bytes)))
+                    parts.append(content_bytes)
+            record = b"".join(parts)
+            f.write(record)
+            index.append((_key_hash(user_id), offset))
+            offset += len(record)
+
+        index.sort()
+        f.writelines(_INDEX_ENTRY.pack(key_hash, record_offset) for key_hash, record_offset in index)
+        f.write(_FOOTER.pack(offset, len(index), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+    return len(index)
+
+
+class SnapshotReader:
+    """Lazy, memory-mapped view of a session snapshot.
+
+    Opening a snapshot only maps the file and reads the header and footer, so
+    startup cost doesn't depend on how many sessions it holds. Sessions are
+    decoded one at a time when first requested via a binary search of the index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:4] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a session snapshot")
+        version, prompt_len = struct.unpack_from("<HI", self._map, 4)
+        if version != VERSION:
+            self.close()
+            raise ValueError(f"Unsupported session snapshot version {version}")
+        self.system_prompt = self._map[10:10 + prompt_len].decode("utf-8")
+
+        self._index_offset, self.session_count, footer_magic = _FOOTER.unpack_from(
+            self._map, len(self._map) - _FOOTER.size
+        )
+        if footer_magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is truncated or corrupt")
+
+    def __len__(self) -> int:
+        return self.session_count
+
+    def mapped_bytes(self) -> int:
+        """Size of the mapping; only the pages of sessions read so far are resident"""
+        return len(self._map)
+
+    def _index_entry(self, i: int) -> Tuple[int, int]:
+        return _INDEX_ENTRY.unpack_from(self._map, self._index_offset + i * _INDEX_ENTRY.size)
+
+    def _decode_record(self, offset: int) -> Tuple[str, List[Dict[str, str]], int]:
+        """Decode the record at ``offset``, returning (user_id, messages, end offset)"""
+        buf = self._map
+        (user_len,) = _U32.unpack_from(buf, offset)
+        offset += 4
+        user_id = buf[offset:offset + user_len].decode("utf-8")
+        offset += user_len
+        (count,) = _U32.unpack_from(buf, offset)
+        offset += 4
+
+        messages = []
+        for _ in range(count):
+            role = ROLE_NAMES.get(buf[offset], "user")
+            (length,) = _U32.unpack_from(buf, offset + 1)
+            offset += 5
+            if length == SHARED_PROMPT:
+                content = self.system_prompt
+            else:
+                content = buf[offset:offset + length].decode("utf-8")
+                offset += length
+            messages.append({"role": role, "content": content})
+        return user_id, messages, offset
+
+    def get(self, user_id: str) -> Optional[List[Dict[str, str]]]:
+        """Return the stored messages for ``user_id`` or None"""
+        target = _key_hash(user_id)
+        lo, hi = 0, self.session_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._index_entry(mid)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        # Walk entries sharing the hash in case of a collision
+        while lo < self.session_count:
+            key_hash, offset = self._index_entry(lo)
+            if key_hash != target:
+                break
+            stored_id, messages, _ = self._decode_record(offset)
+            if stored_id == user_id:
+                return messages
+            lo += 1
+        return None
+
+    def items(self) -> Iterable[Tuple[str, List[Dict[str, str]]]]:
+        """Decode every session in file order"""
+        offset = 10 + len(self.system_prompt.encode("utf-8"))
+        while offset < self._index_offset:
+            user_id, messages, offset = self._decode_record(offset)
+            yield user_id, messages
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def open_snapshot(path: str) -> Optional[SnapshotReader]:
+    """Open a snapshot if one exists, returning None when missing or unreadable"""
+    if not os.path.exists(path):
+        return None
+    try:
+        return SnapshotReader(path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"⚠️ Could not load session snapshot {path}: {str(e)}")
+        return None
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+def conversation_fingerprint(conversation: List[Dict[str, str]]) -> str:
+    """Hash the user/assistant turns of a conversation.
+
+    System messages are skipped so the server-side history (which starts with
+    the agent's system prompt) and the client's copy of the same conversation
+    produce the same fingerprint.
+    """
+    turns = [
+        [msg.get("role"), msg.get("content")]
+        for msg in conversation
+        if msg.get("role") != "system"
+    ]
+    return hashlib.sha256(json.dumps(turns).encode("utf-8")).hexdigest()
+
+
+class SpeculativeDiagnosisStore:
+    """Background diagnoses started when a conversation reaches the diagnosis trigger.
+
+    At most one task is kept per user, tagged with the fingerprint of the
+    conversation it was started from. A later /api/diagnose for the same
+    conversation awaits that task instead of starting a new LLM call.
+    Callers count diagnoses they chose not to start in ``skipped``.
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, Tuple[str, "asyncio.Task", Optional[threading.Event]]] = {}
+        self.started = 0
+        self.used = 0
+        self.discarded = 0
+        self.skipped = 0
+
+    def start(self, user_id: str, conversation: List[Dict[str, str]], task: "asyncio.Future",
+              cancel_event: threading.Event):
+        """Remember a diagnosis started at the trigger, running until ``cancel_event`` is set"""
+        self.put(user_id, conversation, task, cancel_event)
+        self.started += 1
+
+    def put(self, user_id: str, conversation: List[Dict[str, str]], task: "asyncio.Future",
+            cancel_event: Optional[threading.Event] = None):
+        """Remember an already-running diagnosis task against the conversation"""
+        self.discard(user_id)
+        # Retrieve the exception of abandoned tasks so it isn't logged as never retrieved
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._pending[user_id] = (conversation_fingerprint(conversation), task, cancel_event)
+
+    def take(self, user_id: str, conversation: List[Dict[str, str]]) -> Optional["asyncio.Task"]:
+        """Pop the pending task for this user if it matches the conversation"""
+        entry = self._pending.get(user_id)
+        if entry is None:
+            return None
+        fingerprint, task, _ = entry
+        if fingerprint != conversation_fingerprint(conversation) or task.cancelled():
+            self.discard(user_id)
+            return None
+        del self._pending[user_id]
+        self.used += 1
+        return task
+
+    def has(self, user_id: str, conversation: List[Dict[str, str]]) -> bool:
+        """Whether take() would return a task for this user and conversation"""
+        entry = self._pending.get(user_id)
+        return entry is not None and not entry[1].cancelled() and entry[0] == conversation_fingerprint(conversation)
+
+    def discard(self, user_id: str):
+        """Cancel or drop any pending diagnosis for this user"""
+        entry = self._pending.pop(user_id, None)
+        if entry is not None:
+            _, task, cancel_event = entry
+            # Abort the upstream call if it is cancellable; cancelling the task drops its result
+            if cancel_event is not None:
+                cancel_event.set()
+            task.cancel()
+            self.discarded += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Return counters for the metrics endpoint"""
+        return {
+            "pending": len(self._pending),
+            "started": self.started,
+            "used": self.used,
+            "discarded": self.discarded,
+            "skipped": self.skipped,
+        }
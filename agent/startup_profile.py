@@ -0,0 +1,41 @@
+"""Report per-import startup time for the API server.
+
+Usage: python startup_profile.py [module] [top_n]
+
+Imports the module (default: api_server) in a fresh interpreter with
+``-X importtime`` and prints the slowest imports by cumulative time.
+"""
+import os
+import subprocess
+import sys
+
+
+def profile_imports(module="api_server", top_n=25):
+    """Return [(cumulative_us, self_us, name)] for the slowest imports of ``module``"""
+    env = dict(os.environ, STARTUP_PROFILE="1")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed")
+
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        timings.append((int(cumulative_us), int(self_us), name.rstrip()))
+    timings.sort(reverse=True)
+    return timings[:top_n]
+
+
+if __name__ == "__main__":
+    module = sys.argv[1] if len(sys.argv) > 1 else "api_server"
+    top_n = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative_us, self_us, name in profile_imports(module, top_n):
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {name}")
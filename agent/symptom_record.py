@@ -0,0 +1,267 @@
+import re
+from typing import Dict, List, Optional, Sequence
+
+from fallback_diagnosis import RED_FLAGS
+
+# Same keywords PharmacistAgent.detect_pain_symptoms looks for
+PAIN_KEYWORDS = [
+    "pain", "hurt", "ache", "sore", "tender", "stiff", "cramp",
+    "throbbing", "sharp", "dull", "burning", "stabbing", "aching"
+]
+PAIN_TYPES = ["throbbing", "sharp", "dull", "burning", "stabbing", "aching", "cramping", "shooting", "pressure", "tingling"]
+
+# Canonical body part -> phrases that mention it
+LOCATIONS: Dict[str, List[str]] = {
+    "head": ["headache", "head", "migraine"],
+    "forehead": ["forehead"],
+    "temples": ["temple"],
+    "eyes": ["eye"],
+    "ears": ["earache", "ear"],
+    "jaw": ["jaw"],
+    "teeth": ["toothache", "tooth", "teeth", "gum"],
+    "throat": ["throat"],
+    "neck": ["neck"],
+    "shoulder": ["shoulder"],
+    "arm": ["arm", "elbow"],
+    "wrist/hand": ["wrist", "hand", "finger"],
+    "chest": ["chest"],
+    "lower back": ["lower back"],
+    "upper back": ["upper back"],
+    "back": ["backache", "back"],
+    "stomach/abdomen": ["stomachache", "stomach", "abdomen", "abdominal", "belly", "tummy"],
+    "hip": ["hip"],
+    "leg": ["leg", "thigh", "calf"],
+    "knee": ["knee"],
+    "ankle/foot": ["ankle", "foot", "feet", "heel", "toe"],
+    "muscles": ["muscle"],
+    "joints": ["joint"],
+    "skin": ["skin", "rash"],
+}
+# Canonical symptom -> phrases
+ASSOCIATED_SYMPTOMS: Dict[str, List[str]] = {
+    "nausea": ["nausea", "nauseous", "queasy"],
+    "vomiting": ["vomit", "throwing up", "threw up"],
+    "fever": ["fever", "temperature", "feverish"],
+    "chills": ["chills", "shivering"],
+    "dizziness": ["dizzy", "dizziness", "lightheaded", "light-headed"],
+    "fatigue": ["fatigue", "tired", "exhausted", "no energy"],
+    "light sensitivity": ["light bothers", "bright light", "sensitive to light", "sensitivity to light"],
+    "cough": ["cough"],
+    "congestion": ["congest", "stuffy", "blocked nose"],
+    "runny nose": ["runny nose"],
+    "sneezing": ["sneez"],
+    "itchy/watery eyes": ["itchy eyes", "watery eyes"],
+    "diarrhea": ["diarrhea", "diarrhoea", "loose stool"],
+    "constipation": ["constipat"],
+    "bloating": ["bloat"],
+    "heartburn": ["heartburn", "acid reflux", "indigestion"],
+    "loss of appetite": ["no appetite", "loss of appetite", "lost my appetite", "not hungry"],
+    "rash": ["rash", "hives"],
+    "itching": ["itch"],
+    "swelling": ["swell", "swollen"],
+    "numbness": ["numb", "tingl"],
+    "trouble sleeping": ["can't sleep", "cannot sleep", "insomnia", "trouble sleeping"],
+}
+
+
+def _alternation(groups: Dict[str, List[str]], suffix: str = "") -> "re.Pattern":
+    """One regex matching any phrase of any group; longest first, so "lower back" wins over "back"."""
+    phrases = sorted((phrase for group in groups.values() for phrase in group), key=len, reverse=True)
+    return re.compile(r"\b(" + "|".join(re.escape(phrase) for phrase in phrases) + ")" + suffix)
+
+
+# Matching all phrases with one regex keeps extraction to a few scans per message
+LOCATION_PATTERN = _alternation(LOCATIONS, r"(?:s|es)?\b")
+LOCATION_BY_PHRASE = {phrase: location for location, phrases in LOCATIONS.items() for phrase in phrases}
+# Symptom phrases are prefixes ("sneez", "constipat"), so they may end mid-word
+SYMPTOM_PATTERN = _alternation(ASSOCIATED_SYMPTOMS)
+SYMPTOM_BY_PHRASE = {phrase: symptom for symptom, phrases in ASSOCIATED_SYMPTOMS.items() for phrase in phrases}
+
+MEDICATIONS = [
+    "ibuprofen", "advil", "motrin", "acetaminophen", "paracetamol", "tylenol", "naproxen", "aleve",
+    "aspirin", "loratadine", "claritin", "cetirizine", "zyrtec", "diphenhydramine", "benadryl",
+    "omeprazole", "antacid", "tums", "calcium carbonate", "muscle relaxant", "warfarin", "blood thinner",
+]
+
+NEGATIONS = ("no ", "not ", "don't ", "dont ", "doesn't ", "didn't ", "haven't ", "without ", "never ", "denies ", "nor ")
+
+NUMBER_WORDS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+                "a few": 3, "few": 3, "a couple of": 2, "couple of": 2, "several": 3}
+INTENSITY = re.compile(r"\b(10|[0-9])(?:\.5)?\s*(?:/|out of|on a scale of \w+ to)\s*10\b")
+BARE_NUMBER = re.compile(r"^\D{0,20}\b(10|[0-9])\b\D{0,20}$")
+DURATION = re.compile(
+    r"\b(\d+|a couple of|couple of|a few|few|several|an|a|one|two|three|four|five|six|seven)\s+"
+    r"(minute|hour|day|week|month|year)s?\b"
+)
+SINCE = re.compile(r"\bsince (yesterday|this morning|last night|last week|this week|\w+day)\b")
+AGGRAVATING = re.compile(
+    r"\b(?:worse|worsens|gets worse|aggravated|triggered)\s+(?:when|with|after|if|in|by|during|at)\s+([^.,;!?]+)"
+    # "bright light bothers me": up to three words before the verb, none of them a conjunction
+    r"|\b((?:(?!and\b|but\b|also\b)[a-z]+ ){0,2}[a-z]+)\s+(?:bothers|triggers|aggravates)\s+(?:me|it)\b"
+)
+RELIEVING = re.compile(r"\b(?:better|improves|relieved|eases)\s+(?:when|with|after|if|by)\s+([^.,;!?]+)")
+ALLERGY = re.compile(r"\ballerg(?:ic|y|ies)\s+(?:to|:)\s+([^.;!?]+)")
+NO_ALLERGIES = re.compile(r"\bno (?:known )?(?:drug )?allergies\b|\bnot allergic to anything\b")
+NO_MEDICATIONS = re.compile(r"\bnot (?:taking|on) any (?:medication|medicine|meds)|\bno (?:medication|medicine|meds)\b")
+SCALE_QUESTION = re.compile(r"scale|1\s*-\s*10|1 to 10|how (?:bad|severe|intense)|intensity")
+
+
+def _clause(text: str, limit: int = 6) -> str:
+    """Trim a captured phrase to its first few words"""
+    words = re.split(r"\s+(?:and|but|so|because)\s+", text.strip())[0].split()
+    return " ".join(words[:limit])
+
+
+def _negated(text: str, position: int) -> bool:
+    window = text[max(0, position - 24):position]
+    return any(negation in window for negation in NEGATIONS)
+
+
+def _add(items: List[str], item: str):
+    if item and item not in items:
+        items.append(item)
+
+
+class SymptomRecord:
+    """Structured clinical record built from a conversation's user messages without an LLM call.
+
+    Tracks what the chat prompt asks the patient about: pain location,
+    intensity, duration, type and triggers, associated symptoms (and ones
+    the patient denied), allergies and medications, plus red flags. Each
+    user message is processed once, by ``sync``, as the conversation grows;
+    the latest assistant question is kept so a bare "6" after "on a scale
+    of 1-10" counts as the intensity. ``summary`` renders the record as a
+    short prompt block.
+    """
+
+    __slots__ = ("pain", "locations", "intensity", "duration", "pain_types", "aggravating", "relieving",
+                 "symptoms", "denied", "allergies", "no_allergies", "medications", "no_medications",
+                 "red_flags", "_seen", "_last_seen", "_last_question")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pain = False
+        self.locations: List[str] = []
+        self.intensity: Optional[int] = None
+        self.duration: Optional[str] = None
+        self.pain_types: List[str] = []
+        self.aggravating: List[str] = []
+        self.relieving: List[str] = []
+        self.symptoms: List[str] = []
+        self.denied: List[str] = []
+        self.allergies: List[str] = []
+        self.no_allergies = False
+        self.medications: List[str] = []
+        self.no_medications = False
+        self.red_flags: List[str] = []
+        self._seen = 0
+        self._last_seen: Optional[str] = None
+        self._last_question = ""
+
+    def sync(self, messages: Sequence[Dict[str, str]]):
+        """Process the messages added since the last call, rebuilding if the history was cut or replaced"""
+        if self._seen > len(messages) or (self._seen and messages[self._seen - 1]["content"] != self._last_seen):
+            self.reset()
+        for message in messages[self._seen:]:
+            if message["role"] == "user":
+                self.update(message["content"])
+            elif message["role"] == "assistant":
+                self._last_question = message["content"].lower()
+            self._last_seen = message["content"]
+        self._seen = len(messages)
+
+    def update(self, message: str):
+        """Fold one user message into the record"""
+        text = re.sub(r"\s+", " ", message.lower())
+
+        if any(keyword in text for keyword in PAIN_KEYWORDS):
+            self.pain = True
+        for pain_type in PAIN_TYPES:
+            if pain_type in text:
+                _add(self.pain_types, pain_type)
+        for match in LOCATION_PATTERN.finditer(text):
+            if not _negated(text, match.start()):
+                _add(self.locations, LOCATION_BY_PHRASE[match.group(1)])
+
+        # Substring checks skip the regexes that can't match this message
+        intensity = INTENSITY.search(text) if "10" in text else None
+        if intensity is None and SCALE_QUESTION.search(self._last_question):
+            intensity = BARE_NUMBER.search(text)
+        if intensity is not None:
+            self.intensity = int(intensity.group(1))
+
+        duration = DURATION.search(text)
+        if duration is not None:
+            amount = duration.group(1)
+            count = int(amount) if amount.isdigit() else NUMBER_WORDS.get(amount, 1)
+            self.duration = f"{count} {duration.group(2)}{'s' if count != 1 else ''}"
+        elif "since" in text:
+            since = SINCE.search(text)
+            if since is not None:
+                self.duration = f"since {since.group(1)}"
+
+        if any(word in text for word in ("worse", "aggravat", "trigger", "bother")):
+            for match in AGGRAVATING.finditer(text):
+                _add(self.aggravating, _clause(match.group(1) or match.group(2)))
+        if any(word in text for word in ("better", "improve", "reliev", "ease")):
+            for match in RELIEVING.finditer(text):
+                _add(self.relieving, _clause(match.group(1)))
+
+        for match in SYMPTOM_PATTERN.finditer(text):
+            symptom = SYMPTOM_BY_PHRASE[match.group(1)]
+            if _negated(text, match.start()):
+                if symptom not in self.symptoms:
+                    _add(self.denied, symptom)
+            else:
+                _add(self.symptoms, symptom)
+                if symptom in self.denied:
+                    self.denied.remove(symptom)
+
+        if "allerg" in text:
+            if NO_ALLERGIES.search(text):
+                self.no_allergies = True
+            for match in ALLERGY.finditer(text):
+                for allergen in re.split(r",|\band\b|\bor\b", match.group(1)):
+                    _add(self.allergies, _clause(allergen, 3))
+        if "med" in text and NO_MEDICATIONS.search(text):
+            self.no_medications = True
+        for medication in MEDICATIONS:
+            position = text.find(medication)
+            if position >= 0 and "allerg" not in text[max(0, position - 24):position]:
+                _add(self.medications, medication)
+
+        for flag in RED_FLAGS:
+            if flag in text:
+                _add(self.red_flags, flag)
+
+    def summary(self) -> str:
+        """Render the record as a compact prompt block ("" when nothing was extracted)"""
+        lines = []
+        if self.pain or self.locations:
+            details = [f"location: {', '.join(self.locations)}" if self.locations else None,
+                       f"intensity: {self.intensity}/10" if self.intensity is not None else None,
+                       f"type: {', '.join(self.pain_types)}" if self.pain_types else None]
+            lines.append(("Pain" if self.pain else "Complaint") + ": " + ("; ".join(d for d in details if d) or "yes"))
+        elif self.intensity is not None:
+            lines.append(f"Severity: {self.intensity}/10")
+        if self.duration:
+            lines.append(f"Duration: {self.duration}")
+        if self.aggravating:
+            lines.append(f"Worse with: {'; '.join(self.aggravating)}")
+        if self.relieving:
+            lines.append(f"Better with: {'; '.join(self.relieving)}")
+        if self.symptoms:
+            lines.append(f"Associated symptoms: {', '.join(self.symptoms)}")
+        if self.denied:
+            lines.append(f"Denies: {', '.join(self.denied)}")
+        if self.allergies or self.no_allergies:
+            lines.append(f"Allergies: {', '.join(self.allergies) if self.allergies else 'none known'}")
+        if self.medications or self.no_medications:
+            lines.append(f"Medications taken or tried: {', '.join(self.medications) if self.medications else 'none'}")
+        if self.red_flags:
+            lines.append(f"Red flags mentioned: {', '.join(self.red_flags)}")
+        if not lines:
+            return ""
+        return "Clinical record extracted from the whole conversation:\n" + "\n".join(f"- {line}" for line in lines)
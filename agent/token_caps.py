@@ -0,0 +1,65 @@
+import math
+import threading
+from collections import deque
+from typing import Dict
+
+from memory_report import deep_sizeof
+
+
+class AdaptiveTokenCaps:
+    """Per-call-type max_tokens caps learned from observed output lengths.
+
+    Each call type keeps a rolling window of completion token counts. Once
+    ``min_samples`` are seen, the cap is the ``percentile`` of that window plus
+    ``margin``, never below ``floor`` and never above the caller's default.
+    Calls that still hit the cap (finish_reason == "length") are retried once
+    at the default by the agent.
+    """
+
+    def __init__(self, percentile=0.99, margin=0.25, floor=256, min_samples=50, window=500):
+        self.percentile = percentile
+        self.margin = margin
+        self.floor = floor
+        self.min_samples = min_samples
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self._truncations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def cap(self, call_type: str, default: int) -> int:
+        """Return the max_tokens to request for ``call_type``"""
+        with self._lock:
+            samples = self._samples.get(call_type)
+            if samples is None or len(samples) < self.min_samples:
+                return default
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, math.ceil(self.percentile * len(ordered)) - 1)
+        learned = int(ordered[index] * (1 + self.margin))
+        return min(default, max(self.floor, learned))
+
+    def observe(self, call_type: str, completion_tokens: int):
+        """Record the output length of a completed (not truncated) call"""
+        with self._lock:
+            self._samples.setdefault(call_type, deque(maxlen=self.window)).append(completion_tokens)
+
+    def record_truncation(self, call_type: str):
+        with self._lock:
+            self._truncations[call_type] = self._truncations.get(call_type, 0) + 1
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by output length samples"""
+        with self._lock:
+            return deep_sizeof((self._samples, self._truncations))
+
+    def stats(self, defaults: Dict[str, int] = None) -> Dict[str, Dict[str, int]]:
+        """Return sample counts, truncation retries and (given defaults) the current caps"""
+        with self._lock:
+            call_types = set(self._samples) | set(self._truncations)
+            counts = {call_type: len(self._samples.get(call_type, ())) for call_type in call_types}
+            truncations = dict(self._truncations)
+        result = {}
+        for call_type in sorted(call_types):
+            result[call_type] = {"samples": counts[call_type], "truncation_retries": truncations.get(call_type, 0)}
+            if defaults and call_type in defaults:
+                result[call_type]["cap"] = self.cap(call_type, defaults[call_type])
+        return result
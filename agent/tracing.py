@@ -0,0 +1,210 @@
+import contextvars
+import importlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# W3C trace context: version-traceid-parentid-flags
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("current_span", default=None)
+
+
+class _NoopSpan:
+    """Stands in for a span when the request isn't sampled, so instrumented code needs no checks"""
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """One timed phase of a sampled request; entering it makes it the parent of spans started inside"""
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "attributes", "started_at", "_started",
+                 "_token")
+
+    def __init__(self, tracer: "Tracer", trace_id: str, parent_id: Optional[str], name: str, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.started_at = 0.0
+        self._started = 0.0
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def __enter__(self):
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._started
+        _current_span.reset(self._token)
+        record = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.started_at,
+            "duration_ms": round(duration * 1000, 3),
+            "status": "ok" if exc_type is None else "error",
+            "attributes": self.attributes,
+        }
+        if exc_type is not None:
+            record["error"] = f"{exc_type.__name__}: {exc}"
+        self.tracer.export(record)
+        return False
+
+
+def span(name: str, **attributes):
+    """Start a child of the current span; a no-op outside a sampled trace"""
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.tracer, parent.trace_id, parent.span_id, name, attributes)
+
+
+def current_span():
+    """Return the active span (NOOP_SPAN outside a sampled trace), e.g. to add attributes"""
+    return _current_span.get() or NOOP_SPAN
+
+
+def current_traceparent() -> Optional[str]:
+    """traceparent header continuing the current trace, or None outside a sampled trace"""
+    active = _current_span.get()
+    return active.traceparent() if active is not None else None
+
+
+class JsonLinesExporter:
+    """Writes each finished span as one JSON line to ``path``, or to stdout when no path is given"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8") if path else None
+        self._lock = threading.Lock()
+
+    def export(self, record: Dict[str, Any]):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            out = self._file or sys.stdout
+            out.write(line)
+            out.flush()
+
+
+def load_exporter(spec: str, path: Optional[str] = None):
+    """Build the exporter named by TRACE_EXPORTER: "stdout", "file" (to ``path``) or "module:factory".
+
+    A factory is called without arguments and must return an object with an
+    ``export(record)`` method. Returns None for an empty spec (tracing off).
+    """
+    if not spec:
+        return None
+    if spec == "stdout":
+        return JsonLinesExporter()
+    if spec == "file":
+        if not path:
+            raise ValueError("TRACE_EXPORTER=file needs TRACE_FILE")
+        return JsonLinesExporter(path)
+    module_name, _, factory = spec.partition(":")
+    if not factory:
+        raise ValueError(f"Unknown trace exporter {spec!r}, expected stdout, file or module:factory")
+    return getattr(importlib.import_module(module_name), factory)()
+
+
+class Tracer:
+    """Head-sampled tracing: the decision is made once per request when its root span starts.
+
+    A request is traced when its incoming traceparent is flagged as sampled
+    or, failing that, with probability ``sample_rate``. Unsampled requests
+    only pay one context variable lookup per instrumented phase.
+    """
+
+    def __init__(self, exporter, sample_rate=0.01):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.sampled = 0
+        self.exported = 0
+        self.export_errors = 0
+
+    def start(self, name: str, traceparent: Optional[str] = None, **attributes):
+        """Return the root span for a request (NOOP_SPAN when it isn't sampled)"""
+        if self.exporter is None:
+            return NOOP_SPAN
+        match = TRACEPARENT.match(traceparent.strip().lower()) if traceparent else None
+        forced = match is not None and int(match.group(3), 16) & 1
+        if not forced and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return NOOP_SPAN
+        self.sampled += 1
+        if match is not None:
+            return Span(self, match.group(1), match.group(2), name, attributes)
+        return Span(self, f"{random.getrandbits(128):032x}", None, name, attributes)
+
+    def export(self, record: Dict[str, Any]):
+        try:
+            self.exporter.export(record)
+            self.exported += 1
+        except Exception as e:
+            self.export_errors += 1
+            print(f"Failed to export span {record['name']}: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters for the metrics endpoint"""
+        return {
+            "enabled": self.exporter is not None,
+            "sample_rate": self.sample_rate,
+            "sampled_requests": self.sampled,
+            "exported_spans": self.exported,
+            "export_errors": self.export_errors,
+        }
+
+
+class TraceRequests:
+    """ASGI middleware opening a root span for requests to ``paths`` (prefixes).
+
+    The incoming ``traceparent`` header continues the caller's trace, and
+    sampled responses carry a traceparent naming the root span.
+    """
+
+    def __init__(self, app, tracer: Tracer, paths):
+        self.app = app
+        self.tracer = tracer
+        self.paths = tuple(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.tracer.exporter is None or not scope["path"].startswith(self.paths):
+            return await self.app(scope, receive, send)
+        traceparent = next((value.decode("latin-1") for name, value in scope["headers"] if name == b"traceparent"), None)
+        root = self.tracer.start(f"{scope['method']} {scope['path']}", traceparent)
+        if root is NOOP_SPAN:
+            return await self.app(scope, receive, send)
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                root.set(status_code=message["status"])
+                message = dict(message, headers=list(message.get("headers", [])) + [(b"traceparent", root.traceparent().encode())])
+            await send(message)
+
+        with root:
+            await self.app(scope, receive, send_with_trace)
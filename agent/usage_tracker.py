@@ -0,0 +1,127 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from memory_report import deep_sizeof
+
+
+class TokenBudgetExceeded(Exception):
+    """Raised before an upstream call when a user has used up their token budget"""
+    def __init__(self, user_id: str, used: int, budget: int, retry_after: float):
+        super().__init__(f"Token budget exceeded for user {user_id}: {used}/{budget} tokens")
+        self.user_id = user_id
+        self.used = used
+        self.budget = budget
+        self.retry_after = retry_after
+
+
+def _empty_totals() -> Dict[str, float]:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
+            "latency_seconds": 0.0, "max_latency_seconds": 0.0}
+
+
+def _add(totals: Dict[str, float], prompt_tokens: int, completion_tokens: int, latency: float):
+    totals["calls"] += 1
+    totals["prompt_tokens"] += prompt_tokens
+    totals["completion_tokens"] += completion_tokens
+    totals["total_tokens"] += prompt_tokens + completion_tokens
+    totals["latency_seconds"] += latency
+    totals["max_latency_seconds"] = max(totals["max_latency_seconds"], latency)
+
+
+class UsageTracker:
+    """Bounded in-memory token and latency accounting per call type and per user.
+
+    Per-user totals are kept for at most ``max_users`` users (least recently
+    active are evicted). With a ``sink_path``, totals since the last flush
+    are appended to it as one JSON line per flush; without one they are not
+    kept at all. When ``user_token_budget`` is
+    set, ``check_budget`` refuses users who used that many tokens within the
+    current ``budget_window`` seconds.
+    """
+
+    def __init__(self, max_users=10000, sink_path=None, user_token_budget=0, budget_window=3600):
+        self.max_users = max_users
+        self.sink_path = sink_path
+        self.user_token_budget = user_token_budget
+        self.budget_window = budget_window
+        self._lock = threading.Lock()
+        self._by_call_type: Dict[str, Dict[str, float]] = {}
+        self._by_user: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+        self._pending_call_types: Dict[str, Dict[str, float]] = {}
+        self._pending_users: Dict[str, Dict[str, float]] = {}
+        # user_id -> [window start, tokens used in window]
+        self._windows: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def record(self, call_type: str, user_id: Optional[str], prompt_tokens: int, completion_tokens: int, latency: float):
+        """Add one completed upstream call to the aggregates"""
+        user_id = user_id or "anonymous"
+        tables = [(self._by_call_type, call_type), (self._by_user, user_id)]
+        if self.sink_path:
+            tables += [(self._pending_call_types, call_type), (self._pending_users, user_id)]
+        with self._lock:
+            for table, key in tables:
+                _add(table.setdefault(key, _empty_totals()), prompt_tokens, completion_tokens, latency)
+
+            self._by_user.move_to_end(user_id)
+            while len(self._by_user) > self.max_users:
+                self._by_user.popitem(last=False)
+
+            if self.user_token_budget:
+                window = self._current_window(user_id)
+                window[1] += prompt_tokens + completion_tokens
+
+    def _current_window(self, user_id: str) -> List[float]:
+        now = time.time()
+        window = self._windows.get(user_id)
+        if window is None or now - window[0] >= self.budget_window:
+            window = [now, 0]
+            self._windows[user_id] = window
+        self._windows.move_to_end(user_id)
+        while len(self._windows) > self.max_users:
+            self._windows.popitem(last=False)
+        return window
+
+    def check_budget(self, user_id: Optional[str]):
+        """Raise TokenBudgetExceeded if the user has no budget left in the current window"""
+        if not self.user_token_budget or not user_id:
+            return
+        with self._lock:
+            window = self._current_window(user_id)
+            if window[1] >= self.user_token_budget:
+                retry_after = max(0.0, window[0] + self.budget_window - time.time())
+                raise TokenBudgetExceeded(user_id, int(window[1]), self.user_token_budget, retry_after)
+
+    def top_consumers(self, n=10) -> List[Dict[str, Any]]:
+        """Return the ``n`` users with the most total tokens"""
+        with self._lock:
+            ranked = sorted(self._by_user.items(), key=lambda item: item[1]["total_tokens"], reverse=True)[:n]
+            return [dict(totals, user_id=user_id) for user_id, totals in ranked]
+
+    def by_call_type(self) -> Dict[str, Dict[str, float]]:
+        """Return totals per call type, including average latency"""
+        with self._lock:
+            return {
+                call_type: dict(totals, avg_latency_seconds=totals["latency_seconds"] / totals["calls"])
+                for call_type, totals in self._by_call_type.items()
+            }
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by usage counters and budget windows"""
+        with self._lock:
+            return deep_sizeof((self._by_call_type, self._by_user, self._pending_call_types, self._pending_users,
+                                self._windows))
+
+    def flush(self) -> int:
+        """Append totals since the last flush to the sink and reset them; returns users written"""
+        with self._lock:
+            call_types, users = self._pending_call_types, self._pending_users
+            self._pending_call_types, self._pending_users = {}, {}
+        if not self.sink_path or not call_types:
+            return 0
+        record = {"timestamp": time.time(), "by_call_type": call_types, "by_user": users}
+        with open(self.sink_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return len(users)
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from memory_report import deep_sizeof
+
+# Same rules as lib/pharma_api.ts: these users have no row in "User"
+ANONYMOUS_PREFIXES = ("user-", "anonymous-user")
+
+# Rows are matched to "User" by id or clerkId; rows for unknown users are skipped by the join
+CONVERSATION_INSERT = (
+    'INSERT INTO "Conversation" (id, "userId", message, response, diagnosis, "createdAt", "updatedAt") '
+    "SELECT v.id, u.id, v.message, v.response, v.diagnosis::jsonb, v.created_at, v.created_at "
+    "FROM (VALUES {values}) AS v (id, user_key, message, response, diagnosis, created_at) "
+    'JOIN "User" u ON u.id = v.user_key OR u."clerkId" = v.user_key'
+)
+PRESCRIPTION_INSERT = (
+    'INSERT INTO "Prescription" (id, "userId", medication, dosage, frequency, "endDate", "doctorName", '
+    'refills, instructions, "prescribedAt", "createdAt", "updatedAt") '
+    "SELECT v.id, u.id, v.medication, v.dosage, v.frequency, v.end_date, v.doctor_name, "
+    "v.refills, v.instructions, v.created_at, v.created_at, v.created_at "
+    "FROM (VALUES {values}) AS v (id, user_key, medication, dosage, frequency, end_date, doctor_name, "
+    "refills, instructions, created_at) "
+    'JOIN "User" u ON u.id = v.user_key OR u."clerkId" = v.user_key'
+)
+
+
+def _multi_row(template: str, rows: List[tuple]):
+    """Return (sql, params) for a single INSERT of all ``rows``"""
+    placeholders = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+    params = [value for row in rows for value in row]
+    return template.format(values=", ".join([placeholders] * len(rows))), params
+
+
+def _now() -> datetime:
+    # Prisma stores DateTime as UTC timestamps without a time zone
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def prescription_row(user_id: str, rx: Dict[str, Any], created_at: datetime) -> tuple:
+    """Map a PrescriptionItem to a "Prescription" row the way /api/save-prescription does"""
+    instructions = rx.get("instructions")
+    duration = re.search(r"\d+", rx.get("duration") or "")
+    return (
+        uuid.uuid4().hex,
+        user_id,
+        rx.get("drug_name", "Unknown medication"),
+        rx.get("dosage") or "As directed",
+        instructions.split(" ")[0] if instructions else "As directed",
+        created_at + timedelta(days=int(duration.group()) if duration else 30),
+        "PharmaAI Virtual Doctor",
+        3,
+        instructions or "Take as directed",
+        created_at,
+    )
+
+
+class WriteBehindWriter:
+    """Bounded queue of chat turns and diagnoses written to the database in batches.
+
+    Request handlers only append to an in-memory queue; ``run`` flushes it
+    every ``flush_interval`` seconds, or as soon as ``batch_size`` records
+    are waiting, with one multi-row INSERT per table on a worker thread.
+    When the queue holds ``max_pending`` records new ones are dropped and
+    counted rather than slowing the request down, and a failed batch is put
+    back at the front of the queue while there is room.
+    ``on_prescriptions_written`` is called with the user ids whose
+    prescriptions were written (e.g. to invalidate cached medical context).
+    """
+
+    def __init__(self, pool, batch_size=200, flush_interval=2.0, max_pending=5000, persist_prescriptions=False,
+                 on_prescriptions_written: Optional[Callable[[Set[str]], None]] = None):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.persist_prescriptions = persist_prescriptions
+        self.on_prescriptions_written = on_prescriptions_written
+        self._pending: deque = deque()
+        self._lock = threading.Lock()
+        # Serializes flushes from the background loop and the shutdown hook
+        self._flush_lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self.queued = 0
+        self.dropped = 0
+        self.written_conversations = 0
+        self.written_prescriptions = 0
+        self.skipped_unknown_users = 0
+        self.failed_batches = 0
+        self.last_flush_seconds = 0.0
+
+    def _enqueue(self, user_id: str, record: Dict[str, Any]):
+        if user_id.startswith(ANONYMOUS_PREFIXES):
+            return
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            record["user_id"] = user_id
+            record["created_at"] = _now()
+            self._pending.append(record)
+            self.queued += 1
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def add_turn(self, user_id: str, message: str, response: str):
+        """Queue one chat exchange"""
+        self._enqueue(user_id, {"message": message, "response": response, "diagnosis": None})
+
+    def add_diagnosis(self, user_id: str, message: str, response: str, diagnosis: Dict[str, Any]):
+        """Queue a generated diagnosis (and its prescriptions when persist_prescriptions is set)"""
+        self._enqueue(user_id, {"message": message, "response": response, "diagnosis": diagnosis})
+
+    def _write(self, batch: List[Dict[str, Any]]) -> Set[str]:
+        conversation_rows = []
+        prescription_rows = []
+        for record in batch:
+            diagnosis = record["diagnosis"]
+            conversation_rows.append((
+                uuid.uuid4().hex, record["user_id"], record["message"], record["response"],
+                json.dumps(diagnosis) if diagnosis is not None else None, record["created_at"],
+            ))
+            if diagnosis is not None and self.persist_prescriptions:
+                for rx in diagnosis.get("prescriptions", []):
+                    prescription_rows.append(prescription_row(record["user_id"], rx, record["created_at"]))
+
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(*_multi_row(CONVERSATION_INSERT, conversation_rows))
+                    inserted = max(cursor.rowcount, 0)
+                    if prescription_rows:
+                        cursor.execute(*_multi_row(PRESCRIPTION_INSERT, prescription_rows))
+                finally:
+                    cursor.close()
+        finally:
+            self.pool.putconn(conn)
+
+        self.written_conversations += inserted
+        self.skipped_unknown_users += len(conversation_rows) - inserted
+        self.written_prescriptions += len(prescription_rows)
+        return {row[1] for row in prescription_rows}
+
+    def flush(self) -> int:
+        """Write everything queued so far in batches; returns the number of records flushed"""
+        flushed = 0
+        with self._flush_lock:
+            started = time.perf_counter()
+            while True:
+                with self._lock:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                if not batch:
+                    break
+                try:
+                    users = self._write(batch)
+                except Exception as e:
+                    print(f"Write-behind batch of {len(batch)} records failed: {str(e)}")
+                    self.failed_batches += 1
+                    with self._lock:
+                        room = max(self.max_pending - len(self._pending), 0)
+                        self._pending.extendleft(reversed(batch[:room]))
+                        self.dropped += len(batch) - min(room, len(batch))
+                    break
+                flushed += len(batch)
+                if users and self.on_prescriptions_written is not None:
+                    self.on_prescriptions_written(users)
+            self.last_flush_seconds = time.perf_counter() - started
+        return flushed
+
+    async def run(self):
+        """Flush periodically, or early when a full batch is waiting"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await asyncio.to_thread(self.flush)
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by records waiting to be written"""
+        with self._lock:
+            return deep_sizeof(self._pending)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters for the metrics endpoint"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "max_pending": self.max_pending,
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "written_conversations": self.written_conversations,
+            "written_prescriptions": self.written_prescriptions,
+            "skipped_unknown_users": self.skipped_unknown_users,
+            "failed_batches": self.failed_batches,
+            "last_flush_seconds": round(self.last_flush_seconds, 4),
+        }
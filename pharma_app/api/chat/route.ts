@@ -139,11 +139,17 @@ export async function POST(req: NextRequest) {
       return NextResponse.json({ error: "Message is required" }, { status: 400 });
     }
     
-    // Forward the request to the Python backend
+    // Forward the request to the Python backend; an Idempotency-Key lets it
+    // recognize retries of the same message instead of appending it again,
+    // and a W3C traceparent puts its spans in the caller's trace
+    const idempotencyKey = req.headers.get('idempotency-key');
+    const traceparent = req.headers.get('traceparent');
     const response = await fetch(`${apiUrl}/api/chat`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        ...(idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : {}),
+        ...(traceparent ? { traceparent } : {}),
       },
       body: JSON.stringify({
         message,
@@ -1,6 +1,7 @@
 import { NextRequest, NextResponse } from "next/server";
 import { currentUser } from "@clerk/nextjs";
 import { db } from "@/lib/db";
+import { invalidateMedicalContext } from "@/lib/medical-context";
 
 // GET endpoint to retrieve user's medical history
 export async function GET(req: NextRequest) {
@@ -80,6 +81,9 @@ export async function POST(req: NextRequest) {
       });
     }
     
+    // The agent caches this record (allergies included) until it is told it changed
+    await invalidateMedicalContext(user.id, medicalHistory.userId);
+    
     return NextResponse.json(medicalHistory);
   } catch (error) {
     console.error("Medical history POST error:", error);
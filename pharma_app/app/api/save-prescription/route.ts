@@ -1,6 +1,7 @@
 import { auth } from "@clerk/nextjs";
 import { NextResponse, NextRequest } from "next/server";
 import { db } from "@/lib/db";
+import { invalidateMedicalContext } from "@/lib/medical-context";
 
 // Define PrescriptionStatus if not exported by Prisma client
 enum PrescriptionStatus {
@@ -80,6 +81,10 @@ export async function POST(request: NextRequest) {
       savedPrescriptions.push(newPrescription);
     }
     
+    if (savedPrescriptions.length > 0) {
+      await invalidateMedicalContext(userId, user.id);
+    }
+    
     return NextResponse.json({
       success: true,
       message: `${savedPrescriptions.length} prescription(s) saved successfully`,
@@ -0,0 +1,30 @@
+// The Python agent caches each patient's medical history and active prescriptions for
+// MEDICAL_CONTEXT_TTL seconds; routes that change either must drop that cache entry so the
+// next consultation (and the allergy filter on fallback diagnoses) sees the new record.
+const API_URL = process.env.PYTHON_API_URL || "http://localhost:8001";
+const ADMIN_TOKEN = process.env.PYTHON_API_ADMIN_TOKEN || "";
+
+/**
+ * Invalidate the agent's cached medical context for a user.
+ * Pass every id the agent may have been given for the user (Clerk id and internal id).
+ * Never throws: a failed call only means the agent serves the old record until its TTL expires.
+ */
+export async function invalidateMedicalContext(...userIds: (string | null | undefined)[]): Promise<void> {
+  if (!ADMIN_TOKEN) return;
+
+  const ids = Array.from(new Set(userIds.filter((id): id is string => !!id)));
+  await Promise.all(ids.map(async (id) => {
+    try {
+      const response = await fetch(`${API_URL}/api/admin/medical-context/${encodeURIComponent(id)}/invalidate`, {
+        method: "POST",
+        headers: { "X-Admin-Token": ADMIN_TOKEN },
+        signal: AbortSignal.timeout(2000),
+      });
+      if (!response.ok) {
+        console.error(`Medical context invalidation for ${id} failed with status ${response.status}`);
+      }
+    } catch (error) {
+      console.error(`Medical context invalidation for ${id} failed:`, error);
+    }
+  }));
+}